@@ -0,0 +1,179 @@
+"""Admission control for task submissions.
+
+Two limits protect the workers and the broker:
+
+* Queue depth: `monitor` polls the depth of the task queues in the background and keeps it
+  in-process. While the backlog exceeds `ADMISSION_MAX_QUEUE_DEPTH`, submissions are rejected
+  with `503` and a `Retry-After` estimated from how fast the backlog drains.
+* Per-user rate: every user has a token bucket in Redis, refilled at `RATE_LIMIT_PER_SECOND`
+  up to `RATE_LIMIT_BURST` tokens. Each task takes a token, and submissions without enough
+  tokens are rejected with `429`.
+
+Neither check costs a round trip to the broker on the request path.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+
+from fastapi import HTTPException
+from prometheus_client import Counter, Gauge
+
+from cache import instance as cache_instance
+from celery_app import instance as celery_instance, task_queues
+
+_logger = logging.getLogger(__name__)
+
+ADMISSION_MAX_QUEUE_DEPTH = int(os.getenv("ADMISSION_MAX_QUEUE_DEPTH", "0"))
+"""Backlog of queued tasks beyond which submissions are rejected. `0` disables the check."""
+
+ADMISSION_QUEUES = os.getenv("ADMISSION_QUEUES", ",".join(queue.name for queue in task_queues())).split(",")
+"""Broker queues whose depths add up to the backlog, all task queues by default."""
+
+ADMISSION_POLL_INTERVAL = float(os.getenv("ADMISSION_POLL_INTERVAL", "1.0"))
+"""Seconds between two queue depth polls."""
+
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv("ADMISSION_MAX_RETRY_AFTER", "60"))
+"""Upper bound of the `Retry-After` sent with rejections, in seconds."""
+
+RATE_LIMIT_PER_SECOND = float(os.getenv("RATE_LIMIT_PER_SECOND", "0"))
+"""Tasks per second a user may submit on average. `0` disables rate limiting."""
+
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "100"))
+"""Tasks a user may submit at once after having been idle."""
+
+RATE_LIMIT_KEY_PREFIX = "ratelimit:"
+"""Prefix of the Redis keys holding token buckets."""
+
+BROKER_QUEUE_DEPTH = Gauge("broker_queue_depth", "Tasks waiting in the task queues, as last polled.")
+BROKER_DRAIN_RATE = Gauge("broker_queue_drain_rate", "Estimated tasks per second taken off the task queues.")
+ADMISSION_REJECTIONS = Counter("admission_rejections_total", "Rejected task submissions.", ["reason"])
+
+_TOKEN_BUCKET_SCRIPT = cache_instance.register_script("""
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+""")
+"""Take tokens from a bucket, if there are enough.
+
+KEYS: bucket. ARGV: refill rate, burst, tokens requested. Returns the seconds to wait until
+enough tokens are available, `0` if they were taken.
+"""
+
+
+class QueueMonitor:
+    """In-process view of the task queue backlog.
+
+    The drain rate is estimated from how fast the backlog shrinks between polls, as an
+    exponentially weighted moving average. It is therefore most accurate while submissions are
+    being rejected, which is when it is needed.
+    """
+
+    def __init__(self, smoothing: float = 0.3):
+        self.smoothing = smoothing
+        self.depth: int | None = None
+        self.drain_rate = 0.0
+        self._observed_at: float | None = None
+
+    def observe(self, depth: int, now: float | None = None):
+        """Record a polled queue depth."""
+        now = time.monotonic() if now is None else now
+        if self.depth is not None and self._observed_at is not None and now > self._observed_at and self.depth > 0:
+            rate = max(0, self.depth - depth) / (now - self._observed_at)
+            self.drain_rate = self.smoothing * rate + (1 - self.smoothing) * self.drain_rate
+
+        self.depth = depth
+        self._observed_at = now
+        BROKER_QUEUE_DEPTH.set(depth)
+        BROKER_DRAIN_RATE.set(self.drain_rate)
+
+    def overloaded(self) -> bool:
+        """Whether the backlog exceeds its limit. Unknown backlogs never do."""
+        return ADMISSION_MAX_QUEUE_DEPTH > 0 and self.depth is not None and self.depth > ADMISSION_MAX_QUEUE_DEPTH
+
+    def retry_after(self) -> int:
+        """Seconds until the backlog is expected to be back within its limit."""
+        excess = (self.depth or 0) - ADMISSION_MAX_QUEUE_DEPTH
+        if self.drain_rate <= 0:
+            return ADMISSION_MAX_RETRY_AFTER
+        return min(ADMISSION_MAX_RETRY_AFTER, max(1, math.ceil(excess / self.drain_rate)))
+
+    async def run(self, retry_interval: float = 5.0):
+        """Poll the queue depth for the lifetime of the application."""
+        while True:
+            try:
+                self.observe(await asyncio.to_thread(_fetch_depth))
+                await asyncio.sleep(ADMISSION_POLL_INTERVAL)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Admit everything rather than rejecting on stale data
+                _logger.exception("Polling the queue depth failed, retrying")
+                self.depth = None
+                await asyncio.sleep(retry_interval)
+
+
+def _fetch_depth() -> int:
+    with celery_instance.connection_for_read() as connection:
+        channel = connection.default_channel
+        return sum(channel.queue_declare(queue=queue, passive=True).message_count for queue in ADMISSION_QUEUES)
+
+
+monitor = QueueMonitor()
+"""Queue backlog of the process, kept up to date by the application lifespan."""
+
+
+async def admit(user_name: str, tasks: int = 1):
+    """Admit the submission of tasks, or reject it.
+
+    Args:
+        user_name (str): User submitting the tasks.
+        tasks (int): Number of tasks submitted at once.
+
+    Raises:
+        HTTPException: `503` if the workers are overloaded, `429` if the user exceeds their rate,
+            both with a `Retry-After` header, or `429` if more tasks than the burst are submitted.
+    """
+    if monitor.overloaded():
+        ADMISSION_REJECTIONS.labels(reason="queue_depth").inc()
+        raise HTTPException(
+            status_code=503,
+            detail="Too many tasks queued, try again later.",
+            headers={"Retry-After": str(monitor.retry_after())},
+        )
+
+    if RATE_LIMIT_PER_SECOND > 0:
+        if tasks > RATE_LIMIT_BURST:
+            ADMISSION_REJECTIONS.labels(reason="rate_limit").inc()
+            raise HTTPException(status_code=429, detail=f"At most {RATE_LIMIT_BURST} tasks can be submitted at once.")
+
+        wait = float(await _TOKEN_BUCKET_SCRIPT(
+            keys=[f"{RATE_LIMIT_KEY_PREFIX}{user_name}"],
+            args=[RATE_LIMIT_PER_SECOND, RATE_LIMIT_BURST, tasks],
+            client=cache_instance,
+        ))
+        if wait > 0:
+            ADMISSION_REJECTIONS.labels(reason="rate_limit").inc()
+            raise HTTPException(
+                status_code=429,
+                detail="Rate limit exceeded.",
+                headers={"Retry-After": str(min(ADMISSION_MAX_RETRY_AFTER, math.ceil(wait)))},
+            )
@@ -1,20 +1,74 @@
+import asyncio
 import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
 
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Body, Header, Response
 from fastapi.params import Depends
+from fastapi.responses import StreamingResponse
 
+import admission
 import auth
+import cache
+import credit_slots
+import history
+import idempotency
+import ledger
+import publisher
+import results
 import service
+import settlement
+import timing
 from database.models import User
-from models import UserResponseBase, TaskResponseBase, TaskStateResponse, UserCreditsResponse
+from models import UserResponseBase, TaskResponseBase, TaskStateResponse, UserCreditsResponse, OperandsRequest, \
+    BatchTaskResponse, GroupStateResponse, TaskHistoryResponse
 from prometheus_fastapi_instrumentator import Instrumentator
 
-from utils import deactivated
-
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 _logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    """Application lifespan.
+
+    Runs the background tasks of the app, i.e. the user cache invalidation listener, the
+    rebuilds of the API keys filter, the result backend notifier, the task history partition
+    maintenance, in the `ledger` billing mode the ledger write-behind, in the `sharded` billing
+    mode the credit slot rebalancer, in the `on_success` billing policy the settlement of
+    finished tasks, with admission control on queue depth the queue depth monitor and, with
+    sampling enabled, the result backend memory sampler. On shutdown it waits for in-flight
+    publishes and releases the pooled Redis connections.
+    """
+    background_tasks = [
+        asyncio.create_task(auth.listen_for_invalidations()),
+        asyncio.create_task(results.notifier.run()),
+        asyncio.create_task(history.run_maintenance()),
+    ]
+    if service.BILLING_MODE == "ledger":
+        background_tasks.append(asyncio.create_task(ledger.write_behind()))
+    if service.BILLING_MODE == "sharded":
+        background_tasks.append(asyncio.create_task(credit_slots.run_rebalancer(credit_slots.CREDIT_SLOTS)))
+    if service.BILLING_POLICY == "on_success":
+        background_tasks.append(asyncio.create_task(settlement.run()))
+    if admission.ADMISSION_MAX_QUEUE_DEPTH > 0:
+        background_tasks.append(asyncio.create_task(admission.monitor.run()))
+    if auth.API_KEYS_FILTER_REFRESH_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(auth.maintain_api_keys_filter()))
+    if results.RESULT_MEMORY_SAMPLE_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(results.run_memory_sampler()))
+
+    yield
+
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await asyncio.to_thread(publisher.shutdown)
+    await results.close()
+    await cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
 """FastAPI entrypoint."""
 
 Instrumentator().instrument(app).expose(app)
@@ -27,6 +81,9 @@ and health of the application using Prometheus and Grafana.
 The endpoint can be accessed under `http://localhost:8000/docs`
 """
 
+if timing.SERVER_TIMING:
+    app.add_middleware(timing.ServerTimingMiddleware)
+
 
 @app.get("/health")
 def health():
@@ -38,55 +95,172 @@ def health():
 
 
 @app.get("/users", response_model=list[UserResponseBase])
-async def users():
-    """List all users."""
+async def users(response: Response,
+                after: str | None = Query(None),
+                limit: int = Query(service.USERS_PAGE_SIZE, ge=1, le=service.MAX_USERS_PAGE_SIZE),
+                stream: bool = Query(False)):
+    """List users, ordered by name.
+
+    Users are listed a page at a time. Whenever there may be more users, the `X-Next-Cursor`
+    header holds the `after` value of the next page.
+
+    With `stream`, all users after `after` are streamed as newline-delimited JSON instead.
+    """
+
+    _logger.debug(f"Listing users after {after}")
+
+    if stream:
+        async def lines():
+            async for name in service.stream_user_names(after):
+                yield UserResponseBase(name=name).model_dump_json() + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
 
-    _logger.debug("Listing all users")
+    page = await service.get_all_users(after, limit)
+    if len(page) == limit:
+        response.headers["X-Next-Cursor"] = page[-1].name
 
-    return await service.get_all_users()
+    return page
 
 
 @app.post("/task", response_model=TaskResponseBase)
-async def create_addition_task(x: int = Query(...),
+async def create_addition_task(response: Response,
+                               x: int = Query(...),
                                y: int = Query(...),
+                               idempotency_key: str | None = Header(None, max_length=idempotency.IDEMPOTENCY_KEY_MAX_LENGTH),
                                user: User = Depends(auth.get_current_user)):
-    """Create a number addition task."""
+    """Create a number addition task.
+
+    With an `Idempotency-Key` header, retries of the request get the response of the first
+    one back, marked by the `Idempotent-Replayed` header, instead of creating another task.
+    """
 
     _logger.debug(f"Creating addition task with {x} and {y}")
 
-    return await service.create_addition_task(user, x, y)
+    task, replayed = await idempotency.submit_once(
+        user.name, idempotency_key, ["task", x, y], TaskResponseBase,
+        lambda: service.create_addition_task(user, x, y),
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+
+    return task
+
+
+@app.post("/tasks", response_model=BatchTaskResponse)
+async def create_addition_tasks(response: Response,
+                                operands: list[OperandsRequest] = Body(..., min_length=1, max_length=service.MAX_BATCH_SIZE),
+                                group: bool = Query(False),
+                                idempotency_key: str | None = Header(None, max_length=idempotency.IDEMPOTENCY_KEY_MAX_LENGTH),
+                                user: User = Depends(auth.get_current_user)):
+    """Create a batch of number addition tasks.
+
+    The whole batch is charged at once, or rejected if the user cannot afford all of it. If
+    `group` is set, the tasks are submitted as a group whose ID can be polled under `/groups`.
+    Retries with the same `Idempotency-Key` header are answered like for `/task`.
+    """
+
+    _logger.debug(f"Creating {len(operands)} addition tasks")
+
+    pairs = [(pair.x, pair.y) for pair in operands]
+    batch, replayed = await idempotency.submit_once(
+        user.name, idempotency_key, ["tasks", pairs, group], BatchTaskResponse,
+        lambda: service.create_addition_tasks(user, pairs, grouped=group),
+    )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+
+    return batch
 
 
 @app.get("/poll/{task_id}", response_model=TaskStateResponse)
-def poll_task_state(task_id: str):
+async def poll_task_state(task_id: str, wait: float = Query(0, ge=0, le=service.MAX_POLL_WAIT)):
     """Poll task state.
 
     The endpoint will only populate the `result` part of the response if the underlying
     task has been completed successfully. Otherwise, only the task ID with the corresponding state
     will be returned.
+
+    If `wait` is set, the request is held open until the task has completed or `wait` seconds
+    have passed, whichever comes first, which saves clients from polling in a loop.
     """
 
     _logger.debug(f"Polling task state for {task_id}")
 
-    return service.poll_task_state(task_id)
+    if wait:
+        return await service.wait_for_task_state(task_id, wait)
 
+    return await service.poll_task_state(task_id)
 
-@app.get("/fair_poll/{task_id}", response_model=TaskStateResponse)
-@deactivated
-async def fair_poll_task(task_id: str, user: User = Depends(auth.get_current_user)):
-    """Poll task state.
 
-    This endpoint uses a "fairer" approach to polling task states and deducting credits.
+@app.post("/poll", response_model=list[TaskStateResponse])
+async def poll_task_states(task_ids: list[str] = Body(..., min_length=1, max_length=service.MAX_BATCH_SIZE)):
+    """Poll the state of many tasks at once.
 
-    The endpoint will only populate the `result` part of the response if the underlying
-    task has been completed successfully. Otherwise, only the task ID with the corresponding state
-    will be returned.
+    Expects a JSON list of task IDs and returns their states in the same order, fetched from the
+    result backend in a single round trip.
+    """
+
+    _logger.debug(f"Polling task states for {len(task_ids)} tasks")
+
+    return await service.poll_task_states(task_ids)
+
+
+@app.get("/stream")
+async def stream_task_states(task_id: list[str] = Query([]),
+                             group_id: str | None = Query(None),
+                             user: User = Depends(auth.get_current_user)):
+    """Stream task state transitions as Server-Sent Events.
+
+    Follows the given tasks, the tasks of the given group or, if neither is given, the tasks
+    the user submitted recently. Every task's current state is sent first, then each
+    transition (PENDING -> STARTED -> SUCCESS/FAILURE) as a `state` event. The stream ends with
+    an `end` event once all tasks are ready.
+    """
+    task_ids = await service.get_streamed_task_ids(user, task_id, group_id)
 
-    The endpoint is temporarily deactivated!
+    _logger.debug(f"Streaming task states of {len(task_ids)} tasks for {user.name}")
+
+    async def events():
+        async for state in results.stream_states(task_ids, service.STREAM_HEARTBEAT):
+            if state is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: state\ndata: {state.model_dump_json()}\n\n"
+        yield "event: end\ndata: {}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/history", response_model=list[TaskHistoryResponse])
+async def task_history(response: Response,
+                       after: str | None = Query(None),
+                       limit: int = Query(service.HISTORY_PAGE_SIZE, ge=1, le=service.MAX_HISTORY_PAGE_SIZE),
+                       since: datetime | None = Query(None),
+                       until: datetime | None = Query(None),
+                       user: User = Depends(auth.get_current_user)):
+    """List the tasks the user submitted, newest first.
+
+    Tasks are listed a page at a time, optionally within `[since, until)`. Whenever there may
+    be more tasks, the `X-Next-Cursor` header holds the `after` value of the next page.
     """
-    _logger.debug(f"(Fair) Polling task state for {task_id}")
 
-    return await service.fair_poll_task_state(user, task_id)
+    _logger.debug(f"Listing task history of {user.name} after {after}")
+
+    page = await service.get_task_history(user, after, limit, since, until)
+    if len(page) == limit:
+        response.headers["X-Next-Cursor"] = service.history_cursor(page[-1])
+
+    return page
+
+
+@app.get("/groups/{group_id}", response_model=GroupStateResponse)
+async def poll_group_state(group_id: str):
+    """Poll the state of every task of a group."""
+
+    _logger.debug(f"Polling group state for {group_id}")
+
+    return await service.poll_group_state(group_id)
 
 
 @app.get("/credits/{user_name}", response_model=UserCreditsResponse)
@@ -1,13 +1,18 @@
+import asyncio
 import logging
+import os
+import time
 
 from fastapi import HTTPException
 from fastapi.params import Depends
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from prometheus_client import Counter
 from sqlalchemy import select
 
-from database.engine import async_session
+import timing
+from database.engine import async_read_session
 from database.models import User
-from cache import instance as cache_instance
+from cache import instance as cache_instance, listen, BloomFilter, LocalCache
 from models import UserResponseBase, CachedUserValue
 
 _logger = logging.getLogger(__name__)
@@ -16,6 +21,47 @@ security = HTTPBearer()
 
 USERS_CACHE_REGION = "users"
 
+USERS_INVALIDATION_CHANNEL = "users:invalidate"
+"""Redis pub/sub channel carrying API keys whose cached user must be dropped."""
+
+USERS_LOCAL_CACHE_SIZE = int(os.getenv("USERS_LOCAL_CACHE_SIZE", "10000"))
+"""Maximum number of users kept in the in-process cache."""
+
+USERS_LOCAL_CACHE_TTL = float(os.getenv("USERS_LOCAL_CACHE_TTL", "60"))
+"""Seconds an in-process cache entry is trusted without hearing an invalidation."""
+
+USERS_API_KEYS_CHANNEL = "users:api_keys"
+"""Redis pub/sub channel carrying API keys that were just issued."""
+
+UNKNOWN_API_KEYS_TTL = float(os.getenv("UNKNOWN_API_KEYS_TTL", "30"))
+"""Seconds an API key not found in the database is rejected without looking it up again. `0` disables it."""
+
+API_KEYS_FILTER_FALSE_POSITIVE_RATE = float(os.getenv("API_KEYS_FILTER_FALSE_POSITIVE_RATE", "0.01"))
+"""Share of unknown API keys the Bloom filter of valid keys lets through."""
+
+API_KEYS_FILTER_REFRESH_INTERVAL = float(os.getenv("API_KEYS_FILTER_REFRESH_INTERVAL", "300"))
+"""Seconds between two rebuilds of the Bloom filter of valid keys. `0` disables the filter."""
+
+API_KEYS_FILTER_MISS_LOOKUPS = float(os.getenv("API_KEYS_FILTER_MISS_LOOKUPS", "10"))
+"""Lookups per second a process spends on API keys missing from the Bloom filter, e.g. keys of
+users created since it was built. Misses beyond that are rejected. `0` rejects every miss."""
+
+AUTH_REJECTIONS = Counter("auth_unknown_api_key_total", "Requests rejected for an unknown API key.", ["by"])
+
+users_local_cache = LocalCache("users", maxsize=USERS_LOCAL_CACHE_SIZE, ttl=USERS_LOCAL_CACHE_TTL)
+"""Per-process L1 cache of `CachedUserValue`s keyed by API key."""
+
+unknown_api_keys = LocalCache("unknown_api_keys", maxsize=USERS_LOCAL_CACHE_SIZE, ttl=UNKNOWN_API_KEYS_TTL)
+"""Per-process negative cache of API keys the database does not know."""
+
+api_keys_filter: BloomFilter | None = None
+"""Bloom filter of every valid API key, `None` until it is first built by `maintain_api_keys_filter`."""
+
+_announced_api_keys: set[str] = set()
+
+_filter_miss_tokens = max(1.0, API_KEYS_FILTER_MISS_LOOKUPS)
+_filter_miss_refilled_at = time.monotonic()
+
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> User:
     """Get current user from token.
@@ -23,6 +69,15 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     Utility function to retrieve the user trying to access the API based on the provided bearer
     token and the stored API key.
 
+    Lookups go through an in-process cache first, then the Redis `users` hash and finally the
+    database. Entries are dropped from both caches through `invalidate_user`.
+
+    Unknown API keys are rejected without any network hop once the database did not know them,
+    for `UNKNOWN_API_KEYS_TTL` seconds. Keys missing from the Bloom filter of valid keys are
+    most likely unknown as well, but may belong to users created since the filter was built.
+    They are looked up at no more than `API_KEYS_FILTER_MISS_LOOKUPS` per second, so that
+    floods of made-up keys can not overload the database, and rejected beyond that.
+
     Important!!! The cache is here to showcase how the database can be alleviated from certain
     requests. Nevertheless, this cache is not updated and when relying on state - like credits - from
     stale data, it can lead to inconsistencies. Because of this the cache in this implementation is
@@ -33,30 +88,180 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     # 1. Extract credentials
     token = credentials.credentials
 
-    # 2. Try to avoid database hop by checking the cache first
-    cached_user = cache_instance.hget(USERS_CACHE_REGION, token)
+    # 2. Serve hot tokens without any network hop
+    local_user = users_local_cache.get(token)
+    if local_user is not None:
+        return local_user
+
+    # 2.1 Reject tokens the database did not know without any network hop either
+    if UNKNOWN_API_KEYS_TTL > 0 and unknown_api_keys.get(token) is not None:
+        AUTH_REJECTIONS.labels(by="negative_cache").inc()
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    # 2.2 Look up tokens missing from the filter at a bounded rate only
+    missed_filter = api_keys_filter is not None and token not in api_keys_filter
+    if missed_filter and not _take_filter_miss_lookup():
+        AUTH_REJECTIONS.labels(by="filter").inc()
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    # 3. Try to avoid database hop by checking the cache first
+    with timing.stage("auth_cache"):
+        cached_user = await cache_instance.hget(USERS_CACHE_REGION, token)
     if cached_user is not None:
         cached_user_value = CachedUserValue.model_validate_json(cached_user)
-        return CachedUserValue.model_validate_json(cached_user)
-
-    # 3. Proceed to the database
-    async with async_session() as session:
-        result = await session.execute(select(User).where(User.api_key == token))
-        user = result.scalar_one_or_none()
-
-        # 4. Raise if no user is found
-        if not user:
-            _logger.error(f"User with api_key {token[:3]}... not found")
-            raise HTTPException(status_code=401, detail="Unauthorized")
-
-        # 5. Update the cache with the user
-        # 5.1 Convert user to pydantic cached value that we can serialize
-        cached_user_value = CachedUserValue.model_validate(user)
-        # 5.2 Write to cache
-        cache_instance.hset(
-            name=USERS_CACHE_REGION,
-            key=token,
-            value=cached_user_value.model_dump_json()
-        )
-
-        return user
+        users_local_cache.set(token, cached_user_value)
+        if missed_filter:
+            accept_api_key(token)
+        return cached_user_value
+
+    # 4. Proceed to the database, users are only read here so a replica will do
+    with timing.stage("auth_db"):
+        async with async_read_session() as session:
+            result = await session.execute(select(User).where(User.api_key == token))
+            user = result.scalar_one_or_none()
+
+    # 5. Raise if no user is found
+    if not user:
+        _logger.error(f"User with api_key {token[:3]}... not found")
+        AUTH_REJECTIONS.labels(by="database").inc()
+        if UNKNOWN_API_KEYS_TTL > 0:
+            unknown_api_keys.set(token, True)
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    # 6. Update the caches with the user
+    # 6.1 Convert user to pydantic cached value that we can serialize
+    cached_user_value = CachedUserValue.model_validate(user)
+    # 6.2 Write to cache
+    await cache_instance.hset(
+        name=USERS_CACHE_REGION,
+        key=token,
+        value=cached_user_value.model_dump_json()
+    )
+    users_local_cache.set(token, cached_user_value)
+    if missed_filter:
+        accept_api_key(token)
+
+    return user
+
+
+async def invalidate_user(token: str):
+    """Drop a cached user everywhere.
+
+    Must be called whenever a user's cached state changes, e.g. their credits are updated or
+    their API key is rotated. The Redis entry is removed and every API process is told to drop
+    its in-process copy.
+
+    Args:
+        token (str): API key the user is cached under.
+    """
+    users_local_cache.invalidate(token)
+    async with cache_instance.pipeline(transaction=False) as pipe:
+        pipe.hdel(USERS_CACHE_REGION, token)
+        pipe.publish(USERS_INVALIDATION_CHANNEL, token)
+        await pipe.execute()
+
+
+async def announce_api_key(token: str):
+    """Make a newly issued API key usable right away in every API process.
+
+    Should be called whenever a user is created or their API key is rotated. Otherwise the key
+    counts against `API_KEYS_FILTER_MISS_LOOKUPS` until the Bloom filter is next rebuilt, and
+    stays rejected until its negative cache entry expires if it was tried before being stored.
+
+    Args:
+        token (str): The new API key.
+    """
+    accept_api_key(token)
+    await cache_instance.publish(USERS_API_KEYS_CHANNEL, token)
+
+
+def _take_filter_miss_lookup() -> bool:
+    """Take a lookup of a key missing from the filter out of the per-process budget, if left."""
+    global _filter_miss_tokens, _filter_miss_refilled_at
+    if API_KEYS_FILTER_MISS_LOOKUPS <= 0:
+        return False
+
+    now = time.monotonic()
+    _filter_miss_tokens = min(
+        max(1.0, API_KEYS_FILTER_MISS_LOOKUPS),
+        _filter_miss_tokens + (now - _filter_miss_refilled_at) * API_KEYS_FILTER_MISS_LOOKUPS,
+    )
+    _filter_miss_refilled_at = now
+    if _filter_miss_tokens < 1:
+        return False
+    _filter_miss_tokens -= 1
+    return True
+
+
+def accept_api_key(token: str):
+    """Let a new API key through the in-process filter and negative cache."""
+    unknown_api_keys.invalidate(token)
+    _announced_api_keys.add(token)
+    if api_keys_filter is not None:
+        api_keys_filter.add(token)
+
+
+async def build_api_keys_filter() -> BloomFilter:
+    """Build a Bloom filter of every API key in the database."""
+    async with async_read_session() as session:
+        result = await session.execute(select(User.api_key))
+        tokens = result.scalars().all()
+
+    # Leave room for the keys announced until the next rebuild
+    api_keys = BloomFilter(2 * len(tokens) + 1000, API_KEYS_FILTER_FALSE_POSITIVE_RATE)
+    for token in tokens:
+        api_keys.add(token)
+    return api_keys
+
+
+async def maintain_api_keys_filter(retry_interval: float = 5.0):
+    """Keep the Bloom filter of valid API keys up to date for the lifetime of the application.
+
+    Rebuilding drops the keys of deleted users, which a Bloom filter can not remove. Keys
+    announced since the previous rebuild are carried over, in case the replica the keys are
+    read from lags behind.
+    """
+    global api_keys_filter, _announced_api_keys
+    while True:
+        try:
+            announced, _announced_api_keys = _announced_api_keys, set()
+            try:
+                api_keys = await build_api_keys_filter()
+            except BaseException:
+                _announced_api_keys |= announced
+                raise
+            for token in announced | _announced_api_keys:
+                api_keys.add(token)
+            api_keys_filter = api_keys
+            _logger.debug("Rebuilt the API keys filter")
+            await asyncio.sleep(API_KEYS_FILTER_REFRESH_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            _logger.exception("Building the API keys filter failed, retrying")
+            await asyncio.sleep(retry_interval)
+
+
+async def listen_for_invalidations(retry_interval: float = 1.0):
+    """Consume user invalidations and new API keys published by any API process.
+
+    Runs for the lifetime of the application. The in-process caches are cleared every time the
+    subscription is (re-)established after losing the connection, since messages may have been
+    missed meanwhile. Idle periods do not end the subscription.
+    """
+    while True:
+        try:
+            async with cache_instance.pubsub() as pubsub:
+                await pubsub.subscribe(USERS_INVALIDATION_CHANNEL, USERS_API_KEYS_CHANNEL)
+                users_local_cache.clear()
+                unknown_api_keys.clear()
+                async for message in listen(pubsub):
+                    if message["channel"] in (USERS_API_KEYS_CHANNEL, USERS_API_KEYS_CHANNEL.encode()):
+                        accept_api_key(message["data"].decode())
+                    else:
+                        users_local_cache.invalidate(message["data"].decode())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            _logger.exception("User invalidation subscription failed, retrying")
+            await asyncio.sleep(retry_interval)
@@ -0,0 +1,254 @@
+"""Throughput and latency of the hot endpoints, on one machine and without any service running.
+
+Drives `/task`, `/poll/{task_id}`, `/credits/{user_name}` and `/users` through the ASGI app
+in-process, with a fixed number of requests in flight. Redis is replaced by fakeredis, the
+broker by Celery's in-memory transport, and Postgres by a stand-in session that answers every
+statement after a simulated round trip. With `--database`, the Postgres at
+`ASYNC_DATABASE_URL`, migrated to head, is used instead.
+
+Throughput and p50/p95/p99 latencies per endpoint are written as JSON, and two such files can
+be compared. The comparison fails when an endpoint got slower than the threshold, so that
+regressions in the hot paths show up as numbers.
+
+Usage:
+    PYTHONPATH=api/ python api/benchmarks/bench_api.py --requests 2000 --concurrency 64 --output before.json
+    PYTHONPATH=api/ python api/benchmarks/bench_api.py --compare before.json after.json --threshold 10
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import uuid
+from contextlib import ExitStack
+from unittest.mock import patch
+
+# Publish to an in-process broker, before the Celery app is configured on import
+os.environ.setdefault("CELERY_BROKER_URL", "memory://localhost//")
+os.environ.setdefault("CELERY_CONFIRM_PUBLISH", "false")
+
+import fakeredis
+import httpx
+from celery import states
+from sqlalchemy.dialects.postgresql import insert
+
+import results
+from api import app
+from celery_app import instance as celery_instance
+from database.engine import async_session
+from database.models import User
+
+USER = User(name="bench", api_key=str(uuid.UUID(int=1)), credits=10 ** 9)
+ADMIN = User(name="admin", api_key=str(uuid.UUID(int=2)), credits=10 ** 9)
+
+ENDPOINTS = ("task", "poll", "credits", "users")
+"""Endpoints benchmarked, in the order they are run."""
+
+METRICS = {"throughput_rps": 1, "p50_ms": -1, "p95_ms": -1, "p99_ms": -1}
+"""Reported metrics, with the sign of their change that counts as an improvement."""
+
+
+class StandInResult:
+    def __init__(self, rows: list):
+        self._rows = rows
+
+    def scalar_one_or_none(self):
+        return self._rows[0] if self._rows else None
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self._rows
+
+
+class StandInSession:
+    """Session answering user lookups with the benchmark users and debits with a balance."""
+
+    def __init__(self, database: "StandInDatabase"):
+        self._database = database
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def execute(self, statement, *args, **kwargs):
+        await asyncio.sleep(self._database.rtt)
+        self._database.statements += 1
+        descriptions = getattr(statement, "column_descriptions", [])
+        if descriptions and descriptions[0].get("entity") is User:
+            # Lookups by API key or name get the matching user, listings get every user
+            lookups = {str(value) for key, value in statement.compile().params.items() if key.startswith(("api_key", "name"))}
+            if lookups:
+                return StandInResult([user for user in self._database.users if lookups & {user.api_key, user.name}])
+            return StandInResult(self._database.users)
+        return StandInResult([10 ** 9])
+
+    async def commit(self):
+        await asyncio.sleep(self._database.rtt)
+
+
+class StandInDatabase:
+    def __init__(self, rtt: float, users: int):
+        self.rtt = rtt
+        self.users = [User(name=f"user-{i:06d}", api_key=str(uuid.uuid4()), credits=100) for i in range(users)]
+        self.statements = 0
+
+    def session(self):
+        return StandInSession(self)
+
+
+def request_for(endpoint: str, i: int, task_ids: list[str]) -> tuple[str, str, dict]:
+    """Method, URL and headers of the `i`-th request to an endpoint."""
+    if endpoint == "task":
+        return "POST", f"/task?x={i}&y=1", {"Authorization": f"Bearer {USER.api_key}"}
+    if endpoint == "poll":
+        return "GET", f"/poll/{task_ids[i % len(task_ids)]}", {}
+    if endpoint == "credits":
+        return "GET", f"/credits/{USER.name}", {"Authorization": f"Bearer {ADMIN.api_key}"}
+    return "GET", "/users?limit=100", {}
+
+
+async def measure(client: httpx.AsyncClient, endpoint: str, requests: int, concurrency: int,
+                  task_ids: list[str]) -> dict:
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        nonlocal errors
+        method, url, headers = request_for(endpoint, i, task_ids)
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.request(method, url, headers=headers)
+            latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": requests / elapsed,
+        "p50_ms": percentiles[49] * 1000,
+        "p95_ms": percentiles[94] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+    }
+
+
+async def seed_database():
+    async with async_session() as session:
+        for user in (USER, ADMIN):
+            await session.execute(
+                insert(User).values(name=user.name, api_key=user.api_key, credits=user.credits).on_conflict_do_nothing()
+            )
+        await session.commit()
+
+
+async def run(endpoints: list[str], requests: int, concurrency: int, warmup: int) -> dict:
+    # Tasks polled are done already, as if a worker had run them
+    task_ids = [str(uuid.uuid4()) for _ in range(1000)]
+    await results.store_states(task_ids, states.SUCCESS, 2)
+
+    transport = httpx.ASGITransport(app=app)
+    stats = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for endpoint in endpoints:
+            await measure(client, endpoint, warmup, concurrency, task_ids)
+            stats[endpoint] = await measure(client, endpoint, requests, concurrency, task_ids)
+    return stats
+
+
+def benchmark(args) -> dict:
+    server = fakeredis.FakeServer()
+    redis = fakeredis.FakeAsyncRedis(server=server)
+    database = StandInDatabase(args.db_rtt_ms / 1000, users=100)
+
+    with ExitStack() as stack:
+        for target in ("cache.instance", "auth.cache_instance", "admission.cache_instance",
+                       "ledger.cache_instance", "results.instance"):
+            stack.enter_context(patch(target, redis))
+        # The result backend subscribes to the results of every task published
+        stack.enter_context(patch.object(type(celery_instance.backend), "client", fakeredis.FakeRedis(server=server)))
+        if args.database:
+            asyncio.run(seed_database())
+        else:
+            for target in ("auth.async_read_session", "service.async_session", "service.async_read_session",
+                           "ledger.async_session"):
+                stack.enter_context(patch(target, database.session))
+            database.users[:0] = [USER, ADMIN]
+
+        stats = asyncio.run(run(args.endpoints, args.requests, args.concurrency, args.warmup))
+
+    return {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "database": "postgres" if args.database else f"stand-in, {args.db_rtt_ms} ms round trip",
+        },
+        "endpoints": stats,
+    }
+
+
+def compare(base: dict, head: dict, threshold: float) -> bool:
+    """Print the change of every metric between two runs.
+
+    Returns:
+        bool: Whether no metric got worse by more than `threshold` percent.
+    """
+    passed = True
+    print(f"{'endpoint':>8} {'metric':>15} {'base':>10} {'head':>10} {'change':>8}")
+    for endpoint, head_stats in head["endpoints"].items():
+        base_stats = base["endpoints"].get(endpoint)
+        if base_stats is None:
+            continue
+        for metric, better in METRICS.items():
+            change = (head_stats[metric] - base_stats[metric]) / base_stats[metric] * 100
+            regressed = change * better < -threshold
+            passed = passed and not regressed
+            print(f"{endpoint:>8} {metric:>15} {base_stats[metric]:>10.2f} {head_stats[metric]:>10.2f} "
+                  f"{change:>+7.1f}%{'  REGRESSION' if regressed else ''}")
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=2000, help="Measured requests per endpoint.")
+    parser.add_argument("--warmup", type=int, default=200, help="Unmeasured requests per endpoint, run first.")
+    parser.add_argument("--concurrency", type=int, default=64, help="Requests in flight at any time.")
+    parser.add_argument("--db-rtt-ms", type=float, default=0.5, help="Simulated round trip per statement.")
+    parser.add_argument("--database", action="store_true", help="Use the Postgres at ASYNC_DATABASE_URL.")
+    parser.add_argument("--output", help="JSON file the results are written to.")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "HEAD"), help="Compare two result files instead.")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Percentage beyond which a change is a regression.")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as base, open(args.compare[1]) as head:
+            sys.exit(0 if compare(json.load(base), json.load(head), args.threshold) else 1)
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    report = benchmark(args)
+
+    print(f"{'endpoint':>8} {'req/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for endpoint, stats in report["endpoints"].items():
+        print(f"{endpoint:>8} {stats['throughput_rps']:>10.1f} {stats['p50_ms']:>8.2f} {stats['p95_ms']:>8.2f} "
+              f"{stats['p99_ms']:>8.2f} {stats['errors']:>7}")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
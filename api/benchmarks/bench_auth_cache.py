@@ -0,0 +1,116 @@
+"""Concurrent `/task` latency with a blocking vs. an async auth cache.
+
+Drives the ASGI app in-process against a local fake Redis that adds a fixed round trip
+latency to every command. The `blocking` mode reproduces the previous behaviour, where
+the synchronous client stalled the event loop on every `hget`, while the `async` mode
+awaits the pooled async client.
+
+The in-process users cache would answer every request after the first without reaching
+either client, so it is disabled for both modes.
+
+Requests arrive open-loop at a fixed rate and latency is measured from the scheduled
+arrival time, so time spent waiting for a stalled event loop is part of the number.
+
+Usage:
+    PYTHONPATH=api/ python api/benchmarks/bench_auth_cache.py --requests 2000 --rate 400
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import time
+from unittest.mock import AsyncMock, patch
+
+import fakeredis
+import httpx
+
+import auth
+from api import app
+from cache import LocalCache
+from models import CachedUserValue, TaskResponseBase
+
+TOKEN = "550e8400-e29b-41d4-a716-446655440000"
+CACHED_USER = CachedUserValue(name="test_user1", credits=500, api_key=TOKEN).model_dump_json()
+
+
+class BlockingFakeRedis:
+    """Synchronous fake Redis with a simulated round trip, awaited like the old code path."""
+
+    def __init__(self, server: fakeredis.FakeServer, rtt: float):
+        self._client = fakeredis.FakeRedis(server=server)
+        self._rtt = rtt
+
+    async def hget(self, name, key):
+        time.sleep(self._rtt)
+        return self._client.hget(name, key)
+
+    async def hset(self, name, key, value):
+        time.sleep(self._rtt)
+        return self._client.hset(name, key, value)
+
+
+class AsyncFakeRedis:
+    """Async fake Redis with a simulated, non-blocking round trip."""
+
+    def __init__(self, server: fakeredis.FakeServer, rtt: float):
+        self._client = fakeredis.FakeAsyncRedis(server=server)
+        self._rtt = rtt
+
+    async def hget(self, name, key):
+        await asyncio.sleep(self._rtt)
+        return await self._client.hget(name, key)
+
+    async def hset(self, name, key, value):
+        await asyncio.sleep(self._rtt)
+        return await self._client.hset(name, key, value)
+
+
+async def run(requests: int, rate: float) -> dict:
+    latencies = []
+    transport = httpx.ASGITransport(app=app)
+
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(arrival: float):
+            await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+            response = await client.post("/task?x=1&y=2", headers={"Authorization": f"Bearer {TOKEN}"})
+            latencies.append(time.perf_counter() - arrival)
+            assert response.status_code == 200, response.text
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(started + i / rate) for i in range(requests)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "throughput_rps": requests / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=400, help="Offered load in requests per second.")
+    parser.add_argument("--rtt-ms", type=float, default=2.0, help="Simulated Redis round trip.")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    # Seed the fake Redis so every request is served from the cache.
+    server = fakeredis.FakeServer()
+    fakeredis.FakeRedis(server=server).hset(auth.USERS_CACHE_REGION, TOKEN, CACHED_USER)
+
+    rtt = args.rtt_ms / 1000
+    for name, client_cache in (("blocking", BlockingFakeRedis(server, rtt)), ("async", AsyncFakeRedis(server, rtt))):
+        with patch("auth.cache_instance", client_cache), \
+             patch("auth.users_local_cache", LocalCache("users", maxsize=0, ttl=0)), \
+             patch("api.service.create_addition_task", new_callable=AsyncMock) as create_task:
+            create_task.return_value = TaskResponseBase(task_id="bench")
+            stats = asyncio.run(run(args.requests, args.rate))
+        print(f"{name:>8}: {stats['throughput_rps']:8.1f} req/s  "
+              f"p50 {stats['p50_ms']:7.2f} ms  p99 {stats['p99_ms']:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""Batch polling with `POST /poll` vs. one `GET /poll/{task_id}` per task.
+
+Drives the ASGI app in-process against a local fake Redis result backend that adds a
+fixed round trip latency to every pipeline the API sends it. Both endpoints read through the
+async client of `results`, on which the round trips of either are counted.
+
+Usage:
+    PYTHONPATH=api/ python api/benchmarks/bench_batch_poll.py --tasks 200 --concurrency 20
+"""
+import argparse
+import asyncio
+import logging
+import time
+from unittest.mock import patch
+
+import fakeredis
+import httpx
+
+from api import app
+from celery_app import instance as celery_instance
+
+
+class LatentAsyncRedis:
+    """Async fake Redis, as used by `results`, with a simulated round trip per pipeline."""
+
+    def __init__(self, server: fakeredis.FakeServer, rtt: float):
+        self._client = fakeredis.FakeAsyncRedis(server=server)
+        self.rtt = rtt
+        self.round_trips = 0
+
+    def pipeline(self, transaction: bool = True):
+        return LatentPipeline(self, self._client.pipeline(transaction=transaction))
+
+
+class LatentPipeline:
+    def __init__(self, client: LatentAsyncRedis, pipeline):
+        self._client = client
+        self._pipeline = pipeline
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._pipeline.reset()
+
+    def __getattr__(self, name):
+        return getattr(self._pipeline, name)
+
+    async def execute(self):
+        await asyncio.sleep(self._client.rtt)
+        self._client.round_trips += 1
+        return await self._pipeline.execute()
+
+
+async def poll_individually(client: httpx.AsyncClient, task_ids: list[str], concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(task_id: str):
+        async with semaphore:
+            response = await client.get(f"/poll/{task_id}")
+            assert response.status_code == 200, response.text
+
+    await asyncio.gather(*(one(task_id) for task_id in task_ids))
+
+
+async def poll_batch(client: httpx.AsyncClient, task_ids: list[str], _: int):
+    response = await client.post("/poll", json=task_ids)
+    assert response.status_code == 200, response.text
+
+
+async def run(poll, task_ids: list[str], concurrency: int, rounds: int) -> float:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            await poll(client, task_ids, concurrency)
+        return (time.perf_counter() - started) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20, help="Concurrent individual polls.")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--rtt-ms", type=float, default=1.0, help="Simulated Redis round trip.")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    server = fakeredis.FakeServer()
+    redis_client = LatentAsyncRedis(server, args.rtt_ms / 1000)
+
+    backend = celery_instance.backend
+    task_ids = [f"task-{i}" for i in range(args.tasks)]
+    with patch.object(type(backend), "client", fakeredis.FakeRedis(server=server)), \
+         patch("results.instance", redis_client):
+        for i, task_id in enumerate(task_ids):
+            # Half of the tasks are done
+            if i % 2:
+                backend.store_result(task_id, i, "SUCCESS")
+
+        for name, poll in (("individual", poll_individually), ("batch", poll_batch)):
+            redis_client.round_trips = 0
+            elapsed = asyncio.run(run(poll, task_ids, args.concurrency, args.rounds))
+            print(f"{name:>10}: {elapsed * 1000:8.2f} ms per {args.tasks} tasks, "
+                  f"{redis_client.round_trips / args.rounds:6.0f} Redis round trips")
+
+if __name__ == "__main__":
+    main()
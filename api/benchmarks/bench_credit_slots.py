@@ -0,0 +1,212 @@
+"""Throughput of `/task` for a single user at high concurrency, with and without credit slots.
+
+Drives `/task` through the ASGI app in-process, always as the same user, against a stand-in
+database session that models the row locks taken by debits. Every statement costs one network
+round trip, every commit additionally holds a shared WAL lock for the duration of a flush, and
+row locks are held until the commit:
+
+* In the `database` billing mode, every debit waits for the lock on the user's `users` row.
+* In the `sharded` billing mode, a debit takes the first slot not locked by another debit,
+  starting from a random one. If all slots are locked, it waits for the one it started from.
+
+Every slot covers every debit, so the fallback of `credit_slots._debit_across_slots` is never
+taken.
+
+The stand-in runs none of the actual SQL, and its lock model leaves out whatever it does not
+spell out above, e.g. the key share lock every history insert takes on the `users` row through
+its foreign key, MVCC and the actual cost of a commit. Its numbers show how the debits of each
+mode line up behind locks, not how fast they are. With `--database`, the Postgres at
+`ASYNC_DATABASE_URL`, migrated to head, is used instead, and only numbers of such runs say
+anything about throughput.
+
+Publishing is replaced by a no-op. Once debits no longer wait for each other, throughput is
+bounded by the request handling of the single process running the benchmark.
+
+Usage:
+    PYTHONPATH=api/ python api/benchmarks/bench_credit_slots.py --requests 5000 --concurrency 64 --slots 1 4 16 64
+    PYTHONPATH=api/ python api/benchmarks/bench_credit_slots.py --database --slots 1 4 16 64
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import time
+from contextlib import ExitStack
+from unittest.mock import patch, AsyncMock
+
+# Configure the Celery app without a broker to connect to, before it is imported
+os.environ.setdefault("CELERY_BROKER_URL", "memory://localhost//")
+os.environ.setdefault("CELERY_CONFIRM_PUBLISH", "false")
+
+import httpx
+from sqlalchemy.dialects.postgresql import insert
+
+import auth
+import credit_slots
+from api import app
+from database.engine import async_session
+from database.models import User
+
+USER = User(name="bench", api_key="bench", credits=10 ** 9)
+
+
+class FakeResult:
+    def __init__(self, value):
+        self._value = value
+
+    def scalar_one_or_none(self):
+        return self._value
+
+
+class FakeDatabase:
+    """Stand-in for Postgres that charges latency for statements and commits and locks rows."""
+
+    def __init__(self, rtt: float, flush: float, slots: int):
+        self.rtt = rtt
+        self.flush = flush
+        self.user_row = asyncio.Lock()
+        self.slot_rows = [asyncio.Lock() for _ in range(slots)]
+        self.waits = 0
+        self._wal = asyncio.Lock()
+
+    def session(self):
+        return FakeSession(self)
+
+
+class FakeSession:
+    def __init__(self, database: FakeDatabase):
+        self._database = database
+        self._held: list[asyncio.Lock] = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._release()
+        return False
+
+    async def execute(self, statement):
+        await asyncio.sleep(self._database.rtt)
+        kind, start, skip_locked = statement
+        if kind == "user":
+            await self._lock(self._database.user_row)
+            return FakeResult(10 ** 9)
+
+        slot_rows = self._database.slot_rows
+        if not skip_locked:
+            self._database.waits += 1
+            await self._lock(slot_rows[start % len(slot_rows)])
+            return FakeResult(10 ** 9)
+
+        # FOR UPDATE SKIP LOCKED: the first slot from `start` on that nobody else holds
+        for offset in range(len(slot_rows)):
+            row = slot_rows[(start + offset) % len(slot_rows)]
+            if not row.locked():
+                await self._lock(row)
+                return FakeResult(10 ** 9)
+        return FakeResult(None)
+
+    async def commit(self):
+        await asyncio.sleep(self._database.rtt)
+        async with self._database._wal:
+            await asyncio.sleep(self._database.flush)
+        self._release()
+
+    async def _lock(self, row: asyncio.Lock):
+        await row.acquire()
+        self._held.append(row)
+
+    def _release(self):
+        for row in self._held:
+            row.release()
+        self._held.clear()
+
+
+async def seed_database(slots: int | None):
+    """Create the benchmark user, and spread their balance over `slots` or fold it into `users.credits`."""
+    async with async_session() as session:
+        await session.execute(
+            insert(User).values(name=USER.name, api_key=USER.api_key, credits=USER.credits).on_conflict_do_nothing()
+        )
+        await session.commit()
+    await credit_slots.rebalance_user(USER.name, slots or 0)
+
+
+async def run(slots: int | None, requests: int, concurrency: int, rtt: float, flush: float,
+              use_database: bool = False) -> dict:
+    database = FakeDatabase(rtt, flush, slots or 1)
+    slot_debit_statement = credit_slots.slot_debit_statement
+
+    def counting_slot_debit_statement(*args, skip_locked=True):
+        if not skip_locked:
+            database.waits += 1
+        return slot_debit_statement(*args, skip_locked=skip_locked)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def one(client: httpx.AsyncClient, i: int):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post(f"/task?x={i}&y=1")
+            latencies.append(time.perf_counter() - start)
+        if response.status_code != 200:
+            errors += 1
+
+    with ExitStack() as stack:
+        stack.enter_context(patch("service.BILLING_MODE", "database" if slots is None else "sharded"))
+        stack.enter_context(patch("service.TASK_BATCH_WINDOW", 0))
+        stack.enter_context(patch("service.publisher.send_task", new_callable=AsyncMock))
+        stack.enter_context(patch("credit_slots.CREDIT_SLOTS", slots or 1))
+        if use_database:
+            await seed_database(slots)
+            stack.enter_context(patch("credit_slots.slot_debit_statement", counting_slot_debit_statement))
+        else:
+            stack.enter_context(patch("service.async_session", database.session))
+            stack.enter_context(patch("service.debit_statement", lambda *args: ("user", None, False)))
+            stack.enter_context(patch("credit_slots.async_session", database.session))
+            stack.enter_context(patch("credit_slots.slot_debit_statement", lambda *args, skip_locked=True: ("slot", args[3], skip_locked)))
+        stack.enter_context(patch.dict(app.dependency_overrides, {auth.get_current_user: lambda: USER}))
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(one(client, i) for i in range(requests)))
+            elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests_per_s": requests / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "waits": database.waits,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64, help="Requests in flight at any time.")
+    parser.add_argument("--slots", type=int, nargs="+", default=[1, 4, 16, 64], help="Slot counts of the sharded mode.")
+    parser.add_argument("--rtt-ms", type=float, default=1.0, help="Simulated round trip per statement.")
+    parser.add_argument("--flush-ms", type=float, default=0.5, help="Simulated WAL flush per commit.")
+    parser.add_argument("--database", action="store_true", help="Use the Postgres at ASYNC_DATABASE_URL.")
+    args = parser.parse_args()
+
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    print("database: " + ("postgres" if args.database else f"stand-in, {args.rtt_ms} ms round trip, {args.flush_ms} ms flush"))
+    print(f"{'mode':>12} {'req/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'waits':>10} {'errors':>7}")
+    for slots in [None, *args.slots]:
+        stats = asyncio.run(run(slots, args.requests, args.concurrency, args.rtt_ms / 1000, args.flush_ms / 1000,
+                                args.database))
+        mode = "database" if slots is None else f"{slots} slots"
+        print(f"{mode:>12} {stats['requests_per_s']:>10.1f} {stats['p50_ms']:>8.2f} {stats['p99_ms']:>8.2f} "
+              f"{stats['waits']:>10} {stats['errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Latency of small users while a large user floods the workers, with and without queue shards.
+
+Simulates a pool of worker processes with a prefetch of one. A large user submits a burst of
+tasks at once while many small users keep submitting one task at a time. With a single queue,
+tasks are served in order of arrival. With shards, users are routed by `routing.queue_for` and
+free workers take the next message from each non-empty queue in turn, the way RabbitMQ serves
+consumers of several queues.
+
+Every shard count runs twice, without and with the bulk queue. Without it, the small users
+hashed onto the flooder's shard wait behind the whole flood, which shows in the small users'
+p99 until the shards outnumber the users enough for none of them to share the flooder's shard.
+
+Usage:
+    PYTHONPATH=api/ python api/benchmarks/bench_fair_scheduling.py --flood 5000 --shards 1 8 32
+"""
+import argparse
+import heapq
+import itertools
+import random
+import statistics
+from collections import defaultdict
+from unittest.mock import patch
+
+import routing
+from celery_app import TASK_BULK_QUEUE
+
+FLOODER = "flooder"
+
+
+def simulate(tasks: list[tuple[float, str]], shards: int, workers: int, service_time: float,
+             bulk_threshold: int = 0, bulk_window: float = 60.0) -> dict[str, list[float]]:
+    """Run tasks to completion and return the latency of every task per user."""
+    with patch("routing.TASK_QUEUE_SHARDS", shards), patch("routing.TASK_BULK_THRESHOLD", bulk_threshold):
+        names = sorted({routing.queue_for(user_name) for _, user_name in tasks}) if shards > 1 else ["celery"]
+        if shards > 1 and bulk_threshold > 0:
+            names.append(TASK_BULK_QUEUE)
+        queues = {name: [] for name in names}
+        # Tasks per user within the current window, counted like `routing.count_recent` does
+        recent = {}
+        order = itertools.count()
+        latencies = defaultdict(list)
+        pending = sorted(tasks)
+        free_at = [0.0] * workers
+        turn = 0
+        arrived = 0
+
+        while arrived < len(pending) or any(queues.values()):
+            worker_free = heapq.heappop(free_at)
+            # Enqueue everything submitted until the worker is free, or until the next submission
+            # if there is nothing to do yet
+            now = worker_free
+            if not any(queues.values()):
+                now = max(now, pending[arrived][0])
+            while arrived < len(pending) and pending[arrived][0] <= now:
+                submitted, user_name = pending[arrived]
+                window_end, count = recent.get(user_name, (0.0, 0))
+                if submitted >= window_end:
+                    window_end, count = submitted + bulk_window, 0
+                recent[user_name] = (window_end, count + 1)
+                name = routing.queue_for(user_name, count + 1) if shards > 1 else "celery"
+                heapq.heappush(queues[name], (submitted, next(order), user_name))
+                arrived += 1
+
+            for offset in range(len(names)):
+                name = names[(turn + offset) % len(names)]
+                if queues[name]:
+                    turn = (turn + offset + 1) % len(names)
+                    submitted, _, user_name = heapq.heappop(queues[name])
+                    latencies[user_name].append(now + service_time - submitted)
+                    break
+            heapq.heappush(free_at, now + service_time)
+
+    return latencies
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    samples = sorted(samples)
+    return samples[max(0, int(len(samples) * fraction) - 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--flood", type=int, default=5000, help="Tasks submitted at once by the large user.")
+    parser.add_argument("--users", type=int, default=50, help="Small users.")
+    parser.add_argument("--interval", type=float, default=10.0, help="Mean seconds between two tasks of a small user.")
+    parser.add_argument("--duration", type=float, default=600.0, help="Seconds during which small users submit.")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--service-time", type=float, default=1.0, help="Seconds a worker spends on a task.")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--bulk-threshold", type=int, default=100, help="Tasks per window before the bulk queue.")
+    parser.add_argument("--bulk-window", type=float, default=60.0, help="Seconds tasks are counted over.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    tasks = [(0.0, FLOODER)] * args.flood
+    for user in range(args.users):
+        submitted = rng.expovariate(1 / args.interval)
+        while submitted < args.duration:
+            tasks.append((submitted, f"user-{user}"))
+            submitted += rng.expovariate(1 / args.interval)
+
+    print(f"{'shards':>6} {'bulk':>5} {'small p50 s':>12} {'small p99 s':>12} {'flood p50 s':>12} {'max s':>11}")
+    for shards in args.shards:
+        for bulk_threshold in ([0, args.bulk_threshold] if shards > 1 else [0]):
+            latencies = simulate(tasks, shards, args.workers, args.service_time, bulk_threshold, args.bulk_window)
+            small = [latency for user_name, samples in latencies.items() if user_name != FLOODER for latency in samples]
+            flood = latencies[FLOODER]
+            print(f"{shards:>6} {'yes' if bulk_threshold else 'no':>5} {statistics.median(small):>12.1f} "
+                  f"{percentile(small, 0.99):>12.1f} {statistics.median(flood):>12.1f} {max(flood + small):>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
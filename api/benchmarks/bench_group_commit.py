@@ -0,0 +1,112 @@
+"""Commits per second and debit latency of the group commit batcher.
+
+Runs `service.debit_credits` from many concurrent callers against a stand-in database
+session. Every statement costs one network round trip and every commit additionally
+holds a shared WAL lock for the duration of a flush, so commits are serialised the way
+they are on a single Postgres primary.
+
+Usage:
+    PYTHONPATH=api/ python api/benchmarks/bench_group_commit.py --debits 5000 --concurrency 256
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from unittest.mock import patch
+
+import service
+
+USER = "bench"
+
+
+class FakeResult:
+    def all(self):
+        return [(USER, 10 ** 9)]
+
+    def scalar_one_or_none(self):
+        return 10 ** 9
+
+
+class FakeDatabase:
+    """Stand-in for Postgres that charges latency for statements and commits."""
+
+    def __init__(self, rtt: float, flush: float):
+        self.rtt = rtt
+        self.flush = flush
+        self.commits = 0
+        self._wal = asyncio.Lock()
+
+    def session(self):
+        return FakeSession(self)
+
+
+class FakeSession:
+    def __init__(self, database: FakeDatabase):
+        self._database = database
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, statement):
+        await asyncio.sleep(self._database.rtt)
+        return FakeResult()
+
+    async def commit(self):
+        await asyncio.sleep(self._database.rtt)
+        async with self._database._wal:
+            await asyncio.sleep(self._database.flush)
+        self._database.commits += 1
+
+
+async def run(batch_size: int, window: float, debits: int, concurrency: int, rtt: float, flush: float) -> dict:
+    database = FakeDatabase(rtt, flush)
+    batcher = service.DebitBatcher(window, batch_size)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await service.debit_credits(USER, [f"task-{i}"], service.API_COST)
+            latencies.append(time.perf_counter() - start)
+
+    with patch("service.async_session", database.session), \
+         patch("service.BILLING_MODE", "database"), \
+         patch("service.TASK_BATCH_WINDOW", window if batch_size > 1 else 0), \
+         patch("service.debit_batcher", batcher):
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(debits)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "commits_per_s": database.commits / elapsed,
+        "debits_per_s": debits / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--debits", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--window-ms", type=float, default=2.0)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--rtt-ms", type=float, default=0.5, help="Simulated round trip per statement.")
+    parser.add_argument("--flush-ms", type=float, default=2.0, help="Simulated WAL flush per commit.")
+    args = parser.parse_args()
+
+    print(f"{'batch':>6} {'commits/s':>10} {'debits/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for batch_size in args.batch_sizes:
+        stats = asyncio.run(run(batch_size, args.window_ms / 1000, args.debits, args.concurrency,
+                                args.rtt_ms / 1000, args.flush_ms / 1000))
+        print(f"{batch_size:>6} {stats['commits_per_s']:>10.1f} {stats['debits_per_s']:>10.1f} "
+              f"{stats['p50_ms']:>8.2f} {stats['p99_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,143 @@
-import redis
+import hashlib
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator
 
-instance = redis.Redis(host="redis", port=6379)
+from prometheus_client import Counter
+from redis import asyncio as aioredis
+
+REDIS_URL = os.getenv("REDIS_URL", f"redis://{os.getenv('REDIS_HOST', 'redis')}:6379/0")
+"""Redis URL used by the API cache."""
+
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+"""Upper bound of connections kept in the cache connection pool."""
+
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "1.0"))
+"""Seconds to wait on a single Redis command before giving up."""
+
+pool = aioredis.BlockingConnectionPool.from_url(
+    REDIS_URL,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+    timeout=REDIS_SOCKET_TIMEOUT,
+)
+"""Connection pool shared by every cache user in the process.
+
+A blocking pool makes coroutines wait for a free connection instead of opening
+an unbounded number of sockets under load.
+"""
+
+instance = aioredis.Redis(connection_pool=pool)
+"""Async Redis client.
+
+All commands must be awaited so that cache round trips never block the event loop.
+"""
+
+
+LOCAL_CACHE_HITS = Counter("local_cache_hits_total", "In-process cache hits.", ["cache"])
+LOCAL_CACHE_MISSES = Counter("local_cache_misses_total", "In-process cache misses.", ["cache"])
+LOCAL_CACHE_EVICTIONS = Counter("local_cache_evictions_total", "In-process cache LRU evictions.", ["cache"])
+
+
+async def close():
+    """Release the client and disconnect all pooled connections."""
+    await instance.aclose()
+    await pool.disconnect()
+
+
+async def listen(pubsub: aioredis.client.PubSub, poll_interval: float = 1.0) -> AsyncIterator[dict]:
+    """Yield the messages of a subscription until its connection is lost.
+
+    Unlike `PubSub.listen`, reads are bounded by `poll_interval` rather than by the socket
+    timeout of the pool, so a subscription that stays idle longer than that timeout lives on.
+
+    Raises:
+        ConnectionError: If the connection to Redis is lost.
+    """
+    while True:
+        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=poll_interval)
+        if message is not None:
+            yield message
+
+
+class LocalCache:
+    """Bounded, per-process cache with a TTL per entry and LRU eviction.
+
+    Used as an L1 in front of Redis for values that rarely change. Lookups never leave
+    the process, so stale entries must be dropped explicitly through `invalidate`, or
+    they expire after `ttl` seconds at the latest.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: float):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Any | None:
+        """Return the cached value, or `None` if it is missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None:
+            LOCAL_CACHE_MISSES.labels(cache=self.name).inc()
+            return None
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            LOCAL_CACHE_MISSES.labels(cache=self.name).inc()
+            return None
+
+        self._entries.move_to_end(key)
+        LOCAL_CACHE_HITS.labels(cache=self.name).inc()
+        return value
+
+    def set(self, key: str, value: Any):
+        """Store a value, evicting the least recently used entry when full."""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            LOCAL_CACHE_EVICTIONS.labels(cache=self.name).inc()
+
+    def invalidate(self, key: str):
+        """Drop a single entry."""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every entry."""
+        self._entries.clear()
+
+
+class BloomFilter:
+    """Compact, per-process set membership test without false negatives.
+
+    Answers whether a key may have been added, or was certainly not, with a false positive
+    rate close to the one it was sized for as long as no more keys than expected are added.
+    Keys can not be removed, so filters are rebuilt rather than updated when keys go away.
+    """
+
+    def __init__(self, capacity: int, false_positive_rate: float):
+        capacity = max(1, capacity)
+        self.size = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # Double hashing, positions derived from two halves of a single digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        """Add a key."""
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
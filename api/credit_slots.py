@@ -0,0 +1,304 @@
+"""Credit balances split across slot rows.
+
+In the `database` billing mode every debit of a user updates their `users` row, so concurrent
+submissions of one user queue up on its row lock. In the `sharded` billing mode, a user's
+balance is `users.credits` plus the credits of up to `CREDIT_SLOTS` rows in
+`user_credit_slots`, and a debit updates a single slot instead:
+
+* The slot is picked from a random starting point, skipping slots other debits hold locked
+  (`FOR UPDATE SKIP LOCKED`), so concurrent debits of one user rarely wait for each other.
+* If every slot covering the debit is locked, the debit waits for the next one to be free.
+* Only if no slot covers the debit on its own, the `users` row and all the user's slots are
+  locked and the debit is taken from several of them.
+
+Top-ups and refunds go to `users.credits`. A background rebalancer spreads balances evenly
+over the slots. Every API process runs it, and a transaction-level advisory lock makes sure
+only one of them does so at a time.
+
+Before switching to another billing mode, balances must be folded back into `users.credits`
+with `fold`, e.g. `PYTHONPATH=api/ python -c "import asyncio, credit_slots; asyncio.run(credit_slots.fold())"`,
+once no API process runs in the `sharded` mode anymore.
+"""
+import asyncio
+import logging
+import os
+import random
+
+from prometheus_client import Counter
+from sqlalchemy import select, update, delete, func, literal, values, column, or_, true, text, String, Select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database.engine import async_session
+from database.models import User, UserCreditSlot, UserTaskHistory
+
+_logger = logging.getLogger(__name__)
+
+CREDIT_SLOTS = int(os.getenv("CREDIT_SLOTS", "16"))
+"""Number of slots every balance is spread over in the `sharded` billing mode."""
+
+CREDIT_REBALANCE_INTERVAL = float(os.getenv("CREDIT_REBALANCE_INTERVAL", "5"))
+"""Seconds between two rebalancing runs."""
+
+CREDIT_REBALANCE_SKEW = int(os.getenv("CREDIT_REBALANCE_SKEW", "100"))
+"""Difference between a user's fullest and emptiest slot beyond which they are rebalanced."""
+
+CREDIT_REBALANCE_BATCH_SIZE = int(os.getenv("CREDIT_REBALANCE_BATCH_SIZE", "100"))
+"""Maximum number of users rebalanced per run."""
+
+CREDIT_REBALANCE_LOCK = 0x736c6f74
+"""Advisory lock key serialising rebalancing runs across processes."""
+
+SLOT_DEBIT_FALLBACKS = Counter("credit_slot_debit_fallbacks_total", "Debits no single slot could cover.")
+
+
+def slot_debit_statement(user_name: str, task_ids: list[str], cost: int, start: int,
+                         skip_locked: bool = True) -> Select:
+    """Build the debit of tasks from a single slot of a user.
+
+    Like `service.debit_statement`, one statement debits the slot, records the tasks in the
+    user's history and returns the new balance, as of the start of the statement.
+
+    Args:
+        user_name (str): User to debit.
+        task_ids (list[str]): Task IDs to record in the user's history.
+        cost (int): Credits to debit per task.
+        start (int): Slot to try first. The following slots are tried in turn.
+        skip_locked (bool): Whether to skip slots locked by other transactions rather than wait for them.
+
+    Returns:
+        Select: Statement yielding the new balance, or no row if no (unlocked) slot covers the debit.
+    """
+    total = cost * len(task_ids)
+    candidate = (
+        select(UserCreditSlot.slot)
+        .where(UserCreditSlot.user_name == user_name, UserCreditSlot.credits >= total)
+        .order_by((UserCreditSlot.slot - start + CREDIT_SLOTS) % CREDIT_SLOTS)
+        .limit(1)
+        .with_for_update(skip_locked=skip_locked)
+        .scalar_subquery()
+    )
+    debited = (
+        update(UserCreditSlot)
+        .where(UserCreditSlot.user_name == user_name, UserCreditSlot.slot == candidate)
+        .values(credits=UserCreditSlot.credits - total)
+        .returning(UserCreditSlot.user_name)
+        .cte("debited")
+    )
+    tasks = values(column("task_id", String), name="tasks").data([(task_id,) for task_id in task_ids])
+    history = (
+        insert(UserTaskHistory)
+        .from_select(
+            ["user_name", "task_id", "cost", "created_at"],
+            select(debited.c.user_name, tasks.c.task_id, literal(cost), func.now()).join_from(debited, tasks, true()),
+        )
+        .returning(UserTaskHistory.task_id)
+        .cte("history")
+    )
+    return select(balance_statement(user_name).scalar_subquery() - total).select_from(debited).add_cte(history)
+
+
+def balance_statement(user_name: str) -> Select:
+    """Build the read of a user's balance, i.e. `users.credits` plus all their slots."""
+    slots = select(func.coalesce(func.sum(UserCreditSlot.credits), 0)).where(UserCreditSlot.user_name == user_name)
+    return select(User.credits + slots.scalar_subquery()).where(User.name == user_name)
+
+
+async def _debit_across_slots(session: AsyncSession, user_name: str, task_ids: list[str], cost: int) -> int | None:
+    # Lock the users row before the slots, like the rebalancer, so that neither waits on the other forever.
+    # FOR NO KEY UPDATE leaves the row to the key share locks slot debits take through their history rows
+    home = (await session.execute(
+        select(User.credits).where(User.name == user_name).with_for_update(key_share=True)
+    )).scalar_one_or_none()
+    if home is None:
+        return None
+    slots = (await session.execute(
+        select(UserCreditSlot.slot, UserCreditSlot.credits)
+        .where(UserCreditSlot.user_name == user_name)
+        .order_by(UserCreditSlot.slot)
+        .with_for_update()
+    )).all()
+
+    balance = home + sum(credits for _, credits in slots)
+    total = cost * len(task_ids)
+    if balance < total:
+        return None
+
+    remaining = total
+    taken = min(home, remaining)
+    remaining -= taken
+    if taken:
+        await session.execute(update(User).where(User.name == user_name).values(credits=User.credits - taken))
+    for slot, credits in sorted(slots, key=lambda entry: entry[1], reverse=True):
+        if not remaining:
+            break
+        taken = min(credits, remaining)
+        remaining -= taken
+        await session.execute(
+            update(UserCreditSlot)
+            .where(UserCreditSlot.user_name == user_name, UserCreditSlot.slot == slot)
+            .values(credits=UserCreditSlot.credits - taken)
+        )
+
+    await session.execute(insert(UserTaskHistory).values([
+        {"user_name": user_name, "task_id": task_id, "cost": cost, "created_at": func.now()} for task_id in task_ids
+    ]))
+    return balance - total
+
+
+async def debit(user_name: str, task_ids: list[str], cost: int) -> int | None:
+    """Debit a user for tasks from their slots and record them in their history.
+
+    Either all tasks are debited or none.
+
+    Args:
+        user_name (str): User to debit.
+        task_ids (list[str]): Task IDs to record in the user's history.
+        cost (int): Credits to debit per task.
+
+    Returns:
+        int | None: The new balance, or `None` if the user cannot afford the tasks.
+    """
+    start = random.randrange(CREDIT_SLOTS)
+    async with async_session() as session:
+        result = await session.execute(slot_debit_statement(user_name, task_ids, cost, start))
+        credits = result.scalar_one_or_none()
+
+        if credits is None:
+            # Every slot covering the debit may just be busy with other debits
+            result = await session.execute(slot_debit_statement(user_name, task_ids, cost, start, skip_locked=False))
+            credits = result.scalar_one_or_none()
+
+        if credits is None:
+            SLOT_DEBIT_FALLBACKS.inc()
+            credits = await _debit_across_slots(session, user_name, task_ids, cost)
+
+        if credits is not None:
+            await session.commit()
+
+        return credits
+
+
+async def get_credits(user_name: str) -> int | None:
+    """Read a user's balance, `None` if the user does not exist."""
+    async with async_session() as session:
+        result = await session.execute(balance_statement(user_name))
+        return result.scalar_one_or_none()
+
+
+def rebalance_candidates_statement(slots: int) -> Select:
+    """Build the selection of the users whose balance is due to be rebalanced.
+
+    Args:
+        slots (int): Slots balances are spread over, `0` to fold them into `users.credits`.
+    """
+    spread = (
+        select(
+            UserCreditSlot.user_name,
+            func.count().label("slots"),
+            (func.max(UserCreditSlot.credits) - func.min(UserCreditSlot.credits)).label("skew"),
+        )
+        .group_by(UserCreditSlot.user_name)
+        .subquery()
+    )
+    if slots == 0:
+        return select(spread.c.user_name).limit(CREDIT_REBALANCE_BATCH_SIZE)
+
+    return (
+        select(User.name)
+        .outerjoin(spread, spread.c.user_name == User.name)
+        .where(or_(
+            User.credits > 0,
+            func.coalesce(spread.c.slots, 0) != slots,
+            spread.c.skew > CREDIT_REBALANCE_SKEW,
+        ))
+        .limit(CREDIT_REBALANCE_BATCH_SIZE)
+    )
+
+
+async def rebalance_user(user_name: str, slots: int):
+    """Spread a user's balance evenly over their slots, or fold them back into `users.credits`.
+
+    Args:
+        user_name (str): User to rebalance.
+        slots (int): Slots to spread the balance over, `0` to fold them into `users.credits`.
+    """
+    async with async_session() as session:
+        home = (await session.execute(
+            select(User.credits).where(User.name == user_name).with_for_update(key_share=True)
+        )).scalar_one_or_none()
+        if home is None:
+            return
+        held = (await session.execute(
+            select(UserCreditSlot.credits).where(UserCreditSlot.user_name == user_name).with_for_update()
+        )).scalars().all()
+        balance = home + sum(held)
+
+        if slots == 0:
+            await session.execute(update(User).where(User.name == user_name).values(credits=balance))
+            await session.execute(delete(UserCreditSlot).where(UserCreditSlot.user_name == user_name))
+        else:
+            share, remainder = divmod(balance, slots)
+            await session.execute(update(User).where(User.name == user_name).values(credits=0))
+            upsert = insert(UserCreditSlot).values([
+                {"user_name": user_name, "slot": slot, "credits": share + (remainder if slot == 0 else 0)}
+                for slot in range(slots)
+            ])
+            await session.execute(upsert.on_conflict_do_update(
+                index_elements=[UserCreditSlot.user_name, UserCreditSlot.slot],
+                set_={"credits": upsert.excluded.credits},
+            ))
+            await session.execute(
+                delete(UserCreditSlot).where(UserCreditSlot.user_name == user_name, UserCreditSlot.slot >= slots)
+            )
+
+        await session.commit()
+
+
+async def rebalance(slots: int) -> int:
+    """Rebalance a batch of users due for it, unless another process is rebalancing already.
+
+    Args:
+        slots (int): Slots balances are spread over, `0` to fold them into `users.credits`.
+
+    Returns:
+        int: Number of users rebalanced.
+    """
+    async with async_session() as session:
+        # Held until the batch is done, while every user is rebalanced in a transaction of its own
+        locked = await session.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": CREDIT_REBALANCE_LOCK})
+        if not locked.scalar_one():
+            return 0
+
+        user_names = (await session.execute(rebalance_candidates_statement(slots))).scalars().all()
+        for user_name in user_names:
+            await rebalance_user(user_name, slots)
+
+    return len(user_names)
+
+
+async def fold():
+    """Fold the slots of every user back into `users.credits`, to leave the `sharded` billing mode."""
+    while await rebalance(0):
+        pass
+
+
+async def run_rebalancer(slots: int, retry_interval: float = 5.0):
+    """Rebalance credit slots for the lifetime of the application.
+
+    Args:
+        slots (int): Slots balances are spread over, `0` to fold them into `users.credits`.
+    """
+    while True:
+        try:
+            rebalanced = await rebalance(slots)
+            if rebalanced:
+                _logger.debug(f"Rebalanced the credit slots of {rebalanced} users")
+            # Go on right away while there is a backlog of users to rebalance
+            if rebalanced < CREDIT_REBALANCE_BATCH_SIZE:
+                await asyncio.sleep(CREDIT_REBALANCE_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            _logger.exception("Rebalancing credit slots failed, retrying")
+            await asyncio.sleep(retry_interval)
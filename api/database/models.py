@@ -1,6 +1,6 @@
 import datetime
 
-from sqlalchemy import Column, String, Integer, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, DateTime, ForeignKey, Index, CheckConstraint
 from sqlalchemy.orm import declarative_base, relationship
 from sqlalchemy.sql import func
 Base = declarative_base()
@@ -13,8 +13,8 @@ class User(Base):
     name = Column(String(255), primary_key=True, nullable=False)
     """Username."""
 
-    api_key = Column(String(36), nullable=False)
-    """API key."""
+    api_key = Column(String(36), nullable=False, unique=True, index=True)
+    """API key, unique and indexed since every request looks users up by it."""
 
     credits = Column(Integer, nullable=False)
     """User credits.
@@ -26,8 +26,16 @@ class User(Base):
 
 
 class UserTaskHistory(Base):
-    """User task history model."""
+    """User task history model.
+
+    The table is range partitioned by month of `created_at`, see `history`.
+    """
     __tablename__ = "user_task_history"
+    __table_args__ = (
+        Index("ix_user_task_history_task_id", "task_id"),
+        Index("ix_user_task_history_user_name_created_at", "user_name", "created_at"),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
 
     user_name = Column(String(255), ForeignKey("users.name"), primary_key=True, nullable=False)
     """Username of the user who performed the task."""
@@ -38,8 +46,55 @@ class UserTaskHistory(Base):
     cost = Column(Integer, nullable=False)
     """Cost of task in credits."""
 
-    created_at = Column(DateTime, nullable=False, default=func.now())
-    """Timestamp of when the task was performed."""
+    created_at = Column(DateTime, primary_key=True, nullable=False, default=func.now())
+    """Timestamp of when the task was performed.
+
+    Part of the primary key, as partitioned tables require for their partition key.
+    """
+
+    settled_at = Column(DateTime, nullable=True)
+    """Timestamp of when the charge was settled, see `settlement`. `NULL` while unsettled."""
 
     # Relations
     user = relationship("User", back_populates="task_history")
+
+
+class UserCreditSlot(Base):
+    """Slot of a user's balance, in the `sharded` billing mode.
+
+    A user's balance is `users.credits` plus the credits of all their slots, see `credit_slots`.
+    """
+    __tablename__ = "user_credit_slots"
+    __table_args__ = (
+        CheckConstraint("credits >= 0", name="ck_user_credit_slots_credits"),
+    )
+
+    user_name = Column(String(255), ForeignKey("users.name"), primary_key=True, nullable=False)
+    """Username of the user the slot belongs to."""
+
+    slot = Column(Integer, primary_key=True, nullable=False)
+    """Slot number, from `0` to `CREDIT_SLOTS - 1`."""
+
+    credits = Column(Integer, nullable=False)
+    """Credits held in the slot."""
+
+
+class LedgerRefund(Base):
+    """Refund of a task written behind from the ledger, in the `ledger` billing mode.
+
+    Refunds are remembered for a while, so that a debit of the same task written behind after
+    its refund is skipped instead of charged, see `ledger.flush`.
+    """
+    __tablename__ = "ledger_refunds"
+    __table_args__ = (
+        Index("ix_ledger_refunds_created_at", "created_at"),
+    )
+
+    user_name = Column(String(255), ForeignKey("users.name"), primary_key=True, nullable=False)
+    """Username of the user refunded."""
+
+    task_id = Column(String(255), primary_key=True, nullable=False)
+    """Task ID."""
+
+    created_at = Column(DateTime, nullable=False, default=func.now())
+    """Timestamp of when the refund was written behind."""
@@ -0,0 +1,154 @@
+"""Maintenance of the monthly partitions of the task history.
+
+`user_task_history` is range partitioned by month of `created_at`. Partitions are created a few
+months ahead, so that rows never end up in the default partition, and, with a retention period
+set, partitions that fell out of it are dropped as a whole instead of deleting rows one by one.
+If maintenance fell behind and the default partition already holds tasks of a month, they are
+moved into the partition of that month when it is created.
+
+Every API process runs the maintenance periodically. A transaction-level advisory lock makes
+sure only one of them does so at a time.
+"""
+import asyncio
+import logging
+import os
+import re
+from datetime import date, datetime, timezone
+
+from sqlalchemy import text
+
+from database.engine import async_session
+
+_logger = logging.getLogger(__name__)
+
+HISTORY_PARTITIONS_AHEAD = int(os.getenv("HISTORY_PARTITIONS_AHEAD", "3"))
+"""Months after the current one that must have a partition."""
+
+HISTORY_RETENTION_MONTHS = int(os.getenv("HISTORY_RETENTION_MONTHS", "0"))
+"""Months before the current one whose history is kept. `0` keeps the history forever."""
+
+HISTORY_MAINTENANCE_INTERVAL = float(os.getenv("HISTORY_MAINTENANCE_INTERVAL", "3600"))
+"""Seconds between two partition maintenance runs."""
+
+HISTORY_MAINTENANCE_LOCK = 0x68697374
+"""Advisory lock key serialising partition maintenance across processes."""
+
+DEFAULT_PARTITION = "user_task_history_default"
+"""Partition holding the tasks no monthly partition covers."""
+
+_PARTITION_NAME = re.compile(r"^user_task_history_(\d{4})(\d{2})$")
+
+
+def add_months(month: date, months: int) -> date:
+    """Shift the first day of a month by a number of months."""
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    """Name of the partition holding the tasks of a month."""
+    return f"user_task_history_{month:%Y%m}"
+
+
+def _month_condition(month: date) -> str:
+    return f"created_at >= '{month.isoformat()}' AND created_at < '{add_months(month, 1).isoformat()}'"
+
+
+def create_partition_statement(month: date):
+    """Create the partition of a month, unless it exists already."""
+    return text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF user_task_history "
+        f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    )
+
+
+def list_partitions_statement():
+    """List the names of every partition of the task history."""
+    return text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = 'user_task_history'::regclass"
+    )
+
+
+def default_partition_holds_statement(month: date):
+    """Check whether the default partition holds tasks of a month."""
+    return text(f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE {_month_condition(month)})")
+
+
+def split_default_partition_statements(month: date) -> list:
+    """Create the partition of a month out of the tasks the default partition holds for it.
+
+    Postgres refuses to create a partition while the default partition holds rows in its range,
+    so the default partition is detached meanwhile. Must run in a single transaction, which
+    blocks writes to the task history until it commits.
+    """
+    return [
+        text(f"ALTER TABLE user_task_history DETACH PARTITION {DEFAULT_PARTITION}"),
+        create_partition_statement(month),
+        text(
+            f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} WHERE {_month_condition(month)} RETURNING *) "
+            f"INSERT INTO {partition_name(month)} SELECT * FROM moved"
+        ),
+        text(f"ALTER TABLE user_task_history ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"),
+    ]
+
+
+async def maintain_partitions(today: date | None = None) -> list[str]:
+    """Create upcoming partitions and drop those past retention.
+
+    Args:
+        today (date | None): Reference date, today if `None`.
+
+    Returns:
+        list[str]: Names of the dropped partitions.
+    """
+    today = today or datetime.now(timezone.utc).date()
+    current = today.replace(day=1)
+
+    async with async_session() as session:
+        await session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": HISTORY_MAINTENANCE_LOCK})
+
+        result = await session.execute(list_partitions_statement())
+        partitions = result.scalars().all()
+
+        for months in range(HISTORY_PARTITIONS_AHEAD + 1):
+            month = add_months(current, months)
+            if partition_name(month) in partitions:
+                continue
+
+            result = await session.execute(default_partition_holds_statement(month))
+            if result.scalar_one():
+                _logger.warning(f"Moving tasks of {month:%Y-%m} out of the default task history partition")
+                for statement in split_default_partition_statements(month):
+                    await session.execute(statement)
+            else:
+                await session.execute(create_partition_statement(month))
+
+        dropped = []
+        if HISTORY_RETENTION_MONTHS > 0:
+            oldest_kept = add_months(current, -HISTORY_RETENTION_MONTHS)
+            for name in partitions:
+                match = _PARTITION_NAME.match(name)
+                if match and date(int(match[1]), int(match[2]), 1) < oldest_kept:
+                    await session.execute(text(f"DROP TABLE {name}"))
+                    dropped.append(name)
+
+        await session.commit()
+
+    if dropped:
+        _logger.info(f"Dropped task history partitions {dropped}")
+    return dropped
+
+
+async def run_maintenance(retry_interval: float = 60.0):
+    """Maintain the task history partitions for the lifetime of the application."""
+    while True:
+        try:
+            await maintain_partitions()
+            await asyncio.sleep(HISTORY_MAINTENANCE_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            _logger.exception("Task history partition maintenance failed, retrying")
+            await asyncio.sleep(retry_interval)
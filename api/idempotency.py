@@ -0,0 +1,117 @@
+"""Idempotent task submissions.
+
+Clients that time out on a submission cannot tell whether it went through. Retrying it with
+the same `Idempotency-Key` header is safe: a submission carrying a key first claims the key
+in Redis with an in-progress marker, in a single `SET NX`. Once the submission succeeded, its
+response replaces the marker for `IDEMPOTENCY_TTL` seconds, and retries get that response
+back without being debited or published again, and without a round trip to Postgres or the
+broker.
+
+* A retry while the first submission is still in progress is rejected with `409`.
+* A key reused for a different request is rejected with `422`.
+* A failed submission gives up its key, so that it can be retried under the same key.
+* A cancelled submission, e.g. after the client disconnected, keeps its marker until it
+  expires after `IDEMPOTENCY_LOCK_TTL` seconds: its debit may be committed and its publish may
+  still complete, so a retry must not run it again meanwhile.
+
+Keys are scoped to the user submitting.
+"""
+import hashlib
+import json
+import os
+import uuid
+from typing import Awaitable, Callable, TypeVar
+
+from fastapi import HTTPException
+from prometheus_client import Counter
+from pydantic import BaseModel
+
+from cache import instance as cache_instance
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+"""Seconds the response of a submission is replayed to retries for."""
+
+IDEMPOTENCY_LOCK_TTL = int(os.getenv("IDEMPOTENCY_LOCK_TTL", "60"))
+"""Seconds after which a submission that never finished gives up its key."""
+
+IDEMPOTENCY_KEY_PREFIX = "idempotency:"
+"""Prefix of the Redis keys holding in-progress markers and responses."""
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+"""Maximum length of an `Idempotency-Key` header."""
+
+IDEMPOTENT_REQUESTS = Counter("idempotent_requests_total", "Submissions carrying an idempotency key.", ["outcome"])
+
+Response = TypeVar("Response", bound=BaseModel)
+
+_SWAP_SCRIPT = cache_instance.register_script("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+return 1
+""")
+"""Replace or delete an in-progress marker, unless it expired and another submission claimed
+the key meanwhile. KEYS: idempotency key. ARGV: marker, response (empty to delete), TTL."""
+
+
+def fingerprint(request: list) -> str:
+    """Hash the endpoint and parameters of a submission."""
+    return hashlib.sha256(json.dumps(request, separators=(",", ":")).encode()).hexdigest()
+
+
+async def submit_once(user_name: str, key: str | None, request: list, model: type[Response],
+                      submit: Callable[[], Awaitable[Response]]) -> tuple[Response, bool]:
+    """Run a submission, unless it was run under the same idempotency key already.
+
+    Args:
+        user_name (str): User submitting.
+        key (str | None): Idempotency key sent by the client. Without one, the submission is run.
+        request (list): Endpoint and parameters of the submission, e.g. `["task", x, y]`.
+        model (type[Response]): Response model of the submission.
+        submit (Callable[[], Awaitable[Response]]): Runs the submission.
+
+    Returns:
+        tuple[Response, bool]: The response, and whether it was replayed from an earlier submission.
+
+    Raises:
+        HTTPException: `409` if the earlier submission is still in progress, `422` if the key was
+            used for a different request.
+    """
+    if key is None:
+        return await submit(), False
+
+    redis_key = f"{IDEMPOTENCY_KEY_PREFIX}{user_name}:{key}"
+    digest = fingerprint(request)
+    marker = json.dumps({"fingerprint": digest, "token": str(uuid.uuid4())})
+
+    stored = await cache_instance.set(redis_key, marker, nx=True, ex=IDEMPOTENCY_LOCK_TTL, get=True)
+    if stored is not None:
+        stored = json.loads(stored)
+        if stored["fingerprint"] != digest:
+            IDEMPOTENT_REQUESTS.labels(outcome="mismatch").inc()
+            raise HTTPException(status_code=422, detail="Idempotency key was used for a different request.")
+        if "response" not in stored:
+            IDEMPOTENT_REQUESTS.labels(outcome="in_progress").inc()
+            raise HTTPException(
+                status_code=409,
+                detail="A request with this idempotency key is in progress.",
+                headers={"Retry-After": "1"},
+            )
+        IDEMPOTENT_REQUESTS.labels(outcome="replayed").inc()
+        return model.model_validate(stored["response"]), True
+
+    try:
+        response = await submit()
+    except Exception:
+        await _SWAP_SCRIPT(keys=[redis_key], args=[marker, "", 0], client=cache_instance)
+        raise
+
+    IDEMPOTENT_REQUESTS.labels(outcome="submitted").inc()
+    stored = json.dumps({"fingerprint": digest, "response": response.model_dump(mode="json")})
+    await _SWAP_SCRIPT(keys=[redis_key], args=[marker, stored, IDEMPOTENCY_TTL], client=cache_instance)
+    return response, False
@@ -0,0 +1,362 @@
+"""Redis-resident credit ledger.
+
+In the `ledger` billing mode every user's balance lives in Redis under `credits:<user>` and
+is changed only through Lua scripts, which makes a debit a single atomic Redis round trip.
+Each debit is also appended to a Redis stream, from which a background write-behind task
+flushes `UserTaskHistory` rows and aggregated credit updates to Postgres in batches.
+
+Debits and refunds of a task may be written to Postgres in either order, since entries are
+spread over the consumers of all API processes and entries whose flush failed are retried
+later. Refunds are therefore remembered in `ledger_refunds`, and debits of refunded tasks are
+skipped.
+
+Balances are loaded lazily from Postgres the first time a user is seen. The Redis keys are
+the source of truth from then on, so Redis must not evict them (e.g. `noeviction` or a
+`volatile-*` policy).
+"""
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update, delete, func, tuple_, values, column, String, Integer, DateTime
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import instance as cache_instance
+from database.engine import async_session
+from database.models import LedgerRefund, User, UserTaskHistory
+
+_logger = logging.getLogger(__name__)
+
+LEDGER_KEY_PREFIX = "credits:"
+"""Prefix of the Redis keys holding user balances."""
+
+LEDGER_STREAM = "ledger:entries"
+"""Redis stream of ledger entries waiting to be written to Postgres."""
+
+LEDGER_GROUP = "write-behind"
+"""Consumer group shared by the write-behind tasks of all API processes."""
+
+LEDGER_FLUSH_BATCH_SIZE = int(os.getenv("LEDGER_FLUSH_BATCH_SIZE", "500"))
+"""Maximum number of ledger entries written to Postgres in one transaction."""
+
+LEDGER_FLUSH_INTERVAL = float(os.getenv("LEDGER_FLUSH_INTERVAL", "0.5"))
+"""Seconds the write-behind task waits for new entries before checking again."""
+
+LEDGER_RECLAIM_IDLE = float(os.getenv("LEDGER_RECLAIM_IDLE", "30"))
+"""Seconds after which entries read but not acknowledged by a consumer are taken over."""
+
+LEDGER_REFUND_RETENTION = float(os.getenv("LEDGER_REFUND_RETENTION", "86400"))
+"""Seconds refunds are remembered for, so that a debit written behind later is skipped.
+
+Must be well beyond the time entries may stay unflushed, e.g. while Postgres is unavailable.
+"""
+
+INSUFFICIENT_CREDITS = -1
+"""Script result when the balance does not cover the debit."""
+
+MISSING_BALANCE = -2
+"""Script result when the balance has not been loaded into Redis yet."""
+
+_DEBIT_SCRIPT = cache_instance.register_script("""
+local balance = redis.call('GET', KEYS[1])
+if not balance then
+    return -2
+end
+local cost = tonumber(ARGV[2])
+local total = cost * (#ARGV - 3)
+if tonumber(balance) < total then
+    return -1
+end
+for i = 4, #ARGV do
+    redis.call('XADD', KEYS[2], '*', 'op', 'debit', 'user', ARGV[1], 'task', ARGV[i], 'cost', ARGV[2], 'ts', ARGV[3])
+end
+return redis.call('DECRBY', KEYS[1], total)
+""")
+"""Debit `cost` per task ID and journal one stream entry per task, all or nothing.
+
+KEYS: balance key, stream. ARGV: user name, cost, timestamp, task IDs...
+"""
+
+_REFUND_SCRIPT = cache_instance.register_script("""
+if not redis.call('GET', KEYS[1]) then
+    return -2
+end
+for i = 3, #ARGV do
+    redis.call('XADD', KEYS[2], '*', 'op', 'refund', 'user', ARGV[1], 'task', ARGV[i])
+end
+return redis.call('INCRBY', KEYS[1], tonumber(ARGV[2]) * (#ARGV - 2))
+""")
+"""Give back `cost` per task ID and journal the removal of their history rows.
+
+KEYS: balance key, stream. ARGV: user name, cost, task IDs...
+"""
+
+_CREDIT_SCRIPT = cache_instance.register_script("""
+if not redis.call('GET', KEYS[1]) then
+    return -2
+end
+return redis.call('INCRBY', KEYS[1], ARGV[1])
+""")
+"""Add credits to a loaded balance. KEYS: balance key. ARGV: amount."""
+
+
+def _key(user_name: str) -> str:
+    return f"{LEDGER_KEY_PREFIX}{user_name}"
+
+
+async def _load(user_name: str) -> bool:
+    """Seed a user's Redis balance from Postgres, unless it is already there.
+
+    Returns:
+        bool: Whether the user exists.
+    """
+    async with async_session() as session:
+        result = await session.execute(select(User.credits).where(User.name == user_name))
+        credits = result.scalar_one_or_none()
+
+    if credits is None:
+        return False
+
+    await cache_instance.set(_key(user_name), credits, nx=True)
+    return True
+
+
+async def debit(user_name: str, task_ids: list[str], cost: int) -> int | None:
+    """Atomically debit `cost` credits for each task.
+
+    Args:
+        user_name (str): User to debit.
+        task_ids (list[str]): Task IDs to record in the user's history.
+        cost (int): Credits per task.
+
+    Returns:
+        int | None: The new balance, or `None` if the user is unknown or cannot afford all tasks.
+    """
+    created_at = datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
+    args = [user_name, cost, created_at, *task_ids]
+
+    balance = await _DEBIT_SCRIPT(keys=[_key(user_name), LEDGER_STREAM], args=args, client=cache_instance)
+    if balance == MISSING_BALANCE:
+        if not await _load(user_name):
+            return None
+        balance = await _DEBIT_SCRIPT(keys=[_key(user_name), LEDGER_STREAM], args=args, client=cache_instance)
+
+    return None if balance == INSUFFICIENT_CREDITS else balance
+
+
+async def refund(user_name: str, task_ids: list[str], cost: int) -> int:
+    """Revert the debit of tasks that were never published.
+
+    Returns:
+        int: The new balance.
+    """
+    return await _REFUND_SCRIPT(keys=[_key(user_name), LEDGER_STREAM], args=[user_name, cost, *task_ids], client=cache_instance)
+
+
+async def get_credits(user_name: str) -> int | None:
+    """Read a user's balance, loading it from Postgres if needed.
+
+    Returns:
+        int | None: The balance, or `None` if the user is unknown.
+    """
+    credits = await cache_instance.get(_key(user_name))
+    if credits is None:
+        if not await _load(user_name):
+            return None
+        credits = await cache_instance.get(_key(user_name))
+
+    return int(credits)
+
+
+async def credit(user_name: str, amount: int) -> int | None:
+    """Add credits to a user's balance.
+
+    Postgres is updated synchronously, after the balance is guaranteed to be loaded into
+    Redis, so that a concurrent load can never overwrite the top-up.
+
+    Returns:
+        int | None: The new balance, or `None` if the user is unknown.
+    """
+    if await cache_instance.get(_key(user_name)) is None and not await _load(user_name):
+        return None
+
+    async with async_session() as session:
+        await session.execute(update(User).where(User.name == user_name).values(credits=User.credits + amount))
+        await session.commit()
+
+    return await _CREDIT_SCRIPT(keys=[_key(user_name)], args=[amount], client=cache_instance)
+
+
+def history_debit_statement(rows: list[dict]):
+    """Insert history rows and debit their aggregated cost from each user.
+
+    Rows already present are skipped and not debited again, which makes replaying a batch safe.
+    Rows of tasks refunded already are skipped too, as their refund was written first.
+
+    Args:
+        rows (list[dict]): `UserTaskHistory` column values.
+    """
+    entries = values(
+        column("user_name", String), column("task_id", String), column("cost", Integer), column("created_at", DateTime),
+        name="entries",
+    ).data([(row["user_name"], row["task_id"], row["cost"], row["created_at"]) for row in rows])
+    refunded = select(LedgerRefund.task_id).where(
+        LedgerRefund.user_name == entries.c.user_name,
+        LedgerRefund.task_id == entries.c.task_id,
+    )
+    inserted = (
+        insert(UserTaskHistory)
+        .from_select(
+            ["user_name", "task_id", "cost", "created_at"],
+            select(entries.c.user_name, entries.c.task_id, entries.c.cost, entries.c.created_at)
+            .where(~refunded.exists()),
+        )
+        .on_conflict_do_nothing()
+        .returning(UserTaskHistory.user_name, UserTaskHistory.cost)
+        .cte("inserted")
+    )
+    totals = (
+        select(inserted.c.user_name, func.sum(inserted.c.cost).label("total"))
+        .group_by(inserted.c.user_name)
+        .cte("totals")
+    )
+    return update(User).where(User.name == totals.c.user_name).values(credits=User.credits - totals.c.total)
+
+
+def history_refund_statement(keys: list[tuple[str, str]]):
+    """Remember refunds, delete their history rows and give their aggregated cost back to each user.
+
+    Refunds already remembered are not refunded again, which makes replaying a batch safe. Tasks
+    whose debit was not written yet have no history row and are not refunded, their debit is
+    skipped once it is written instead.
+
+    Args:
+        keys (list[tuple[str, str]]): `(user_name, task_id)` pairs.
+    """
+    refunds = values(column("user_name", String), column("task_id", String), name="refunds").data(keys)
+    remembered = (
+        insert(LedgerRefund)
+        .from_select(["user_name", "task_id", "created_at"], select(refunds.c.user_name, refunds.c.task_id, func.now()))
+        .on_conflict_do_nothing()
+        .returning(LedgerRefund.user_name, LedgerRefund.task_id)
+        .cte("remembered")
+    )
+    removed = (
+        delete(UserTaskHistory)
+        .where(tuple_(UserTaskHistory.user_name, UserTaskHistory.task_id).in_(
+            select(remembered.c.user_name, remembered.c.task_id)
+        ))
+        .returning(UserTaskHistory.user_name, UserTaskHistory.cost)
+        .cte("removed")
+    )
+    totals = (
+        select(removed.c.user_name, func.sum(removed.c.cost).label("total"))
+        .group_by(removed.c.user_name)
+        .cte("totals")
+    )
+    return update(User).where(User.name == totals.c.user_name).values(credits=User.credits + totals.c.total)
+
+
+def prune_refunds_statement():
+    """Forget refunds older than `LEDGER_REFUND_RETENTION`."""
+    return delete(LedgerRefund).where(LedgerRefund.created_at < func.now() - timedelta(seconds=LEDGER_REFUND_RETENTION))
+
+
+async def flush(entries: list[tuple[bytes, dict]]):
+    """Write a batch of stream entries to Postgres in one transaction and acknowledge them."""
+    debits, refunds = [], []
+    for _, fields in entries:
+        if fields[b"op"] == b"debit":
+            debits.append(dict(
+                user_name=fields[b"user"].decode(),
+                task_id=fields[b"task"].decode(),
+                cost=int(fields[b"cost"]),
+                created_at=datetime.fromisoformat(fields[b"ts"].decode()),
+            ))
+        else:
+            refunds.append((fields[b"user"].decode(), fields[b"task"].decode()))
+
+    user_names = sorted({row["user_name"] for row in debits} | {user_name for user_name, _ in refunds})
+    async with async_session() as session:
+        # Flushes of other processes may write the debit or refund of the same task. Taking the
+        # users' rows first, in a fixed order, makes them wait for each other without deadlocks
+        await session.execute(
+            select(User.name).where(User.name.in_(user_names)).order_by(User.name).with_for_update(key_share=True)
+        )
+        # A refund in the same batch follows its debit, so apply debits first
+        if debits:
+            await session.execute(history_debit_statement(debits))
+        if refunds:
+            await session.execute(history_refund_statement(refunds))
+        await session.commit()
+
+    entry_ids = [entry_id for entry_id, _ in entries]
+    async with cache_instance.pipeline(transaction=False) as pipe:
+        pipe.xack(LEDGER_STREAM, LEDGER_GROUP, *entry_ids)
+        pipe.xdel(LEDGER_STREAM, *entry_ids)
+        await pipe.execute()
+
+    _logger.debug(f"Flushed {len(debits)} debits and {len(refunds)} refunds")
+
+
+async def reconcile(consumer: str):
+    """Take over and flush entries left unacknowledged by consumers that went away.
+
+    Runs on startup and periodically afterwards, so entries read by a crashed process are
+    written to Postgres exactly once.
+    """
+    start_id = "0-0"
+    while True:
+        response = await cache_instance.xautoclaim(
+            LEDGER_STREAM, LEDGER_GROUP, consumer,
+            min_idle_time=int(LEDGER_RECLAIM_IDLE * 1000),
+            start_id=start_id,
+            count=LEDGER_FLUSH_BATCH_SIZE,
+        )
+        # Redis 7 appends the IDs of entries deleted meanwhile, which are of no interest
+        start_id = response[0]
+        entries = [entry for entry in response[1] if entry[1] is not None]
+        if entries:
+            _logger.warning(f"Reclaimed {len(entries)} unflushed ledger entries")
+            await flush(entries)
+        if start_id in (b"0-0", "0-0"):
+            return
+
+
+async def write_behind(retry_interval: float = 1.0):
+    """Flush the ledger stream to Postgres for the lifetime of the application."""
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+
+    try:
+        await cache_instance.xgroup_create(LEDGER_STREAM, LEDGER_GROUP, id="0", mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+    last_reconciled = 0.0
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            if loop.time() - last_reconciled >= LEDGER_RECLAIM_IDLE:
+                await reconcile(consumer)
+                async with async_session() as session:
+                    await session.execute(prune_refunds_statement())
+                    await session.commit()
+                last_reconciled = loop.time()
+
+            response = await cache_instance.xreadgroup(
+                LEDGER_GROUP, consumer, {LEDGER_STREAM: ">"},
+                count=LEDGER_FLUSH_BATCH_SIZE,
+                block=int(LEDGER_FLUSH_INTERVAL * 1000),
+            )
+            for _, entries in response:
+                if entries:
+                    await flush(entries)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Entries stay pending and are reclaimed once they are idle long enough
+            _logger.exception("Ledger write-behind failed, retrying")
+            await asyncio.sleep(retry_interval)
@@ -0,0 +1,111 @@
+"""Content-addressed memoization of addition tasks.
+
+Tasks are keyed by a hash of their name and arguments. Before an addition is published, the
+result backend Redis is asked, in one atomic step, whether
+
+* its result is memoized: the result is stored under the new task ID right away,
+* an identical task is in flight: the new task ID is attached to it as a follower, or
+* neither: the new task leads and is published as usual.
+
+Once the leader has run, the worker memoizes its result and stores it under the ID of every
+follower, see `worker.settle_memo`. Memoized results expire after `TASK_MEMO_TTL` seconds and
+at most `TASK_MEMO_MAX_ENTRIES` of them are kept.
+"""
+import hashlib
+import json
+import os
+
+import results
+from celery_app import instance as celery_instance
+
+TASK_MEMO_TTL = float(os.getenv("TASK_MEMO_TTL", "0"))
+"""Seconds a memoized result is served for. `0` disables memoization."""
+
+TASK_MEMO_INFLIGHT_TTL = int(os.getenv("TASK_MEMO_INFLIGHT_TTL", "300"))
+"""Seconds after which a leader that never reported back stops collecting followers."""
+
+MEMO_KEY_PREFIX = "memo:"
+"""Prefix of the Redis keys holding memoized results, leaders and followers."""
+
+HIT = b"hit"
+"""Claim outcome of a memoized task."""
+
+FOLLOW = b"follow"
+"""Claim outcome of a task attached to an identical one in flight."""
+
+LEAD = b"lead"
+"""Claim outcome of a task that must be published."""
+
+_CLAIM_SCRIPT = results.instance.register_script("""
+local result = redis.call('GET', KEYS[1])
+if result then
+    return {'hit', result}
+end
+local leader = redis.call('GET', KEYS[2])
+if leader then
+    redis.call('RPUSH', KEYS[3], ARGV[1])
+    redis.call('EXPIRE', KEYS[3], ARGV[2])
+    return {'follow', leader}
+end
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+return {'lead'}
+""")
+"""Serve, attach or lead a task. KEYS: result, leader, followers. ARGV: task ID, in-flight TTL."""
+
+_RELEASE_SCRIPT = results.instance.register_script("""
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return {}
+end
+local followers = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2])
+return followers
+""")
+"""Step down as leader and hand back the followers. KEYS: leader, followers. ARGV: task ID."""
+
+
+def memo_key(name: str, args: list) -> str:
+    """Derive the memo key of a task.
+
+    Must stay in line with the worker, which derives the same key to settle the task.
+    """
+    digest = hashlib.sha256(json.dumps([name, args], separators=(",", ":")).encode()).hexdigest()
+    return f"{MEMO_KEY_PREFIX}{digest}"
+
+
+def _keys(key: str) -> list[str]:
+    return [f"{key}:result", f"{key}:leader", f"{key}:followers"]
+
+
+async def claim(name: str, args: list, task_id: str) -> tuple[bytes, object]:
+    """Look up a task before publishing it.
+
+    Args:
+        name (str): Registered task name, e.g. `worker.add`.
+        args (list): Positional task arguments.
+        task_id (str): ID of the new task.
+
+    Returns:
+        tuple[bytes, object]: `HIT` and the memoized result, `FOLLOW` and the leader's task ID,
+        or `LEAD` and `None`.
+    """
+    outcome, *value = await _CLAIM_SCRIPT(
+        keys=_keys(memo_key(name, args)),
+        args=[task_id, TASK_MEMO_INFLIGHT_TTL],
+        client=results.instance,
+    )
+    if outcome == HIT:
+        return HIT, celery_instance.backend.decode(value[0])
+    if outcome == FOLLOW:
+        return FOLLOW, value[0].decode()
+    return LEAD, None
+
+
+async def release(name: str, args: list, task_id: str) -> list[str]:
+    """Give up leading a task that could not be published.
+
+    Returns:
+        list[str]: IDs of the followers that were waiting for the task.
+    """
+    _, leader, followers = _keys(memo_key(name, args))
+    task_ids = await _RELEASE_SCRIPT(keys=[leader, followers], args=[task_id], client=results.instance)
+    return [task_id.decode() for task_id in task_ids]
@@ -0,0 +1,29 @@
+"""add unique index on users api key
+
+Revision ID: 5d0e8f3c1b27
+Revises: a2c73d6f899e
+Create Date: 2026-10-17 23:04:51.208716
+
+Built concurrently, so that authentication keeps reading the table meanwhile. Fails on
+duplicate API keys, which must be resolved first.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d0e8f3c1b27'
+down_revision: Union[str, None] = 'a2c73d6f899e'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index('ix_users_api_key', 'users', ['api_key'], unique=True, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_users_api_key', table_name='users', postgresql_concurrently=True)
@@ -0,0 +1,39 @@
+"""user credit slots table
+
+Revision ID: 7c41a9d2e6f0
+Revises: 5d0e8f3c1b27
+Create Date: 2026-10-17 23:31:08.774520
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7c41a9d2e6f0'
+down_revision: Union[str, None] = '5d0e8f3c1b27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'user_credit_slots',
+        sa.Column('user_name', sa.String(255), sa.ForeignKey('users.name'), nullable=False),
+        sa.Column('slot', sa.Integer(), nullable=False),
+        sa.Column('credits', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('user_name', 'slot'),
+        sa.CheckConstraint('credits >= 0', name='ck_user_credit_slots_credits'),
+    )
+
+
+def downgrade() -> None:
+    # Fold slot balances back into the users they belong to before dropping them
+    op.execute("""
+        UPDATE users SET credits = users.credits + slots.total
+        FROM (SELECT user_name, SUM(credits) AS total FROM user_credit_slots GROUP BY user_name) AS slots
+        WHERE users.name = slots.user_name
+    """)
+    op.drop_table('user_credit_slots')
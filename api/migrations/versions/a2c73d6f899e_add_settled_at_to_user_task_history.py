@@ -0,0 +1,26 @@
+"""add settled_at to user task history
+
+Revision ID: a2c73d6f899e
+Revises: bb82937a784c
+Create Date: 2026-10-17 14:03:27.551902
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a2c73d6f899e'
+down_revision: Union[str, None] = 'bb82937a784c'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('user_task_history', sa.Column('settled_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('user_task_history', 'settled_at')
@@ -0,0 +1,92 @@
+"""partition user task history by month
+
+Revision ID: bb82937a784c
+Revises: 3227ac46f5ef
+Create Date: 2026-10-17 09:12:44.318207
+
+Declarative partitioning with a primary key and a default partition requires PostgreSQL 11 or
+later. The primary key of a partitioned table must include the partition key, hence
+`created_at` joins it.
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'bb82937a784c'
+down_revision: Union[str, None] = '3227ac46f5ef'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PARTITIONS_AHEAD = 3
+"""Months after the current one to create partitions for right away."""
+
+
+def upgrade() -> None:
+    op.execute("ALTER TABLE user_task_history RENAME TO user_task_history_unpartitioned")
+    op.execute("ALTER INDEX user_task_history_pkey RENAME TO user_task_history_unpartitioned_pkey")
+
+    op.execute("""
+        CREATE TABLE user_task_history (
+            user_name VARCHAR(255) NOT NULL REFERENCES users (name),
+            task_id VARCHAR(255) NOT NULL,
+            cost INTEGER NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (user_name, task_id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute("CREATE TABLE user_task_history_default PARTITION OF user_task_history DEFAULT")
+
+    # One partition per month, from the oldest task on record up to a few months ahead
+    op.execute(f"""
+        DO $$
+        DECLARE
+            month DATE;
+        BEGIN
+            FOR month IN
+                SELECT generate_series(
+                    date_trunc('month', LEAST((SELECT MIN(created_at) FROM user_task_history_unpartitioned), now())),
+                    date_trunc('month', now()) + INTERVAL '{PARTITIONS_AHEAD} months',
+                    INTERVAL '1 month'
+                )::DATE
+            LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF user_task_history FOR VALUES FROM (%L) TO (%L)',
+                    'user_task_history_' || to_char(month, 'YYYYMM'),
+                    month,
+                    month + INTERVAL '1 month'
+                );
+            END LOOP;
+        END
+        $$
+    """)
+
+    op.execute("CREATE INDEX ix_user_task_history_task_id ON user_task_history (task_id)")
+    op.execute("CREATE INDEX ix_user_task_history_user_name_created_at ON user_task_history (user_name, created_at)")
+
+    op.execute("""
+        INSERT INTO user_task_history (user_name, task_id, cost, created_at)
+        SELECT user_name, task_id, cost, created_at FROM user_task_history_unpartitioned
+    """)
+    op.execute("DROP TABLE user_task_history_unpartitioned")
+
+
+def downgrade() -> None:
+    op.execute("ALTER TABLE user_task_history RENAME TO user_task_history_partitioned")
+    op.execute("ALTER INDEX user_task_history_pkey RENAME TO user_task_history_partitioned_pkey")
+
+    op.execute("""
+        CREATE TABLE user_task_history (
+            user_name VARCHAR(255) NOT NULL REFERENCES users (name),
+            task_id VARCHAR(255) NOT NULL,
+            cost INTEGER NOT NULL,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (user_name, task_id)
+        )
+    """)
+    op.execute("""
+        INSERT INTO user_task_history (user_name, task_id, cost, created_at)
+        SELECT user_name, task_id, cost, created_at FROM user_task_history_partitioned
+    """)
+    op.execute("DROP TABLE user_task_history_partitioned")
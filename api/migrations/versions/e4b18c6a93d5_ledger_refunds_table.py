@@ -0,0 +1,34 @@
+"""ledger refunds table
+
+Revision ID: e4b18c6a93d5
+Revises: 7c41a9d2e6f0
+Create Date: 2026-10-17 23:52:19.604183
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4b18c6a93d5'
+down_revision: Union[str, None] = '7c41a9d2e6f0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'ledger_refunds',
+        sa.Column('user_name', sa.String(255), sa.ForeignKey('users.name'), nullable=False),
+        sa.Column('task_id', sa.String(255), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+        sa.PrimaryKeyConstraint('user_name', 'task_id'),
+    )
+    op.create_index('ix_ledger_refunds_created_at', 'ledger_refunds', ['created_at'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_ledger_refunds_created_at', table_name='ledger_refunds')
+    op.drop_table('ledger_refunds')
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from pydantic import BaseModel, ConfigDict
 
 
@@ -22,6 +24,26 @@ class TaskResponseBase(BaseModel):
     """Task id."""
 
 
+class OperandsRequest(BaseModel):
+    """Operands of a single addition task."""
+
+    x: int
+    """First operand."""
+
+    y: int
+    """Second operand."""
+
+
+class BatchTaskResponse(BaseModel):
+    """Batch task response model."""
+
+    task_ids: list[str]
+    """Task ids, in the order of the submitted operands."""
+
+    group_id: str | None = None
+    """Group id, if the tasks were submitted as a group."""
+
+
 class TaskStateResponse(TaskResponseBase):
     """Task response state and result."""
 
@@ -32,6 +54,27 @@ class TaskStateResponse(TaskResponseBase):
     """Task result."""
 
 
+class GroupStateResponse(BaseModel):
+    """Group state response model."""
+
+    group_id: str
+    """Group id."""
+
+    tasks: list[TaskStateResponse]
+    """State and result of every task of the group."""
+
+
+class TaskHistoryResponse(TaskResponseBase):
+    """Task history entry response model."""
+    model_config = ConfigDict(from_attributes=True)
+
+    cost: int
+    """Credits the task cost."""
+
+    created_at: datetime
+    """Timestamp of when the task was submitted."""
+
+
 class CachedUserValue(BaseModel):
     """Cache user value model."""
     model_config = ConfigDict(from_attributes=True)
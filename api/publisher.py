@@ -0,0 +1,85 @@
+"""Non-blocking task publishing.
+
+Celery publishes synchronously over AMQP. Publishing from a coroutine would therefore stall
+every other request of the process for a broker round trip, or longer with publisher
+confirms. Publishes are instead handed to a dedicated thread pool, sized to match the
+Celery producer pool, so every thread holds its own pooled broker connection and channel.
+"""
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from celery import group
+from prometheus_client import Gauge, Histogram
+
+from celery_app import instance as celery_instance, PUBLISH_POOL_SIZE
+
+PUBLISH_LATENCY = Histogram("task_publish_seconds", "Time to publish a task, including waiting for a connection.")
+PUBLISH_PENDING = Gauge("task_publish_pending", "Publishes queued for or holding a broker connection.")
+
+_executor = ThreadPoolExecutor(max_workers=PUBLISH_POOL_SIZE, thread_name_prefix="publisher")
+
+
+async def send_task(name: str, args: list | None = None, task_id: str | None = None, **options) -> str:
+    """Publish a task without blocking the event loop.
+
+    Args:
+        name (str): Registered task name, e.g. `worker.add`.
+        args (list | None): Positional task arguments.
+        task_id (str | None): Task ID to use instead of a generated one.
+        **options: Further `Celery.send_task` options.
+
+    Returns:
+        str: The Celery task ID.
+    """
+    result = await _run(partial(celery_instance.send_task, name, args=args, task_id=task_id, **options))
+    return result.id
+
+
+async def send_tasks(name: str, tasks: list[tuple[list, str]], grouped: bool = False, **options) -> str | None:
+    """Publish many tasks at once without blocking the event loop.
+
+    All messages are published from one thread over one pooled broker connection.
+
+    Args:
+        name (str): Registered task name, e.g. `worker.add`.
+        tasks (list[tuple[list, str]]): Positional arguments and task ID of every task.
+        grouped (bool): Publish the tasks as a Celery group and store the group in the result
+            backend, so that it can be restored from its ID.
+        **options: Further `Celery.send_task` options, applied to every task.
+
+    Returns:
+        str | None: The group ID, if `grouped`.
+    """
+    return await _run(partial(_send_tasks, name, tasks, grouped, options))
+
+
+def _send_tasks(name: str, tasks: list[tuple[list, str]], grouped: bool, options: dict) -> str | None:
+    if grouped:
+        signatures = [celery_instance.signature(name, args=args, task_id=task_id, options=options) for args, task_id in tasks]
+        group_result = group(signatures, app=celery_instance).apply_async()
+        group_result.save()
+        return group_result.id
+
+    with celery_instance.producer_or_acquire() as producer:
+        for args, task_id in tasks:
+            celery_instance.send_task(name, args=args, task_id=task_id, producer=producer, **options)
+    return None
+
+
+async def _run(send):
+    loop = asyncio.get_running_loop()
+
+    PUBLISH_PENDING.inc()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, send)
+    finally:
+        PUBLISH_PENDING.dec()
+        PUBLISH_LATENCY.observe(time.perf_counter() - start)
+
+
+def shutdown():
+    """Wait for in-flight publishes and stop the publishing threads."""
+    _executor.shutdown(wait=True)
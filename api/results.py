@@ -0,0 +1,400 @@
+"""Direct reads from the Redis result backend.
+
+`AsyncResult` fetches one task per Redis round trip and blocks while doing so. Task states
+are instead read here with the async client, many tasks per `MGET`, and decoded with the
+result backend's own serializer.
+
+The Redis backend also publishes every state it stores on a channel named after the task's
+key. `notifier` consumes those with a single pattern subscription per process and hands them
+to whoever waits for a task.
+
+Ready results that have been delivered to a client are rarely read again, yet would take up
+memory until the result backend expires them. They are either given a short TTL, or moved into
+one of `RESULT_BUCKETS` hashes. A hash field holding a packed result takes a fraction of the
+memory of a key holding the full meta.
+"""
+import asyncio
+import logging
+import os
+import random
+import zlib
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import AsyncIterator
+
+import msgpack
+from celery import states
+from prometheus_client import Gauge
+from redis import asyncio as aioredis
+
+from cache import REDIS_MAX_CONNECTIONS, REDIS_SOCKET_TIMEOUT, listen
+from celery_app import instance as celery_instance, CELERY_RESULT_BACKEND
+from models import TaskStateResponse
+
+_logger = logging.getLogger(__name__)
+
+RESULTS_MGET_CHUNK_SIZE = int(os.getenv("RESULTS_MGET_CHUNK_SIZE", "500"))
+"""Maximum number of keys per `MGET`. Larger requests are split and pipelined."""
+
+RESULT_DELIVERED_TTL = int(os.getenv("RESULT_DELIVERED_TTL", "0"))
+"""Seconds a ready result is kept once it has been delivered. `0` keeps it as long as the result backend does."""
+
+RESULT_BUCKETS = int(os.getenv("RESULT_BUCKETS", "0"))
+"""Number of hashes delivered results are packed into. `0` leaves them in their own keys."""
+
+RESULT_BUCKET_PREFIX = "results:"
+"""Prefix of the keys of result buckets."""
+
+RESULT_MEMORY_SAMPLE_INTERVAL = float(os.getenv("RESULT_MEMORY_SAMPLE_INTERVAL", "0"))
+"""Seconds between two samples of the result backend memory. `0` disables sampling."""
+
+RESULT_MEMORY_SAMPLE_SIZE = int(os.getenv("RESULT_MEMORY_SAMPLE_SIZE", "100"))
+"""Keys measured per sample."""
+
+RESULT_TASK_BYTES = Gauge("result_backend_task_bytes", "Average result backend memory per task, as last sampled.", ["storage"])
+RESULT_USED_MEMORY = Gauge("result_backend_used_memory_bytes", "Memory used by the result backend, as last sampled.")
+
+_PACKED_STATES = (states.SUCCESS, states.FAILURE, states.REVOKED)
+
+pool = aioredis.BlockingConnectionPool.from_url(
+    CELERY_RESULT_BACKEND,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    socket_timeout=REDIS_SOCKET_TIMEOUT,
+    socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
+    timeout=REDIS_SOCKET_TIMEOUT,
+)
+"""Connection pool to the result backend."""
+
+instance = aioredis.Redis(connection_pool=pool)
+"""Async client to the result backend."""
+
+
+def to_state_response(task_id: str, meta: dict | None) -> TaskStateResponse:
+    """Convert decoded result backend meta into a task state response.
+
+    Tasks without any meta are reported as `PENDING`, like `AsyncResult` does.
+    """
+    if meta is None:
+        return TaskStateResponse(task_id=task_id, state=states.PENDING)
+
+    response = TaskStateResponse(task_id=task_id, state=meta["status"])
+    if meta["status"] == states.SUCCESS:
+        response.result = meta["result"]
+
+    return response
+
+
+def bucket_for(task_id: str) -> str:
+    """Key of the hash a task's result is packed into once delivered."""
+    return f"{RESULT_BUCKET_PREFIX}{zlib.crc32(task_id.encode()) % RESULT_BUCKETS}"
+
+
+def pack_meta(meta: dict) -> bytes:
+    """Pack what clients get of a ready meta, i.e. the state and the result of a success.
+
+    The state is packed as a small integer, so the result of an addition takes 3 to 11 bytes.
+    """
+    state = _PACKED_STATES.index(meta["status"])
+    return msgpack.packb([state, meta["result"]] if meta["status"] == states.SUCCESS else [state])
+
+
+def unpack_meta(packed: bytes) -> dict:
+    """Unpack a meta packed by `pack_meta`."""
+    state, *result = msgpack.unpackb(packed)
+    return {"status": _PACKED_STATES[state], "result": result[0] if result else None}
+
+
+async def release_delivered(metas: list[tuple[str, dict]]):
+    """Shorten the lifetime of delivered ready results, or pack them into their buckets.
+
+    Args:
+        metas (list[tuple[str, dict]]): `(task_id, meta)` of every delivered ready task.
+    """
+    if not metas or (RESULT_BUCKETS <= 0 and RESULT_DELIVERED_TTL <= 0):
+        return
+
+    backend = celery_instance.backend
+    ttl = RESULT_DELIVERED_TTL or backend.expires
+    async with instance.pipeline(transaction=False) as pipe:
+        for task_id, meta in metas:
+            key = backend.get_key_for_task(task_id)
+            if RESULT_BUCKETS > 0:
+                bucket = bucket_for(task_id)
+                pipe.hset(bucket, task_id, pack_meta(meta))
+                if ttl:
+                    pipe.hexpire(bucket, int(ttl), task_id)
+                pipe.delete(key)
+            else:
+                # Never lengthen the lifetime of results about to expire anyway
+                pipe.expire(key, RESULT_DELIVERED_TTL, lt=True)
+        await pipe.execute()
+
+
+async def fetch_metas(task_ids: list[str]) -> list[dict | None]:
+    """Fetch the decoded result backend meta of many tasks.
+
+    Ready results read from their own keys are released, see `release_delivered`. Results
+    read from buckets only hold a state and, on success, a result.
+
+    Returns:
+        list[dict | None]: Meta per task, in the order of `task_ids`, or `None` if there is none yet.
+    """
+    backend = celery_instance.backend
+    keys = [backend.get_key_for_task(task_id) for task_id in task_ids]
+
+    async with instance.pipeline(transaction=False) as pipe:
+        for start in range(0, len(keys), RESULTS_MGET_CHUNK_SIZE):
+            pipe.mget(keys[start:start + RESULTS_MGET_CHUNK_SIZE])
+        if RESULT_BUCKETS > 0:
+            for task_id in task_ids:
+                pipe.hget(bucket_for(task_id), task_id)
+        replies = await pipe.execute()
+
+    chunk_count = -(-len(keys) // RESULTS_MGET_CHUNK_SIZE)
+    raws = [raw for chunk in replies[:chunk_count] for raw in chunk]
+    packed = replies[chunk_count:] or [None] * len(task_ids)
+
+    metas, delivered = [], []
+    for task_id, raw, packed_meta in zip(task_ids, raws, packed):
+        if raw is not None:
+            meta = backend.decode_result(raw)
+            if meta["status"] in states.READY_STATES:
+                delivered.append((task_id, meta))
+        else:
+            meta = None if packed_meta is None else unpack_meta(packed_meta)
+        metas.append(meta)
+
+    await release_delivered(delivered)
+    return metas
+
+
+async def fetch_states(task_ids: list[str]) -> list[TaskStateResponse]:
+    """Fetch the state, and result if available, of many tasks in a single round trip.
+
+    Returns:
+        list[TaskStateResponse]: States in the order of `task_ids`.
+    """
+    metas = await fetch_metas(task_ids)
+    return [to_state_response(task_id, meta) for task_id, meta in zip(task_ids, metas)]
+
+
+async def store_states(task_ids: list[str], state: str, result=None):
+    """Store the same state and result for many tasks in a single round trip.
+
+    Writes the meta the worker would have stored and notifies subscribers, for tasks whose
+    outcome is known without running them.
+    """
+    backend = celery_instance.backend
+    date_done = datetime.now(timezone.utc).isoformat()
+    async with instance.pipeline(transaction=False) as pipe:
+        for task_id in task_ids:
+            meta = backend.encode({
+                "status": state,
+                "result": result,
+                "traceback": None,
+                "children": [],
+                "date_done": date_done,
+                "task_id": task_id,
+            })
+            key = backend.get_key_for_task(task_id)
+            pipe.set(key, meta, ex=backend.expires)
+            pipe.publish(key, meta)
+        await pipe.execute()
+
+
+class TaskStateNotifier:
+    """Fan-out of result backend notifications to in-process subscribers.
+
+    Subscribers get a queue, which receives `(task_id, meta)` with the decoded meta of every
+    state stored for the tasks they subscribed to. One queue may be subscribed to many tasks.
+    `(task_id, None)` is put on every queue whenever the subscription is re-established after
+    losing the connection, since notifications may have been missed meanwhile and subscribers
+    must re-read the state. Idle periods do not end the subscription.
+    """
+
+    def __init__(self):
+        self._subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+
+    def subscribe(self, task_id: str, queue: asyncio.Queue | None = None) -> asyncio.Queue:
+        """Start receiving the states stored for a task, on a new queue unless one is given."""
+        queue = queue if queue is not None else asyncio.Queue()
+        self._subscribers[task_id].add(queue)
+        return queue
+
+    def unsubscribe(self, task_id: str, queue: asyncio.Queue):
+        """Stop receiving the states stored for a task."""
+        subscribers = self._subscribers.get(task_id)
+        if subscribers is not None:
+            subscribers.discard(queue)
+            if not subscribers:
+                del self._subscribers[task_id]
+
+    def publish(self, task_id: str, meta: dict | None):
+        """Hand a state to every subscriber of the task."""
+        for queue in self._subscribers.get(task_id, ()):
+            queue.put_nowait((task_id, meta))
+
+    async def run(self, retry_interval: float = 1.0):
+        """Consume result backend notifications for the lifetime of the application."""
+        backend = celery_instance.backend
+        prefix = backend.task_keyprefix
+        if isinstance(prefix, str):
+            prefix = prefix.encode()
+
+        while True:
+            try:
+                async with instance.pubsub() as pubsub:
+                    await pubsub.psubscribe(prefix + b"*")
+                    for task_id in list(self._subscribers):
+                        self.publish(task_id, None)
+
+                    async for message in listen(pubsub):
+                        if message["type"] != "pmessage":
+                            continue
+                        task_id = message["channel"][len(prefix):].decode()
+                        if task_id in self._subscribers:
+                            self.publish(task_id, backend.decode_result(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                _logger.exception("Result backend subscription failed, retrying")
+                await asyncio.sleep(retry_interval)
+
+
+notifier = TaskStateNotifier()
+"""Per-process notifier, run from the application lifespan."""
+
+
+async def wait_for_state(task_id: str, timeout: float) -> TaskStateResponse:
+    """Wait until a task reaches a ready state, or the timeout expires.
+
+    Args:
+        task_id (str): Celery Task ID.
+        timeout (float): Maximum number of seconds to wait.
+
+    Returns:
+        TaskStateResponse: The ready state of the task, or its latest state on timeout.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+
+    # Subscribe before reading the state, so that no transition can slip in between
+    queue = notifier.subscribe(task_id)
+    try:
+        state = (await fetch_states([task_id]))[0]
+        while state.state not in states.READY_STATES:
+            try:
+                _, meta = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            if meta is None:
+                state = (await fetch_states([task_id]))[0]
+            else:
+                state = to_state_response(task_id, meta)
+                if state.state in states.READY_STATES:
+                    await release_delivered([(task_id, meta)])
+        return state
+    finally:
+        notifier.unsubscribe(task_id, queue)
+
+
+async def stream_states(task_ids: list[str], heartbeat: float) -> AsyncIterator[TaskStateResponse | None]:
+    """Stream the state transitions of tasks until all of them are ready.
+
+    The current state of every task is yielded first, then every change as it is stored by the
+    workers. `None` is yielded whenever `heartbeat` seconds pass without a change, so that the
+    caller can keep the connection alive.
+
+    Args:
+        task_ids (list[str]): Celery Task IDs.
+        heartbeat (float): Seconds of silence after which `None` is yielded.
+    """
+    queue = asyncio.Queue()
+    for task_id in task_ids:
+        notifier.subscribe(task_id, queue)
+
+    try:
+        latest = {}
+        pending = set(task_ids)
+        changes = await fetch_states(task_ids)
+        while True:
+            for state in changes:
+                if state.task_id in pending and latest.get(state.task_id) != state:
+                    latest[state.task_id] = state
+                    yield state
+                    if state.state in states.READY_STATES:
+                        pending.discard(state.task_id)
+                        notifier.unsubscribe(state.task_id, queue)
+
+            if not pending:
+                return
+
+            try:
+                task_id, meta = await asyncio.wait_for(queue.get(), heartbeat)
+            except asyncio.TimeoutError:
+                yield None
+                changes = []
+                continue
+
+            if meta is None:
+                changes = await fetch_states(sorted(pending))
+            else:
+                changes = [to_state_response(task_id, meta)]
+                if meta["status"] in states.READY_STATES and task_id in pending:
+                    await release_delivered([(task_id, meta)])
+    finally:
+        for task_id in task_ids:
+            notifier.unsubscribe(task_id, queue)
+
+
+async def sample_memory():
+    """Sample the memory the result backend takes per task, in keys and in buckets."""
+    backend = celery_instance.backend
+    prefix = backend.task_keyprefix
+    if isinstance(prefix, bytes):
+        prefix = prefix.decode()
+
+    _, keys = await instance.scan(0, match=f"{prefix}*", count=RESULT_MEMORY_SAMPLE_SIZE)
+    keys = keys[:RESULT_MEMORY_SAMPLE_SIZE]
+    buckets = []
+    if RESULT_BUCKETS > 0:
+        indices = random.sample(range(RESULT_BUCKETS), min(RESULT_BUCKETS, RESULT_MEMORY_SAMPLE_SIZE))
+        buckets = [f"{RESULT_BUCKET_PREFIX}{index}" for index in indices]
+
+    async with instance.pipeline(transaction=False) as pipe:
+        pipe.info("memory")
+        for key in keys:
+            pipe.memory_usage(key)
+        for bucket in buckets:
+            pipe.memory_usage(bucket)
+            pipe.hlen(bucket)
+        replies = await pipe.execute()
+
+    RESULT_USED_MEMORY.set(replies[0]["used_memory"])
+    key_bytes = [usage for usage in replies[1:1 + len(keys)] if usage is not None]
+    if key_bytes:
+        RESULT_TASK_BYTES.labels(storage="key").set(sum(key_bytes) / len(key_bytes))
+    bucket_replies = replies[1 + len(keys):]
+    bucket_bytes = sum(usage or 0 for usage in bucket_replies[0::2])
+    bucket_tasks = sum(bucket_replies[1::2])
+    if bucket_tasks:
+        RESULT_TASK_BYTES.labels(storage="bucket").set(bucket_bytes / bucket_tasks)
+
+
+async def run_memory_sampler(retry_interval: float = 60.0):
+    """Sample the result backend memory for the lifetime of the application."""
+    while True:
+        try:
+            await sample_memory()
+            await asyncio.sleep(RESULT_MEMORY_SAMPLE_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            _logger.exception("Sampling the result backend memory failed, retrying")
+            await asyncio.sleep(retry_interval)
+
+
+async def close():
+    """Release the client and disconnect all pooled connections."""
+    await instance.aclose()
+    await pool.disconnect()
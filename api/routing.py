@@ -0,0 +1,81 @@
+"""Routing of tasks to per-user queues.
+
+With a single queue, a user submitting thousands of tasks at once makes everyone else wait
+until their backlog is worked off. With `TASK_QUEUE_SHARDS` set, users are instead hashed onto
+that many queues. Workers consume all of them, and RabbitMQ hands out messages from each queue
+in turn.
+
+Hashing alone still lets a flooding user starve the users sharing their shard. Once a user
+submitted more than `TASK_BULK_THRESHOLD` tasks within `TASK_BULK_WINDOW` seconds, their further
+tasks go to a dedicated bulk queue instead. It is served in turn with the shards like any other
+queue, so a flood gets the whole capacity left over by the shards, but never holds them back.
+
+Within a queue, users with a higher priority, e.g. paying tiers, are served first.
+"""
+import os
+import zlib
+
+from cache import instance as cache_instance
+from celery_app import TASK_QUEUE_SHARDS, TASK_QUEUE_PREFIX, TASK_MAX_PRIORITY, TASK_BULK_QUEUE
+
+TASK_USER_PRIORITIES = {
+    user_name: min(int(priority), TASK_MAX_PRIORITY)
+    for user_name, priority in (
+        entry.split("=") for entry in os.getenv("TASK_USER_PRIORITIES", "").split(",") if entry
+    )
+}
+"""Message priority per user, configured as `user=priority,...`."""
+
+TASK_DEFAULT_PRIORITY = int(os.getenv("TASK_DEFAULT_PRIORITY", "0"))
+"""Message priority of users without one of their own."""
+
+TASK_BULK_THRESHOLD = int(os.getenv("TASK_BULK_THRESHOLD", "100"))
+"""Tasks a user may submit within `TASK_BULK_WINDOW` before the rest go to the bulk queue. `0` disables it."""
+
+TASK_BULK_WINDOW = int(os.getenv("TASK_BULK_WINDOW", "60"))
+"""Seconds over which the tasks of a user are counted towards `TASK_BULK_THRESHOLD`."""
+
+TASK_BULK_KEY_PREFIX = "bulk:"
+"""Prefix of the Redis keys counting the recent tasks of a user."""
+
+
+def queue_for(user_name: str, recent: int = 0) -> str:
+    """Name of the queue a user's tasks go to.
+
+    Args:
+        user_name (str): User submitting.
+        recent (int): Tasks the user submitted within `TASK_BULK_WINDOW`, including these.
+    """
+    if 0 < TASK_BULK_THRESHOLD < recent:
+        return TASK_BULK_QUEUE
+    return f"{TASK_QUEUE_PREFIX}.{zlib.crc32(user_name.encode()) % TASK_QUEUE_SHARDS}"
+
+
+async def count_recent(user_name: str, tasks: int) -> int:
+    """Count tasks towards a user's submissions of the current `TASK_BULK_WINDOW`, and return them."""
+    key = f"{TASK_BULK_KEY_PREFIX}{user_name}"
+    async with cache_instance.pipeline(transaction=False) as pipe:
+        pipe.incrby(key, tasks)
+        pipe.expire(key, TASK_BULK_WINDOW, nx=True)
+        recent, _ = await pipe.execute()
+    return recent
+
+
+async def route(user_name: str, tasks: int = 1) -> dict:
+    """Publishing options routing a user's tasks.
+
+    Args:
+        user_name (str): User submitting.
+        tasks (int): Tasks submitted at once, all routed alike.
+
+    Returns:
+        dict: `Celery.send_task` options, empty if all tasks go to the default queue.
+    """
+    if TASK_QUEUE_SHARDS <= 0:
+        return {}
+
+    recent = await count_recent(user_name, tasks) if TASK_BULK_THRESHOLD > 0 else 0
+    return {
+        "queue": queue_for(user_name, recent),
+        "priority": TASK_USER_PRIORITIES.get(user_name, TASK_DEFAULT_PRIORITY),
+    }
@@ -1,29 +1,378 @@
+import asyncio
 import logging
-
+import os
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator
+
+from celery import states
+from celery.result import GroupResult
 from fastapi import HTTPException
-from sqlalchemy import select, update, insert
-
+from sqlalchemy import select, update, insert, delete, func, literal, values, column, tuple_, String, Integer, Select
+
+import admission
+import auth
+import credit_slots
+import ledger
+import memo
+import publisher
+import results
+import routing
+import settlement
+import timing
 from celery_app import instance as celery_instance
-from database.engine import async_session
+from database.engine import async_session, async_read_session
 from database.models import User, UserTaskHistory
-from models import TaskResponseBase, TaskStateResponse, UserCreditsResponse
+from models import TaskResponseBase, TaskStateResponse, UserCreditsResponse, BatchTaskResponse, GroupStateResponse
 
 _logger = logging.getLogger(__name__)
 
 API_COST = 10
 """Arbitrary API cost for each task submitted."""
 
+BILLING_MODE = os.getenv("BILLING_MODE", "database")
+"""Where user balances are debited.
 
-async def get_all_users() -> list[User]:
-    """Retrieve all users' names."""
-    async with async_session() as session:
-        result = await session.execute(select(User))
+* `database`: every submission debits the `users` row in Postgres synchronously.
+* `sharded`: every submission debits one of several slot rows of the user in Postgres
+  synchronously, see `credit_slots`. Group commit does not apply. Balances must be folded
+  back with `credit_slots.fold` when switching to another mode.
+* `ledger`: balances live in Redis and are written behind to Postgres, see `ledger`.
+"""
+
+BILLING_POLICY = os.getenv("BILLING_POLICY", "on_submit")
+"""When the credits debited for a task are final.
+
+* `on_submit`: tasks are paid for when submitted, whatever their outcome.
+* `on_success`: the debit on submission is a hold, which is given back if the task fails,
+  see `settlement`. Requires the `database` or `sharded` billing mode.
+"""
+
+if BILLING_POLICY == "on_success" and BILLING_MODE == "ledger":
+    raise ValueError("The on_success billing policy requires the database or sharded billing mode")
+
+MAX_POLL_WAIT = float(os.getenv("MAX_POLL_WAIT", "30"))
+"""Maximum number of seconds a long-poll request is held open."""
+
+STREAM_HISTORY_WINDOW = float(os.getenv("STREAM_HISTORY_WINDOW", "3600"))
+"""Seconds back in the user's history a state stream without explicit tasks looks for tasks."""
+
+STREAM_HEARTBEAT = float(os.getenv("STREAM_HEARTBEAT", "15"))
+"""Seconds of silence after which a state stream sends a keep-alive."""
+
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
+"""Maximum number of tasks accepted by a single batch submission or batch poll."""
+
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", "100"))
+"""Default number of users per page of the user listing."""
+
+MAX_USERS_PAGE_SIZE = int(os.getenv("MAX_USERS_PAGE_SIZE", "1000"))
+"""Maximum number of users per page of the user listing."""
+
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "100"))
+"""Default number of tasks per page of the task history."""
+
+MAX_HISTORY_PAGE_SIZE = int(os.getenv("MAX_HISTORY_PAGE_SIZE", "1000"))
+"""Maximum number of tasks per page of the task history."""
+
+USERS_STREAM_BATCH_SIZE = int(os.getenv("USERS_STREAM_BATCH_SIZE", "1000"))
+"""Number of users fetched from the database at a time while streaming the user listing."""
+
+TASK_BATCH_WINDOW = float(os.getenv("TASK_BATCH_WINDOW_MS", "0")) / 1000
+"""Seconds database debits are collected for before being committed together.
+
+`0` disables group commit and debits every task in its own transaction.
+"""
+
+TASK_BATCH_SIZE = int(os.getenv("TASK_BATCH_SIZE", "100"))
+"""Number of collected debits that triggers a commit before the window has passed."""
+
+TASK_MICROBATCH_WINDOW = float(os.getenv("TASK_MICROBATCH_WINDOW_MS", "0")) / 1000
+"""Seconds single task submissions are collected for before being published as one `worker.add_many`.
+
+`0` disables micro-batching and publishes every task as its own `worker.add` message.
+"""
+
+TASK_MICROBATCH_SIZE = int(os.getenv("TASK_MICROBATCH_SIZE", "100"))
+"""Number of collected submissions that triggers a publish before the window has passed."""
+
+
+async def get_all_users(after: str | None = None, limit: int | None = None) -> list[User]:
+    """Retrieve a page of users, ordered by name.
+
+    Pages are addressed by keyset, so fetching a page costs the same no matter how deep into
+    the listing it is.
+
+    Args:
+        after (str | None): Name of the last user of the previous page, if any.
+        limit (int | None): Page size, all remaining users if `None`.
+    """
+    statement = select(User).order_by(User.name).limit(limit)
+    if after is not None:
+        statement = statement.where(User.name > after)
+
+    async with async_read_session() as session:
+        result = await session.execute(statement)
         return result.scalars().all()
 
 
+async def stream_user_names(after: str | None = None) -> AsyncIterator[str]:
+    """Stream the names of all users, ordered by name, from a server-side cursor.
+
+    Rows are fetched `USERS_STREAM_BATCH_SIZE` at a time, so memory use does not grow with the
+    number of users.
+
+    Args:
+        after (str | None): Only stream users whose name sorts after this one.
+    """
+    statement = select(User.name).order_by(User.name).execution_options(yield_per=USERS_STREAM_BATCH_SIZE)
+    if after is not None:
+        statement = statement.where(User.name > after)
+
+    async with async_read_session() as session:
+        result = await session.stream_scalars(statement)
+        async for name in result:
+            yield name
+
+
+def debit_statement(user_name: str, task_id: str, cost: int) -> Select:
+    """Build the conditional credit debit for a single task.
+
+    One statement debits the user only if they can afford the task, records the task in the
+    user's history and returns the new balance. Row locking on `users` makes the check correct
+    under concurrent submissions, so no locking is needed in Python.
+
+    Args:
+        user_name (str): User to debit.
+        task_id (str): Task ID to record in the user's history.
+        cost (int): Credits to debit.
+
+    Returns:
+        Select: Statement yielding the new balance, or no row if the user cannot afford the task.
+    """
+    debited = (
+        update(User)
+        .where(User.name == user_name, User.credits >= cost)
+        .values(credits=User.credits - cost)
+        .returning(User.name, User.credits)
+        .cte("debited")
+    )
+    history = (
+        insert(UserTaskHistory)
+        .from_select(
+            ["user_name", "task_id", "cost", "created_at"],
+            select(debited.c.name, literal(task_id), literal(cost), func.now()),
+        )
+        .returning(UserTaskHistory.task_id)
+        .cte("history")
+    )
+    return select(debited.c.credits).add_cte(history)
+
+
+def batch_debit_statement(tasks: list[tuple[str, str, int]]) -> Select:
+    """Build the conditional credit debit for a batch of tasks.
+
+    Costs are aggregated per user and debited with a single `UPDATE ... FROM (VALUES ...)`,
+    only for users that can afford all their tasks. History rows of those users are written
+    with a single multi-row `INSERT` in the same statement.
+
+    The users' rows are locked in order of their names first, so that batches committed
+    concurrently wait for each other rather than deadlock over users they share.
+
+    Args:
+        tasks (list[tuple[str, str, int]]): `(user_name, task_id, cost)` per task.
+
+    Returns:
+        Select: Statement yielding `(name, credits)` for every debited user.
+    """
+    totals_by_user = defaultdict(int)
+    for user_name, _, cost in tasks:
+        totals_by_user[user_name] += cost
+
+    totals = values(column("name", String), column("total", Integer), name="totals").data(
+        sorted(totals_by_user.items())
+    )
+    locked = (
+        select(User.name)
+        .where(User.name.in_(sorted(totals_by_user)))
+        .order_by(User.name)
+        .with_for_update(key_share=True)
+        .cte("locked")
+    )
+    debited = (
+        update(User)
+        .where(User.name == locked.c.name, User.name == totals.c.name, User.credits >= totals.c.total)
+        .values(credits=User.credits - totals.c.total)
+        .returning(User.name, User.credits)
+        .cte("debited")
+    )
+    rows = values(column("user_name", String), column("task_id", String), column("cost", Integer), name="tasks").data(
+        tasks
+    )
+    history = (
+        insert(UserTaskHistory)
+        .from_select(
+            ["user_name", "task_id", "cost", "created_at"],
+            select(rows.c.user_name, rows.c.task_id, rows.c.cost, func.now())
+            .join(debited, debited.c.name == rows.c.user_name),
+        )
+        .returning(UserTaskHistory.task_id)
+        .cte("history")
+    )
+    return select(debited.c.name, debited.c.credits).add_cte(history)
+
+
+class DebitBatcher:
+    """Group commit of task debits.
+
+    Debits are collected for `window` seconds, or until `max_size` of them are pending, and
+    then committed in one transaction. Every caller awaits the outcome of its own debit.
+    """
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._pending: list[tuple[str, str, int, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._commits: set[asyncio.Task] = set()
+
+    async def debit(self, user_name: str, task_id: str, cost: int) -> int | None:
+        """Queue a debit and wait for the batch it ends up in to be committed.
+
+        Returns:
+            int | None: The user's balance after the batch, or `None` if they cannot afford the task.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_name, task_id, cost, future))
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._commit(batch))
+            self._commits.add(task)
+            task.add_done_callback(self._commits.discard)
+
+    async def _commit(self, batch: list[tuple[str, str, int, asyncio.Future]]):
+        try:
+            async with async_session() as session:
+                result = await session.execute(batch_debit_statement([item[:3] for item in batch]))
+                balances = dict(result.all())
+
+                # Users that cannot afford their whole batch fall back to per task debits, so that
+                # the tasks they can afford still go through.
+                task_balances = {}
+                for user_name, task_id, cost, _ in batch:
+                    if user_name not in balances:
+                        result = await session.execute(debit_statement(user_name, task_id, cost))
+                        task_balances[task_id] = result.scalar_one_or_none()
+
+                await session.commit()
+        except Exception as e:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for user_name, task_id, _, future in batch:
+            if not future.done():
+                future.set_result(balances[user_name] if user_name in balances else task_balances[task_id])
+
+
+debit_batcher = DebitBatcher(TASK_BATCH_WINDOW, TASK_BATCH_SIZE)
+"""Group commit batcher used for database debits when `TASK_BATCH_WINDOW` is set."""
+
+
+class AdditionBatcher:
+    """Micro-batching of addition task submissions.
+
+    Submissions are collected for `window` seconds, or until `max_size` of them are pending,
+    and published as a single `worker.add_many` message. Every task keeps its own ID, under
+    which the worker stores its result, and every caller awaits the publish of its own batch.
+    """
+
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self._pending: list[tuple[str, int, int, dict, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._publishes: set[asyncio.Task] = set()
+
+    async def submit(self, task_id: str, x: int, y: int, **options):
+        """Queue an addition and wait for the batch it ends up in to be published.
+
+        Additions are only batched with others published with the same `options`, e.g. the
+        same queue.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((task_id, x, y, options, future))
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+
+        await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            routes = defaultdict(list)
+            for task_id, x, y, options, future in batch:
+                routes[tuple(sorted(options.items()))].append((task_id, x, y, future))
+
+            for options, routed in routes.items():
+                task = asyncio.create_task(self._publish(routed, dict(options)))
+                self._publishes.add(task)
+                task.add_done_callback(self._publishes.discard)
+
+    async def _publish(self, batch: list[tuple[str, int, int, asyncio.Future]], options: dict):
+        task_ids, xs, ys, futures = (list(column) for column in zip(*batch))
+        try:
+            await publisher.send_task("worker.add_many", args=[task_ids, xs, ys], **options)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future in futures:
+            if not future.done():
+                future.set_result(None)
+
+
+addition_batcher = AdditionBatcher(TASK_MICROBATCH_WINDOW, TASK_MICROBATCH_SIZE)
+"""Micro-batcher used for single task submissions when `TASK_MICROBATCH_WINDOW` is set."""
+
+
 async def create_addition_task(user: User, x: int, y: int) -> TaskResponseBase:
     """Create addition task.
 
+    Submissions are subject to admission control, see `admission`. Credits are debited before
+    the task is published, so that a task is never executed for free. Should publishing fail,
+    the debit is reverted.
+
+    With `memo.TASK_MEMO_TTL` set, additions computed recently are answered from the memo, and
+    additions identical to one in flight share its outcome, without being published. They are
+    billed like any other task.
+
     Args:
         user (User): User triggering the task.
         x (int): First operand.
@@ -32,30 +381,168 @@ async def create_addition_task(user: User, x: int, y: int) -> TaskResponseBase:
     Returns:
         TaskResponseBase: Task response including the spawned task ID.
     """
-    if user.credits - API_COST < 0:
+    with timing.stage("admission"):
+        await admission.admit(user.name)
+
+    task_id = str(uuid.uuid4())
+
+    # 1. Deduct user credits and trace task history in a single round trip.
+    # With the on_success billing policy, failed tasks are refunded once they are settled
+    with timing.stage("debit"):
+        credits = await debit_credits(user.name, [task_id], API_COST)
+    if credits is None:
+        raise HTTPException(status_code=403, detail="Insufficient credits")
+
+    _logger.debug(f"Debited {API_COST} credits from {user.name}, {credits} left")
+
+    # 2. Serve repeated additions without a trip to the broker
+    if memo.TASK_MEMO_TTL > 0:
+        with timing.stage("memo"):
+            outcome, value = await memo.claim("worker.add", [x, y], task_id)
+        if outcome == memo.HIT:
+            await results.store_states([task_id], states.SUCCESS, value)
+            if BILLING_POLICY == "on_success":
+                await settlement.publish_outcomes([task_id], states.SUCCESS)
+            return TaskResponseBase(task_id=task_id)
+        if outcome == memo.FOLLOW:
+            _logger.debug(f"Task {task_id} follows identical task {value}")
+            return TaskResponseBase(task_id=task_id)
+
+    # 3. Submit the task, possibly along with other submissions of the same instant
+    try:
+        with timing.stage("publish"):
+            if TASK_MICROBATCH_WINDOW > 0:
+                await addition_batcher.submit(task_id, x, y, **await routing.route(user.name))
+            else:
+                await publisher.send_task("worker.add", args=[x, y], task_id=task_id, **await routing.route(user.name))
+    except Exception as e:
+        await refund_tasks(user.name, [task_id], API_COST)
+        if memo.TASK_MEMO_TTL > 0:
+            # Followers were accepted already, so they fail along with the task they waited for
+            followers = await memo.release("worker.add", [x, y], task_id)
+            if followers:
+                await results.store_states(followers, states.FAILURE, celery_instance.backend.prepare_exception(e))
+                if BILLING_POLICY == "on_success":
+                    await settlement.publish_outcomes(followers, states.FAILURE)
+        raise
+
+    return TaskResponseBase(task_id=task_id)
+
+
+async def create_addition_tasks(user: User, operands: list[tuple[int, int]], grouped: bool = False) -> BatchTaskResponse:
+    """Create a batch of addition tasks.
+
+    The whole batch is debited in one transaction, or not at all, and published over a single
+    broker connection.
+
+    Args:
+        user (User): User triggering the tasks.
+        operands (list[tuple[int, int]]): Operand pairs, one per task.
+        grouped (bool): Publish the tasks as a Celery group that can be polled as a unit.
+
+    Returns:
+        BatchTaskResponse: The spawned task IDs, in the order of `operands`, and the group ID.
+    """
+    with timing.stage("admission"):
+        await admission.admit(user.name, len(operands))
+
+    task_ids = [str(uuid.uuid4()) for _ in operands]
+
+    # 1. Deduct user credits for all tasks and trace task history in a single round trip
+    with timing.stage("debit"):
+        credits = await debit_credits(user.name, task_ids, API_COST)
+    if credits is None:
         raise HTTPException(status_code=403, detail="Insufficient credits")
 
-    # 1. Submit the task
-    task = celery_instance.send_task("worker.add", args=[x, y])
+    _logger.debug(f"Debited {API_COST * len(task_ids)} credits from {user.name}, {credits} left")
+
+    # 2. Submit the tasks
+    tasks = [([x, y], task_id) for (x, y), task_id in zip(operands, task_ids)]
+    try:
+        with timing.stage("publish"):
+            group_id = await publisher.send_tasks(
+                "worker.add", tasks, grouped=grouped, **await routing.route(user.name, len(tasks))
+            )
+    except Exception:
+        await refund_tasks(user.name, task_ids, API_COST)
+        raise
+
+    return BatchTaskResponse(task_ids=task_ids, group_id=group_id)
+
+
+async def debit_credits(user_name: str, task_ids: list[str], cost: int) -> int | None:
+    """Debit a user for tasks and record them in their history.
+
+    Either all tasks are debited or none.
+
+    Args:
+        user_name (str): User to debit.
+        task_ids (list[str]): Task IDs to record in the user's history.
+        cost (int): Credits to debit per task.
+
+    Returns:
+        int | None: The new balance, or `None` if the user cannot afford the tasks.
+    """
+    if BILLING_MODE == "ledger":
+        return await ledger.debit(user_name, task_ids, cost)
+
+    if BILLING_MODE == "sharded":
+        return await credit_slots.debit(user_name, task_ids, cost)
+
+    if len(task_ids) > 1:
+        async with async_session() as session:
+            result = await session.execute(batch_debit_statement([(user_name, task_id, cost) for task_id in task_ids]))
+            credits = dict(result.all()).get(user_name)
+
+            if credits is not None:
+                await session.commit()
+
+            return credits
+
+    if TASK_BATCH_WINDOW > 0:
+        return await debit_batcher.debit(user_name, task_ids[0], cost)
 
-    # 2. Deduct user credits upon submission.
-    # For a fairer credit deduction implementation check the /fair_poll endpoint
     async with async_session() as session:
-        # 3. Trace task history for user
-        await session.execute(insert(UserTaskHistory).values(user_name=user.name, task_id=task.id, cost=API_COST))
+        result = await session.execute(debit_statement(user_name, task_ids[0], cost))
+        credits = result.scalar_one_or_none()
+
+        if credits is not None:
+            await session.commit()
 
-        # 4. Deduct user credits
-        await session.execute(update(User).where(User.name == user.name).values(credits=User.credits - API_COST))
+        return credits
 
-        # Commit changes
-        await session.commit()
 
-    return TaskResponseBase(task_id=task.id)
+async def refund_tasks(user_name: str, task_ids: list[str], cost: int):
+    """Revert the debit of tasks that were never published.
+
+    Args:
+        user_name (str): User that was debited.
+        task_ids (list[str]): Task IDs recorded in the user's history.
+        cost (int): Credits to give back per task.
+    """
+    _logger.error(f"Refunding {cost * len(task_ids)} credits to {user_name} for unpublished tasks {task_ids}")
+
+    if BILLING_MODE == "ledger":
+        await ledger.refund(user_name, task_ids, cost)
+        return
+
+    async with async_session() as session:
+        await session.execute(
+            delete(UserTaskHistory)
+            .where(UserTaskHistory.user_name == user_name, UserTaskHistory.task_id.in_(task_ids))
+        )
+        await session.execute(
+            update(User).where(User.name == user_name).values(credits=User.credits + cost * len(task_ids))
+        )
+        await session.commit()
 
 
-def poll_task_state(task_id: str) -> TaskStateResponse:
+async def poll_task_state(task_id: str) -> TaskStateResponse:
     """Poll task state.
 
+    Read through `results` rather than `AsyncResult`, which knows nothing about results packed
+    into buckets once delivered.
+
     Args:
         task_id (str): Celery Task ID.
 
@@ -63,49 +550,154 @@ def poll_task_state(task_id: str) -> TaskStateResponse:
         TaskStateResponse: The json includes the task ID itself, the state (SUCCESS, PENDING...)
         and if the task has completed successfully, the result will be part of the response.
     """
-    result = celery_instance.AsyncResult(task_id)
-    response = TaskStateResponse(task_id=task_id, state=result.state)
-    if result.ready():
-        response.result = result.result
-
-    return response
+    return (await results.fetch_states([task_id]))[0]
 
 
-async def fair_poll_task_state(user: User, task_id: str) -> TaskResponseBase:
-    """(Fair) Poll task state.
+async def wait_for_task_state(task_id: str, wait: float) -> TaskStateResponse:
+    """Long-poll task state.
 
-    The difference with the regular poll_task_state is that this function will only update the
-    user's credits if the task has completed successfully. If this is to be used, the credit
-    deduction should be removed from the create_addition_task function.
+    Holds on until the task has completed, successfully or not, or `wait` seconds have passed.
 
     Args:
-        user (User): User triggering the task.
         task_id (str): Celery Task ID.
+        wait (float): Maximum number of seconds to wait.
 
     Returns:
         TaskStateResponse: The json includes the task ID itself, the state (SUCCESS, PENDING...)
         and if the task has completed successfully, the result will be part of the response.
     """
-    task_state_response = poll_task_state(task_id)
+    return await results.wait_for_state(task_id, wait)
+
 
-    # 1. Make sure that the task has been completed and a result has been computed and only then,
-    if task_state_response.state is not None and task_state_response.state == "SUCCESS" and task_state_response.result is not None:
-        # 2. Update user credits
+async def get_streamed_task_ids(user: User, task_ids: list[str], group_id: str | None) -> list[str]:
+    """Resolve the tasks a state stream follows.
+
+    Task IDs and group IDs act as capabilities, like for polling. Without either, the user's
+    tasks submitted within `STREAM_HISTORY_WINDOW` are followed.
+
+    Args:
+        user (User): User opening the stream.
+        task_ids (list[str]): Explicitly requested Celery Task IDs.
+        group_id (str | None): Celery group ID whose tasks to follow.
+
+    Returns:
+        list[str]: Task IDs to follow.
+    """
+    task_ids = list(task_ids)
+
+    if group_id is not None:
+        group_result = await asyncio.to_thread(GroupResult.restore, group_id, app=celery_instance)
+        if group_result is None:
+            raise HTTPException(status_code=404, detail="Group not found.")
+        task_ids.extend(result.id for result in group_result.results)
+
+    if not task_ids:
+        since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=STREAM_HISTORY_WINDOW)
+        # Streams are typically opened right after submitting, and a lagging replica would
+        # miss exactly those tasks, so read from the primary
         async with async_session() as session:
-            user_task_result = await session.execute(select(UserTaskHistory).where(user_name=user.name, task_id=task_id))
-            user_task_trace = user_task_result.scalar_one_or_none()
-            if user_task_trace is not None:
-                await session.execute(update(User).where(User.name == user.name).values(credits=user.credits - user_task_trace.cost))
-            else:
-                _logger.error(f"No user task found for task {task_id}")
+            result = await session.execute(
+                select(UserTaskHistory.task_id)
+                .where(UserTaskHistory.user_name == user.name, UserTaskHistory.created_at >= since)
+                .order_by(UserTaskHistory.created_at.desc())
+                .limit(MAX_BATCH_SIZE)
+            )
+            task_ids = list(result.scalars().all())
 
-            # Commit changes
-            await session.commit()
-    return task_state_response
+    return list(dict.fromkeys(task_ids))[:MAX_BATCH_SIZE]
+
+
+def history_cursor(entry: UserTaskHistory) -> str:
+    """Encode the position of a task history entry as a page cursor."""
+    return f"{entry.created_at.isoformat()},{entry.task_id}"
+
+
+async def get_task_history(user: User,
+                           after: str | None = None,
+                           limit: int = HISTORY_PAGE_SIZE,
+                           since: datetime | None = None,
+                           until: datetime | None = None) -> list[UserTaskHistory]:
+    """Retrieve a page of a user's task history, newest first.
+
+    Pages are addressed by keyset on `(created_at, task_id)`, which the
+    `(user_name, created_at)` index serves directly. Date filters also restrict the query to
+    the monthly partitions they overlap.
+
+    Args:
+        user (User): User whose history to read.
+        after (str | None): Cursor of the last entry of the previous page, see `history_cursor`.
+        limit (int): Page size.
+        since (datetime | None): Only tasks submitted at or after this time.
+        until (datetime | None): Only tasks submitted before this time.
+    """
+    statement = (
+        select(UserTaskHistory)
+        .where(UserTaskHistory.user_name == user.name)
+        .order_by(UserTaskHistory.created_at.desc(), UserTaskHistory.task_id.desc())
+        .limit(limit)
+    )
+    if since is not None:
+        statement = statement.where(UserTaskHistory.created_at >= _to_naive_utc(since))
+    if until is not None:
+        statement = statement.where(UserTaskHistory.created_at < _to_naive_utc(until))
+    if after is not None:
+        try:
+            created_at, task_id = after.split(",", 1)
+            position = (_to_naive_utc(datetime.fromisoformat(created_at)), task_id)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor.")
+        statement = statement.where(tuple_(UserTaskHistory.created_at, UserTaskHistory.task_id) < position)
+
+    async with async_read_session() as session:
+        result = await session.execute(statement)
+        return result.scalars().all()
+
+
+async def poll_task_states(task_ids: list[str]) -> list[TaskStateResponse]:
+    """Poll the state of many tasks at once.
+
+    Args:
+        task_ids (list[str]): Celery Task IDs.
+
+    Returns:
+        list[TaskStateResponse]: States, and results of completed tasks, in the order of `task_ids`.
+    """
+    return await results.fetch_states(task_ids)
+
+
+async def poll_group_state(group_id: str) -> GroupStateResponse:
+    """Poll the state of every task of a group.
+
+    Args:
+        group_id (str): Celery group ID returned on batch submission.
+
+    Returns:
+        GroupStateResponse: The state, and result if available, of every task of the group.
+    """
+    group_result = await asyncio.to_thread(GroupResult.restore, group_id, app=celery_instance)
+    if group_result is None:
+        raise HTTPException(status_code=404, detail="Group not found.")
+
+    task_ids = [result.id for result in group_result.results]
+    return GroupStateResponse(group_id=group_id, tasks=await results.fetch_states(task_ids))
 
 
 async def get_user_credits(user_name: str) -> UserCreditsResponse:
-    async with async_session() as session:
+    if BILLING_MODE == "ledger":
+        credits = await ledger.get_credits(user_name)
+        if credits is None:
+            raise HTTPException(status_code=404, detail="User not found.")
+
+        return UserCreditsResponse(name=user_name, credits=credits)
+
+    if BILLING_MODE == "sharded":
+        credits = await credit_slots.get_credits(user_name)
+        if credits is None:
+            raise HTTPException(status_code=404, detail="User not found.")
+
+        return UserCreditsResponse(name=user_name, credits=credits)
+
+    async with async_read_session() as session:
         result = await session.execute(select(User).where(User.name == user_name))
         user = result.scalar_one_or_none()
 
@@ -116,11 +708,20 @@ async def get_user_credits(user_name: str) -> UserCreditsResponse:
 
 
 async def update_user_credits(user_name: str, additional_user_credits: int) -> UserCreditsResponse:
+    if BILLING_MODE == "ledger":
+        credits = await ledger.credit(user_name, additional_user_credits)
+        if credits is None:
+            raise HTTPException(status_code=404, detail="User not found.")
+
+        await auth.invalidate_user(await _get_api_key(user_name))
+
+        return UserCreditsResponse(name=user_name, credits=credits)
+
     async with async_session() as session:
         result = await session.execute(
             update(User).where(User.name == user_name)
             .values(credits=User.credits + additional_user_credits)
-            .returning(User.name, User.credits)
+            .returning(User.name, User.credits, User.api_key)
         )
 
         affected_user = result.fetchone()
@@ -128,6 +729,27 @@ async def update_user_credits(user_name: str, additional_user_credits: int) -> U
         if affected_user is None:
             raise HTTPException(status_code=404, detail="User not found.")
 
+        # Credits are added to `users.credits`, from where the rebalancer spreads them over the slots
+        credits = affected_user.credits
+        if BILLING_MODE == "sharded":
+            credits = (await session.execute(credit_slots.balance_statement(user_name))).scalar_one()
+
         await session.commit()
 
-        return UserCreditsResponse(name=affected_user.name, credits=affected_user.credits)
+    # Cached users carry their credits, so make sure no API process keeps serving the old value
+    await auth.invalidate_user(affected_user.api_key)
+
+    return UserCreditsResponse(name=affected_user.name, credits=credits)
+
+
+def _to_naive_utc(timestamp: datetime) -> datetime:
+    """Convert a timestamp to naive UTC, like the history stores it. Naive ones are taken as UTC."""
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+async def _get_api_key(user_name: str) -> str:
+    async with async_session() as session:
+        result = await session.execute(select(User.api_key).where(User.name == user_name))
+        return result.scalar_one()
@@ -0,0 +1,158 @@
+"""Settlement of task charges once tasks are done.
+
+In the `on_success` billing policy, the credits debited on submission are a hold. Workers
+append the outcome of every finished task to a Redis stream on the result backend, and a
+background task of every API process consumes that stream in batches:
+
+* successful tasks keep their charge,
+* failed tasks get their charge back,
+
+and both are stamped with `settled_at`. Only unsettled history rows are touched, which makes
+settling a batch again harmless. Polling never has to look at billing.
+"""
+import asyncio
+import logging
+import os
+import socket
+
+from celery import states
+from sqlalchemy import select, update, func, case, values, column, String, Boolean, Update
+
+import results
+from database.engine import async_session
+from database.models import User, UserTaskHistory
+
+_logger = logging.getLogger(__name__)
+
+SETTLEMENT_STREAM = "billing:outcomes"
+"""Redis stream of task outcomes waiting to be settled. Must match the worker."""
+
+SETTLEMENT_GROUP = "settlement"
+"""Consumer group shared by the settlement tasks of all API processes."""
+
+SETTLEMENT_BATCH_SIZE = int(os.getenv("SETTLEMENT_BATCH_SIZE", "500"))
+"""Maximum number of outcomes settled in one transaction."""
+
+SETTLEMENT_INTERVAL = float(os.getenv("SETTLEMENT_INTERVAL", "1.0"))
+"""Seconds the settlement task waits for new outcomes before checking again."""
+
+SETTLEMENT_RECLAIM_IDLE = float(os.getenv("SETTLEMENT_RECLAIM_IDLE", "30"))
+"""Seconds after which outcomes read but not acknowledged by a consumer are taken over."""
+
+
+def settle_statement(outcomes: list[tuple[str, bool]]) -> Update:
+    """Settle the charges of finished tasks and refund the failed ones per user.
+
+    Unsettled history rows are locked before being settled, so that concurrent settlements of
+    the same task settle it once.
+
+    Args:
+        outcomes (list[tuple[str, bool]]): `(task_id, succeeded)` per task.
+    """
+    outcome = values(column("task_id", String), column("succeeded", Boolean), name="outcomes").data(outcomes)
+    pending = (
+        select(UserTaskHistory.user_name, UserTaskHistory.task_id, UserTaskHistory.created_at,
+               UserTaskHistory.cost, outcome.c.succeeded)
+        .join(outcome, UserTaskHistory.task_id == outcome.c.task_id)
+        .where(UserTaskHistory.settled_at.is_(None))
+        .with_for_update(of=UserTaskHistory)
+        .cte("pending")
+    )
+    settled = (
+        update(UserTaskHistory)
+        .where(
+            UserTaskHistory.user_name == pending.c.user_name,
+            UserTaskHistory.task_id == pending.c.task_id,
+            UserTaskHistory.created_at == pending.c.created_at,
+        )
+        .values(settled_at=func.now(), cost=case((pending.c.succeeded, UserTaskHistory.cost), else_=0))
+        .returning(pending.c.user_name, pending.c.cost, pending.c.succeeded)
+        .cte("settled")
+    )
+    refunds = (
+        select(settled.c.user_name, func.sum(settled.c.cost).label("total"))
+        .where(settled.c.succeeded.is_(False))
+        .group_by(settled.c.user_name)
+        .cte("refunds")
+    )
+    return update(User).where(User.name == refunds.c.user_name).values(credits=User.credits + refunds.c.total)
+
+
+async def publish_outcomes(task_ids: list[str], state: str):
+    """Append the outcome of tasks finished without reaching a worker, e.g. memoized ones."""
+    async with results.instance.pipeline(transaction=False) as pipe:
+        for task_id in task_ids:
+            pipe.xadd(SETTLEMENT_STREAM, {"task": task_id, "state": state})
+        await pipe.execute()
+
+
+async def settle(entries: list[tuple[bytes, dict]]):
+    """Settle a batch of stream entries in one transaction and acknowledge them."""
+    outcomes = {}
+    for _, fields in entries:
+        outcomes[fields[b"task"].decode()] = fields[b"state"].decode() == states.SUCCESS
+
+    async with async_session() as session:
+        await session.execute(settle_statement(list(outcomes.items())))
+        await session.commit()
+
+    entry_ids = [entry_id for entry_id, _ in entries]
+    async with results.instance.pipeline(transaction=False) as pipe:
+        pipe.xack(SETTLEMENT_STREAM, SETTLEMENT_GROUP, *entry_ids)
+        pipe.xdel(SETTLEMENT_STREAM, *entry_ids)
+        await pipe.execute()
+
+    _logger.debug(f"Settled {len(outcomes)} tasks")
+
+
+async def reconcile(consumer: str):
+    """Take over and settle outcomes left unacknowledged by consumers that went away."""
+    start_id = "0-0"
+    while True:
+        response = await results.instance.xautoclaim(
+            SETTLEMENT_STREAM, SETTLEMENT_GROUP, consumer,
+            min_idle_time=int(SETTLEMENT_RECLAIM_IDLE * 1000),
+            start_id=start_id,
+            count=SETTLEMENT_BATCH_SIZE,
+        )
+        start_id = response[0]
+        entries = [entry for entry in response[1] if entry[1] is not None]
+        if entries:
+            _logger.warning(f"Reclaimed {len(entries)} unsettled task outcomes")
+            await settle(entries)
+        if start_id in (b"0-0", "0-0"):
+            return
+
+
+async def run(retry_interval: float = 1.0):
+    """Settle task outcomes for the lifetime of the application."""
+    consumer = f"{socket.gethostname()}-{os.getpid()}"
+
+    try:
+        await results.instance.xgroup_create(SETTLEMENT_STREAM, SETTLEMENT_GROUP, id="0", mkstream=True)
+    except Exception as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+    last_reconciled = 0.0
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            if loop.time() - last_reconciled >= SETTLEMENT_RECLAIM_IDLE:
+                await reconcile(consumer)
+                last_reconciled = loop.time()
+
+            response = await results.instance.xreadgroup(
+                SETTLEMENT_GROUP, consumer, {SETTLEMENT_STREAM: ">"},
+                count=SETTLEMENT_BATCH_SIZE,
+                block=int(SETTLEMENT_INTERVAL * 1000),
+            )
+            for _, entries in response:
+                if entries:
+                    await settle(entries)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Outcomes stay pending and are reclaimed once they are idle long enough
+            _logger.exception("Settlement failed, retrying")
+            await asyncio.sleep(retry_interval)
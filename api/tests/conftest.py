@@ -0,0 +1,18 @@
+import socket
+import threading
+
+import fakeredis
+import pytest
+
+
+@pytest.fixture
+def redis_server():
+    """Address of a fakeredis server reached over TCP, so that socket timeouts apply."""
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        address = probe.getsockname()
+    server = fakeredis.TcpFakeServer(address, server_type="redis")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield address
+    server.shutdown()
+    server.server_close()
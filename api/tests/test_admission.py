@@ -0,0 +1,80 @@
+from unittest.mock import patch
+
+import fakeredis
+import pytest
+from fastapi import HTTPException
+
+import admission
+from admission import QueueMonitor
+
+
+@pytest.fixture
+def token_buckets():
+    client = fakeredis.FakeAsyncRedis()
+    with patch("admission.cache_instance", client), \
+         patch("admission._TOKEN_BUCKET_SCRIPT", client.register_script(admission._TOKEN_BUCKET_SCRIPT.script)), \
+         patch("admission.RATE_LIMIT_PER_SECOND", 1.0), \
+         patch("admission.RATE_LIMIT_BURST", 2):
+        yield client
+
+
+def test_queue_monitor_estimates_drain_rate():
+    monitor = QueueMonitor(smoothing=1.0)
+
+    monitor.observe(1000, now=0.0)
+    monitor.observe(900, now=2.0)
+
+    assert monitor.drain_rate == 50
+    with patch("admission.ADMISSION_MAX_QUEUE_DEPTH", 500):
+        assert monitor.overloaded()
+        assert monitor.retry_after() == 8
+
+
+def test_queue_monitor_without_drain_backs_off_fully():
+    monitor = QueueMonitor()
+    monitor.observe(1000, now=0.0)
+
+    with patch("admission.ADMISSION_MAX_QUEUE_DEPTH", 500):
+        assert monitor.retry_after() == admission.ADMISSION_MAX_RETRY_AFTER
+
+
+def test_queue_monitor_unknown_depth_is_not_overloaded():
+    with patch("admission.ADMISSION_MAX_QUEUE_DEPTH", 500):
+        assert not QueueMonitor().overloaded()
+
+
+@pytest.mark.anyio
+async def test_admit_rejects_when_queues_are_overloaded():
+    monitor = QueueMonitor()
+    monitor.observe(1000, now=0.0)
+
+    with patch("admission.monitor", monitor), patch("admission.ADMISSION_MAX_QUEUE_DEPTH", 500):
+        with pytest.raises(HTTPException) as exc_info:
+            await admission.admit("test_user")
+
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.headers["Retry-After"] == str(admission.ADMISSION_MAX_RETRY_AFTER)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_admit_enforces_token_bucket(token_buckets):
+    await admission.admit("test_user")
+    await admission.admit("test_user")
+
+    with pytest.raises(HTTPException) as exc_info:
+        await admission.admit("test_user")
+
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.headers["Retry-After"] == "1"
+    # Buckets are per user
+    await admission.admit("other_user", 2)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_admit_rejects_batches_beyond_burst(token_buckets):
+    with pytest.raises(HTTPException) as exc_info:
+        await admission.admit("test_user", 3)
+
+    assert exc_info.value.status_code == 429
@@ -1,20 +1,30 @@
 import sys
+from datetime import datetime
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 
 # Mock redis before any app imports
 mock_redis = MagicMock()
-sys.modules["redis"] = mock_redis
 mock_redis_instance = MagicMock()
-mock_redis_instance.hget.return_value = None  # No cached user
-mock_redis.Redis.return_value = mock_redis_instance
+mock_redis_instance.hget = AsyncMock(return_value=None)  # No cached user
+mock_redis.asyncio.Redis.return_value = mock_redis_instance
+
+real_redis = sys.modules.get("redis")
+sys.modules["redis"] = mock_redis
 
 from fastapi.testclient import TestClient
 
 import auth
+import timing
 from api import app
-from models import UserResponseBase, TaskResponseBase, TaskStateResponse, UserCreditsResponse
+from models import UserResponseBase, TaskResponseBase, TaskStateResponse, UserCreditsResponse, BatchTaskResponse
+
+# Only the app modules keep the mock, so other test modules can still import the real redis
+if real_redis is None:
+    del sys.modules["redis"]
+else:
+    sys.modules["redis"] = real_redis
 
 
 @pytest.fixture
@@ -72,6 +82,29 @@ class TestGetUsers:
             assert len(data) == 2
             assert data[0]["name"] == "user1"
             assert data[1]["name"] == "user2"
+            assert "X-Next-Cursor" not in response.headers
+
+    def test_get_users_full_page_has_next_cursor(self, client):
+        with patch("api.service.get_all_users", new_callable=AsyncMock) as mock_get_all:
+            mock_get_all.return_value = [UserResponseBase(name="user1"), UserResponseBase(name="user2")]
+
+            response = client.get("/users?after=user0&limit=2")
+
+            assert response.status_code == 200
+            assert response.headers["X-Next-Cursor"] == "user2"
+            mock_get_all.assert_awaited_once_with("user0", 2)
+
+    def test_get_users_stream(self, client):
+        async def names(after):
+            for name in ["user1", "user2"]:
+                yield name
+
+        with patch("api.service.stream_user_names", names):
+            response = client.get("/users?stream=true")
+
+            assert response.status_code == 200
+            assert response.headers["content-type"] == "application/x-ndjson"
+            assert response.text == '{"name":"user1"}\n{"name":"user2"}\n'
 
 
 class TestCreateAdditionTask:
@@ -86,9 +119,59 @@ class TestCreateAdditionTask:
             assert data["task_id"] == "task-123"
 
 
+    def test_create_task_reports_server_timing(self, client_with_user):
+        async def create(user, x, y):
+            with timing.stage("debit"):
+                return TaskResponseBase(task_id="task-123")
+
+        with patch("api.service.create_addition_task", side_effect=create):
+            response = client_with_user.post("/task?x=5&y=3", headers={"Authorization": "Bearer test-api-key"})
+
+            assert response.status_code == 200
+            assert response.headers["Server-Timing"].startswith("debit;dur=")
+
+
+    def test_create_task_replays_idempotent_retry(self, client_with_user, mock_regular_user):
+        with patch("api.idempotency.submit_once", new_callable=AsyncMock) as mock_submit_once:
+            mock_submit_once.return_value = (TaskResponseBase(task_id="task-123"), True)
+
+            response = client_with_user.post(
+                "/task?x=5&y=3", headers={"Authorization": "Bearer test-api-key", "Idempotency-Key": "key-1"}
+            )
+
+            assert response.status_code == 200
+            assert response.json()["task_id"] == "task-123"
+            assert response.headers["Idempotent-Replayed"] == "true"
+            args = mock_submit_once.call_args.args
+            assert args[:4] == (mock_regular_user.name, "key-1", ["task", 5, 3], TaskResponseBase)
+
+
+class TestCreateAdditionTasks:
+    def test_create_tasks_success(self, client_with_user, mock_regular_user):
+        with patch("api.service.create_addition_tasks", new_callable=AsyncMock) as mock_create:
+            mock_create.return_value = BatchTaskResponse(task_ids=["task-1", "task-2"], group_id="group-123")
+
+            response = client_with_user.post(
+                "/tasks?group=true",
+                json=[{"x": 1, "y": 2}, {"x": 3, "y": 4}],
+                headers={"Authorization": "Bearer test-api-key"},
+            )
+
+            assert response.status_code == 200
+            data = response.json()
+            assert data["task_ids"] == ["task-1", "task-2"]
+            assert data["group_id"] == "group-123"
+            mock_create.assert_called_once_with(mock_regular_user, [(1, 2), (3, 4)], grouped=True)
+
+    def test_create_tasks_rejects_empty_batch(self, client_with_user):
+        response = client_with_user.post("/tasks", json=[], headers={"Authorization": "Bearer test-api-key"})
+
+        assert response.status_code == 422
+
+
 class TestPollTaskState:
     def test_poll_pending_task(self, client):
-        with patch("api.service.poll_task_state") as mock_poll:
+        with patch("api.service.poll_task_state", new_callable=AsyncMock) as mock_poll:
             mock_poll.return_value = TaskStateResponse(task_id="task-123", state="PENDING")
 
             response = client.get("/poll/task-123")
@@ -100,7 +183,7 @@ class TestPollTaskState:
             assert data["result"] is None
 
     def test_poll_completed_task(self, client):
-        with patch("api.service.poll_task_state") as mock_poll:
+        with patch("api.service.poll_task_state", new_callable=AsyncMock) as mock_poll:
             mock_poll.return_value = TaskStateResponse(task_id="task-123", state="SUCCESS", result=8)
 
             response = client.get("/poll/task-123")
@@ -111,6 +194,78 @@ class TestPollTaskState:
             assert data["state"] == "SUCCESS"
             assert data["result"] == 8
 
+    def test_long_poll_task(self, client):
+        with patch("api.service.wait_for_task_state", new_callable=AsyncMock) as mock_wait:
+            mock_wait.return_value = TaskStateResponse(task_id="task-123", state="SUCCESS", result=8)
+
+            response = client.get("/poll/task-123?wait=30")
+
+            assert response.status_code == 200
+            assert response.json()["result"] == 8
+            mock_wait.assert_called_once_with("task-123", 30)
+
+    def test_long_poll_wait_is_bounded(self, client):
+        response = client.get("/poll/task-123?wait=3600")
+
+        assert response.status_code == 422
+
+
+class TestPollTaskStates:
+    def test_poll_many_tasks(self, client):
+        with patch("api.service.poll_task_states", new_callable=AsyncMock) as mock_poll:
+            mock_poll.return_value = [
+                TaskStateResponse(task_id="task-1", state="SUCCESS", result=3),
+                TaskStateResponse(task_id="task-2", state="PENDING"),
+            ]
+
+            response = client.post("/poll", json=["task-1", "task-2"])
+
+            assert response.status_code == 200
+            data = response.json()
+            assert [task["state"] for task in data] == ["SUCCESS", "PENDING"]
+            assert data[0]["result"] == 3
+            mock_poll.assert_called_once_with(["task-1", "task-2"])
+
+
+class TestStreamTaskStates:
+    def test_stream_sends_states_as_server_sent_events(self, client_with_user, mock_regular_user):
+        async def fake_stream(task_ids, heartbeat):
+            yield TaskStateResponse(task_id="task-1", state="STARTED")
+            yield None
+            yield TaskStateResponse(task_id="task-1", state="SUCCESS", result=3)
+
+        with patch("api.service.get_streamed_task_ids", new_callable=AsyncMock) as mock_task_ids, \
+             patch("api.results.stream_states", fake_stream):
+            mock_task_ids.return_value = ["task-1"]
+
+            response = client_with_user.get("/stream?task_id=task-1", headers={"Authorization": "Bearer test-api-key"})
+
+            assert response.status_code == 200
+            assert response.headers["content-type"].startswith("text/event-stream")
+            events = response.text.split("\n\n")
+            assert events[0] == 'event: state\ndata: {"task_id":"task-1","state":"STARTED","result":null}'
+            assert events[1] == ": keep-alive"
+            assert events[3] == "event: end\ndata: {}"
+            mock_task_ids.assert_called_once_with(mock_regular_user, ["task-1"], None)
+
+
+class TestTaskHistory:
+    def test_task_history_full_page_has_next_cursor(self, client_with_user, mock_regular_user):
+        entry = MagicMock(task_id="task-1", cost=10, created_at=datetime(2026, 10, 17, 8))
+
+        with patch("api.service.get_task_history", new_callable=AsyncMock) as mock_history:
+            mock_history.return_value = [entry]
+
+            response = client_with_user.get(
+                "/history?limit=1&since=2026-10-01T00:00:00",
+                headers={"Authorization": "Bearer test-api-key"},
+            )
+
+            assert response.status_code == 200
+            assert response.json() == [{"task_id": "task-1", "cost": 10, "created_at": "2026-10-17T08:00:00"}]
+            assert response.headers["X-Next-Cursor"] == "2026-10-17T08:00:00,task-1"
+            mock_history.assert_awaited_once_with(mock_regular_user, None, 1, datetime(2026, 10, 1), None)
+
 
 class TestGetUserCredits:
     def test_get_credits_as_admin(self, client_with_admin):
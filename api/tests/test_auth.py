@@ -0,0 +1,268 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from redis import asyncio as aioredis
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+
+from auth import (
+    USERS_API_KEYS_CHANNEL,
+    USERS_CACHE_REGION,
+    USERS_INVALIDATION_CHANNEL,
+    announce_api_key,
+    build_api_keys_filter,
+    get_current_user,
+    invalidate_user,
+    listen_for_invalidations,
+    unknown_api_keys,
+    users_local_cache,
+)
+from cache import BloomFilter
+from models import CachedUserValue
+
+
+@pytest.fixture(autouse=True)
+def clear_local_cache():
+    users_local_cache.clear()
+    unknown_api_keys.clear()
+    yield
+    users_local_cache.clear()
+    unknown_api_keys.clear()
+
+
+def _credentials(token: str) -> HTTPAuthorizationCredentials:
+    return HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+
+
+@pytest.mark.anyio
+async def test_get_current_user_cache_hit():
+    cached = CachedUserValue(name="test_user", credits=500, api_key="test-api-key")
+
+    with patch("auth.cache_instance") as mock_cache, \
+         patch("auth.async_read_session") as mock_session:
+        mock_cache.hget = AsyncMock(return_value=cached.model_dump_json())
+
+        user = await get_current_user(_credentials("test-api-key"))
+
+        assert user == cached
+        mock_cache.hget.assert_awaited_once_with(USERS_CACHE_REGION, "test-api-key")
+        mock_session.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_get_current_user_local_cache_hit_skips_redis():
+    cached = CachedUserValue(name="test_user", credits=500, api_key="test-api-key")
+
+    with patch("auth.cache_instance") as mock_cache:
+        mock_cache.hget = AsyncMock(return_value=cached.model_dump_json())
+
+        await get_current_user(_credentials("test-api-key"))
+        user = await get_current_user(_credentials("test-api-key"))
+
+        assert user == cached
+        mock_cache.hget.assert_awaited_once()
+
+
+@pytest.mark.anyio
+async def test_get_current_user_cache_miss_populates_cache():
+    mock_user = MagicMock()
+    mock_user.name = "test_user"
+    mock_user.credits = 500
+    mock_user.api_key = "test-api-key"
+
+    with patch("auth.cache_instance") as mock_cache, \
+         patch("auth.async_read_session") as mock_session:
+        mock_cache.hget = AsyncMock(return_value=None)
+        mock_cache.hset = AsyncMock()
+        mock_ctx = AsyncMock()
+        mock_result = MagicMock()
+        mock_result.scalar_one_or_none.return_value = mock_user
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        user = await get_current_user(_credentials("test-api-key"))
+
+        assert user is mock_user
+        mock_cache.hset.assert_awaited_once()
+        assert mock_cache.hset.await_args.kwargs["key"] == "test-api-key"
+
+
+@pytest.mark.anyio
+async def test_get_current_user_unknown_token():
+    with patch("auth.cache_instance") as mock_cache, \
+         patch("auth.async_read_session") as mock_session:
+        mock_cache.hget = AsyncMock(return_value=None)
+        mock_ctx = AsyncMock()
+        mock_result = MagicMock()
+        mock_result.scalar_one_or_none.return_value = None
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        with pytest.raises(HTTPException) as exc_info:
+            await get_current_user(_credentials("unknown"))
+
+        assert exc_info.value.status_code == 401
+
+
+@pytest.mark.anyio
+async def test_invalidate_user_drops_local_entry_and_publishes():
+    users_local_cache.set("test-api-key", CachedUserValue(name="test_user", credits=500, api_key="test-api-key"))
+
+    with patch("auth.cache_instance", new_callable=MagicMock) as mock_cache:
+        mock_pipe = MagicMock()
+        mock_pipe.execute = AsyncMock()
+        mock_cache.pipeline.return_value.__aenter__.return_value = mock_pipe
+
+        await invalidate_user("test-api-key")
+
+        assert users_local_cache.get("test-api-key") is None
+        mock_pipe.hdel.assert_called_once_with(USERS_CACHE_REGION, "test-api-key")
+        mock_pipe.publish.assert_called_once_with(USERS_INVALIDATION_CHANNEL, "test-api-key")
+        mock_pipe.execute.assert_awaited_once()
+
+
+@pytest.mark.anyio
+async def test_get_current_user_unknown_token_is_not_looked_up_again():
+    with patch("auth.cache_instance") as mock_cache, \
+         patch("auth.async_read_session") as mock_session:
+        mock_cache.hget = AsyncMock(return_value=None)
+        mock_ctx = AsyncMock()
+        mock_result = MagicMock()
+        mock_result.scalar_one_or_none.return_value = None
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        for _ in range(3):
+            with pytest.raises(HTTPException) as exc_info:
+                await get_current_user(_credentials("unknown"))
+            assert exc_info.value.status_code == 401
+
+        mock_cache.hget.assert_awaited_once()
+        mock_ctx.execute.assert_awaited_once()
+
+
+def _mock_database_user(mock_session, user):
+    mock_ctx = AsyncMock()
+    mock_result = MagicMock()
+    mock_result.scalar_one_or_none.return_value = user
+    mock_ctx.execute = AsyncMock(return_value=mock_result)
+    mock_session.return_value.__aenter__.return_value = mock_ctx
+    return mock_ctx
+
+
+@pytest.mark.anyio
+async def test_get_current_user_looks_up_tokens_missing_from_filter():
+    api_keys = BloomFilter(100, 0.01)
+    new_user = CachedUserValue(name="new_user", credits=500, api_key="new-api-key")
+
+    with patch("auth.api_keys_filter", api_keys), \
+         patch("auth.cache_instance") as mock_cache, \
+         patch("auth.async_read_session") as mock_session:
+        mock_cache.hget = AsyncMock(return_value=None)
+        mock_cache.hset = AsyncMock()
+        _mock_database_user(mock_session, new_user)
+
+        user = await get_current_user(_credentials("new-api-key"))
+
+        assert user is new_user
+        assert "new-api-key" in api_keys
+
+
+@pytest.mark.anyio
+async def test_get_current_user_rejects_tokens_missing_from_filter_beyond_lookup_budget():
+    api_keys = BloomFilter(100, 0.01)
+
+    with patch("auth.api_keys_filter", api_keys), \
+         patch("auth.API_KEYS_FILTER_MISS_LOOKUPS", 1), \
+         patch("auth._filter_miss_tokens", 1.0), \
+         patch("auth._filter_miss_refilled_at", time.monotonic()), \
+         patch("auth.cache_instance") as mock_cache, \
+         patch("auth.async_read_session") as mock_session:
+        mock_cache.hget = AsyncMock(return_value=None)
+        mock_ctx = _mock_database_user(mock_session, None)
+
+        for token in ("unknown-1", "unknown-2"):
+            with pytest.raises(HTTPException) as exc_info:
+                await get_current_user(_credentials(token))
+            assert exc_info.value.status_code == 401
+
+        mock_cache.hget.assert_awaited_once_with(USERS_CACHE_REGION, "unknown-1")
+        mock_ctx.execute.assert_awaited_once()
+
+
+@pytest.mark.anyio
+async def test_get_current_user_without_lookup_budget_rejects_tokens_missing_from_filter():
+    api_keys = BloomFilter(100, 0.01)
+    api_keys.add("test-api-key")
+
+    with patch("auth.api_keys_filter", api_keys), \
+         patch("auth.API_KEYS_FILTER_MISS_LOOKUPS", 0), \
+         patch("auth.cache_instance") as mock_cache, \
+         patch("auth.async_read_session") as mock_session:
+        mock_cache.hget = AsyncMock(return_value=None)
+
+        with pytest.raises(HTTPException) as exc_info:
+            await get_current_user(_credentials("unknown"))
+
+        assert exc_info.value.status_code == 401
+        mock_cache.hget.assert_not_awaited()
+        mock_session.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_announce_api_key_lets_new_key_through():
+    api_keys = BloomFilter(100, 0.01)
+    unknown_api_keys.set("new-api-key", True)
+
+    with patch("auth.api_keys_filter", api_keys), \
+         patch("auth.cache_instance", new_callable=MagicMock) as mock_cache:
+        mock_cache.publish = AsyncMock()
+
+        await announce_api_key("new-api-key")
+
+        assert "new-api-key" in api_keys
+        assert unknown_api_keys.get("new-api-key") is None
+        mock_cache.publish.assert_awaited_once_with(USERS_API_KEYS_CHANNEL, "new-api-key")
+
+
+@pytest.mark.anyio
+async def test_build_api_keys_filter():
+    with patch("auth.async_read_session") as mock_session:
+        mock_ctx = AsyncMock()
+        mock_result = MagicMock()
+        mock_result.scalars.return_value.all.return_value = ["key-1", "key-2"]
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        api_keys = await build_api_keys_filter()
+
+        assert "key-1" in api_keys
+        assert "key-2" in api_keys
+        assert "key-3" not in api_keys
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_listen_for_invalidations_outlives_idle_socket_timeouts(redis_server):
+    host, port = redis_server
+    client = aioredis.Redis(host=host, port=port, socket_timeout=0.1, retry=Retry(NoBackoff(), 0))
+    with patch("auth.cache_instance", client), patch("auth._logger") as mock_logger:
+        listener = asyncio.create_task(listen_for_invalidations())
+        await asyncio.sleep(0.2)
+        users_local_cache.set("hot-key", "cached-user")
+        users_local_cache.set("stale-key", "cached-user")
+
+        # Idle for several socket timeouts
+        await asyncio.sleep(0.5)
+        await client.publish(USERS_INVALIDATION_CHANNEL, "stale-key")
+        await asyncio.sleep(0.2)
+        listener.cancel()
+
+        assert users_local_cache.get("hot-key") == "cached-user"
+        assert users_local_cache.get("stale-key") is None
+        mock_logger.exception.assert_not_called()
+    await client.aclose()
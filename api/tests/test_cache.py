@@ -0,0 +1,63 @@
+from unittest.mock import patch
+
+from cache import BloomFilter, LocalCache
+
+
+def test_local_cache_get_and_set():
+    local_cache = LocalCache("test", maxsize=2, ttl=60)
+    local_cache.set("a", 1)
+
+    assert local_cache.get("a") == 1
+    assert local_cache.get("b") is None
+
+
+def test_local_cache_evicts_least_recently_used():
+    local_cache = LocalCache("test", maxsize=2, ttl=60)
+    local_cache.set("a", 1)
+    local_cache.set("b", 2)
+    local_cache.get("a")
+    local_cache.set("c", 3)
+
+    assert len(local_cache) == 2
+    assert local_cache.get("a") == 1
+    assert local_cache.get("b") is None
+    assert local_cache.get("c") == 3
+
+
+def test_local_cache_expires_entries():
+    local_cache = LocalCache("test", maxsize=2, ttl=10)
+
+    with patch("cache.time.monotonic", return_value=100.0):
+        local_cache.set("a", 1)
+    with patch("cache.time.monotonic", return_value=111.0):
+        assert local_cache.get("a") is None
+
+    assert len(local_cache) == 0
+
+
+def test_local_cache_invalidate():
+    local_cache = LocalCache("test", maxsize=2, ttl=60)
+    local_cache.set("a", 1)
+    local_cache.invalidate("a")
+    local_cache.invalidate("missing")
+
+    assert local_cache.get("a") is None
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bloom_filter = BloomFilter(1000, 0.01)
+    keys = [f"key-{i}" for i in range(1000)]
+    for key in keys:
+        bloom_filter.add(key)
+
+    assert all(key in bloom_filter for key in keys)
+
+
+def test_bloom_filter_false_positive_rate():
+    bloom_filter = BloomFilter(1000, 0.01)
+    for i in range(1000):
+        bloom_filter.add(f"key-{i}")
+
+    false_positives = sum(f"other-{i}" in bloom_filter for i in range(10000))
+
+    assert false_positives < 300
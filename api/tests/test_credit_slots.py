@@ -0,0 +1,182 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from credit_slots import (
+    balance_statement,
+    debit,
+    rebalance,
+    rebalance_candidates_statement,
+    rebalance_user,
+    slot_debit_statement,
+)
+
+
+def _result(value=None, rows=None):
+    result = MagicMock()
+    result.scalar_one_or_none.return_value = value
+    result.scalars.return_value.all.return_value = rows or []
+    return result
+
+
+def _mock_session(mock_session, *results):
+    mock_ctx = AsyncMock()
+    mock_ctx.execute = AsyncMock(side_effect=list(results))
+    mock_session.return_value.__aenter__.return_value = mock_ctx
+    return mock_ctx
+
+
+def test_slot_debit_statement_skips_locked_slots():
+    sql = str(slot_debit_statement("test_user", ["task-1", "task-2"], 10, 3).compile(dialect=postgresql.dialect()))
+
+    assert sql.startswith("WITH debited AS")
+    assert "UPDATE user_credit_slots" in sql
+    assert "FOR UPDATE SKIP LOCKED" in sql
+    assert "INSERT INTO user_task_history" in sql
+
+
+def test_slot_debit_statement_can_wait_for_locked_slots():
+    sql = str(slot_debit_statement("test_user", ["task-1"], 10, 3, skip_locked=False).compile(
+        dialect=postgresql.dialect()
+    ))
+
+    assert "FOR UPDATE" in sql
+    assert "SKIP LOCKED" not in sql
+
+
+def test_balance_statement_adds_slots_to_users_credits():
+    sql = str(balance_statement("test_user").compile(dialect=postgresql.dialect()))
+
+    assert "users.credits + " in sql
+    assert "sum(user_credit_slots.credits)" in sql
+
+
+def test_rebalance_candidates_statement_folds_every_user_with_slots():
+    sql = str(rebalance_candidates_statement(0).compile(dialect=postgresql.dialect()))
+
+    assert "FROM users" not in sql
+    assert "GROUP BY user_credit_slots.user_name" in sql
+
+
+@pytest.mark.anyio
+async def test_debit_takes_a_free_slot():
+    with patch("credit_slots.async_session") as mock_session, \
+         patch("credit_slots._debit_across_slots", new_callable=AsyncMock) as mock_across:
+        mock_ctx = _mock_session(mock_session, _result(490))
+
+        assert await debit("test_user", ["task-123"], 10) == 490
+
+        mock_ctx.execute.assert_awaited_once()
+        mock_ctx.commit.assert_awaited_once()
+        mock_across.assert_not_awaited()
+
+
+@pytest.mark.anyio
+async def test_debit_waits_for_a_busy_slot():
+    with patch("credit_slots.async_session") as mock_session, \
+         patch("credit_slots.slot_debit_statement") as mock_statement, \
+         patch("credit_slots._debit_across_slots", new_callable=AsyncMock) as mock_across:
+        mock_ctx = _mock_session(mock_session, _result(None), _result(490))
+
+        assert await debit("test_user", ["task-123"], 10) == 490
+
+        assert mock_statement.call_args_list[1].kwargs == {"skip_locked": False}
+        mock_ctx.commit.assert_awaited_once()
+        mock_across.assert_not_awaited()
+
+
+@pytest.mark.anyio
+async def test_debit_falls_back_to_several_slots():
+    with patch("credit_slots.async_session") as mock_session, \
+         patch("credit_slots._debit_across_slots", new_callable=AsyncMock) as mock_across:
+        mock_ctx = _mock_session(mock_session, _result(None), _result(None))
+        mock_across.return_value = 5
+
+        assert await debit("test_user", ["task-123"], 10) == 5
+
+        mock_across.assert_awaited_once_with(mock_ctx, "test_user", ["task-123"], 10)
+        mock_ctx.commit.assert_awaited_once()
+
+
+@pytest.mark.anyio
+async def test_debit_insufficient_credits():
+    with patch("credit_slots.async_session") as mock_session, \
+         patch("credit_slots._debit_across_slots", new_callable=AsyncMock) as mock_across:
+        mock_ctx = _mock_session(mock_session, _result(None), _result(None))
+        mock_across.return_value = None
+
+        assert await debit("test_user", ["task-123"], 10) is None
+
+        mock_ctx.commit.assert_not_awaited()
+
+
+@pytest.mark.anyio
+async def test_rebalance_user_spreads_balance_over_slots():
+    with patch("credit_slots.async_session") as mock_session:
+        mock_ctx = _mock_session(mock_session, _result(100), _result(rows=[3, 0]), None, None, None)
+
+        await rebalance_user("test_user", 4)
+
+        home = str(mock_ctx.execute.call_args_list[0].args[0].compile(dialect=postgresql.dialect()))
+        assert home.startswith("SELECT users.credits") and home.endswith("FOR NO KEY UPDATE")
+        upsert = mock_ctx.execute.call_args_list[3].args[0]
+        params = upsert.compile(dialect=postgresql.dialect()).params
+        assert sorted(value for key, value in params.items() if key.startswith("credits")) == [25, 25, 25, 28]
+        assert "ON CONFLICT" in str(upsert.compile(dialect=postgresql.dialect()))
+        mock_ctx.commit.assert_awaited_once()
+
+
+@pytest.mark.anyio
+async def test_rebalance_user_folds_slots():
+    with patch("credit_slots.async_session") as mock_session:
+        mock_ctx = _mock_session(mock_session, _result(100), _result(rows=[3, 0]), None, None)
+
+        await rebalance_user("test_user", 0)
+
+        fold = mock_ctx.execute.call_args_list[2].args[0].compile(dialect=postgresql.dialect())
+        assert fold.params["credits"] == 103
+        assert str(mock_ctx.execute.call_args_list[3].args[0]).startswith("DELETE FROM user_credit_slots")
+        mock_ctx.commit.assert_awaited_once()
+
+
+@pytest.mark.anyio
+async def test_rebalance_user_ignores_missing_users():
+    with patch("credit_slots.async_session") as mock_session:
+        mock_ctx = _mock_session(mock_session, _result(None))
+
+        await rebalance_user("missing_user", 4)
+
+        mock_ctx.execute.assert_awaited_once()
+        mock_ctx.commit.assert_not_awaited()
+
+
+@pytest.mark.anyio
+async def test_rebalance_rebalances_candidates_under_advisory_lock():
+    locked, candidates = MagicMock(), MagicMock()
+    locked.scalar_one.return_value = True
+    candidates.scalars.return_value.all.return_value = ["user_a", "user_b"]
+
+    with patch("credit_slots.async_session") as mock_session, \
+         patch("credit_slots.rebalance_user", new_callable=AsyncMock) as mock_rebalance_user:
+        mock_ctx = _mock_session(mock_session, locked, candidates)
+
+        assert await rebalance(4) == 2
+
+        assert "pg_try_advisory_xact_lock" in str(mock_ctx.execute.call_args_list[0].args[0])
+        assert [call.args for call in mock_rebalance_user.await_args_list] == [("user_a", 4), ("user_b", 4)]
+
+
+@pytest.mark.anyio
+async def test_rebalance_skips_while_another_process_rebalances():
+    locked = MagicMock()
+    locked.scalar_one.return_value = False
+
+    with patch("credit_slots.async_session") as mock_session, \
+         patch("credit_slots.rebalance_user", new_callable=AsyncMock) as mock_rebalance_user:
+        mock_ctx = _mock_session(mock_session, locked)
+
+        assert await rebalance(4) == 0
+
+        mock_ctx.execute.assert_awaited_once()
+        mock_rebalance_user.assert_not_awaited()
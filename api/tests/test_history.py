@@ -0,0 +1,96 @@
+from datetime import date
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+
+from history import (
+    add_months,
+    create_partition_statement,
+    default_partition_holds_statement,
+    maintain_partitions,
+    partition_name,
+    split_default_partition_statements,
+)
+
+
+def test_add_months_wraps_years():
+    assert add_months(date(2026, 11, 1), 3) == date(2027, 2, 1)
+    assert add_months(date(2026, 1, 1), -1) == date(2025, 12, 1)
+
+
+def test_create_partition_statement():
+    statement = str(create_partition_statement(date(2026, 12, 1)))
+
+    assert statement == (
+        "CREATE TABLE IF NOT EXISTS user_task_history_202612 PARTITION OF user_task_history "
+        "FOR VALUES FROM ('2026-12-01') TO ('2027-01-01')"
+    )
+
+
+def _mock_database(mock_session, partitions: list[str], default_holds: set[str] = frozenset()):
+    async def execute(statement, *args):
+        result = MagicMock()
+        result.scalars.return_value.all.return_value = partitions
+        result.scalar_one.return_value = any(month in str(statement) for month in default_holds)
+        return result
+
+    mock_ctx = AsyncMock()
+    mock_ctx.execute = AsyncMock(side_effect=execute)
+    mock_session.return_value.__aenter__.return_value = mock_ctx
+    return mock_ctx
+
+
+@pytest.mark.anyio
+async def test_maintain_partitions_creates_ahead_and_drops_expired():
+    with patch("history.async_session") as mock_session, \
+         patch("history.HISTORY_PARTITIONS_AHEAD", 2), \
+         patch("history.HISTORY_RETENTION_MONTHS", 12):
+        mock_ctx = _mock_database(mock_session, [
+            "user_task_history_default",
+            "user_task_history_202509",
+            "user_task_history_202510",
+            "user_task_history_202611",
+        ])
+
+        dropped = await maintain_partitions(date(2026, 10, 17))
+
+        assert dropped == [partition_name(date(2025, 9, 1))]
+        statements = [str(call.args[0]) for call in mock_ctx.execute.await_args_list]
+        assert "pg_advisory_xact_lock" in statements[0]
+        assert [s for s in statements if s.startswith("CREATE")] == [
+            str(create_partition_statement(date(2026, month, 1))) for month in (10, 12)
+        ]
+        assert statements[-1] == "DROP TABLE user_task_history_202509"
+        mock_ctx.commit.assert_awaited_once()
+
+
+@pytest.mark.anyio
+async def test_maintain_partitions_moves_tasks_out_of_default_partition():
+    with patch("history.async_session") as mock_session, \
+         patch("history.HISTORY_PARTITIONS_AHEAD", 1), \
+         patch("history.HISTORY_RETENTION_MONTHS", 0):
+        mock_ctx = _mock_database(mock_session, ["user_task_history_default"], default_holds={"2026-10-01"})
+
+        await maintain_partitions(date(2026, 10, 17))
+
+        statements = [str(call.args[0]) for call in mock_ctx.execute.await_args_list]
+        assert statements[3:] == [
+            str(statement) for statement in split_default_partition_statements(date(2026, 10, 1))
+        ] + [
+            str(default_partition_holds_statement(date(2026, 11, 1))),
+            str(create_partition_statement(date(2026, 11, 1))),
+        ]
+        mock_ctx.commit.assert_awaited_once()
+
+
+def test_split_default_partition_statements():
+    statements = [str(statement) for statement in split_default_partition_statements(date(2026, 12, 1))]
+
+    assert statements[0] == "ALTER TABLE user_task_history DETACH PARTITION user_task_history_default"
+    assert statements[1] == str(create_partition_statement(date(2026, 12, 1)))
+    assert statements[2] == (
+        "WITH moved AS (DELETE FROM user_task_history_default "
+        "WHERE created_at >= '2026-12-01' AND created_at < '2027-01-01' RETURNING *) "
+        "INSERT INTO user_task_history_202612 SELECT * FROM moved"
+    )
+    assert statements[3] == "ALTER TABLE user_task_history ATTACH PARTITION user_task_history_default DEFAULT"
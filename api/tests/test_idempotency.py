@@ -0,0 +1,127 @@
+import asyncio
+import json
+from unittest.mock import AsyncMock, patch
+
+import fakeredis
+import pytest
+from fastapi import HTTPException
+
+import idempotency
+from idempotency import submit_once
+from models import TaskResponseBase
+
+
+@pytest.fixture
+def keys():
+    client = fakeredis.FakeAsyncRedis()
+    with patch("idempotency.cache_instance", client), \
+         patch("idempotency._SWAP_SCRIPT", client.register_script(idempotency._SWAP_SCRIPT.script)):
+        yield client
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_submit_once_replays_stored_response(keys):
+    submit = AsyncMock(return_value=TaskResponseBase(task_id="task-123"))
+
+    first = await submit_once("test_user", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+    retry = await submit_once("test_user", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+
+    assert first == (TaskResponseBase(task_id="task-123"), False)
+    assert retry == (TaskResponseBase(task_id="task-123"), True)
+    submit.assert_awaited_once()
+    assert 0 < await keys.ttl("idempotency:test_user:key-1") <= idempotency.IDEMPOTENCY_TTL
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_submit_once_without_key_always_submits(keys):
+    submit = AsyncMock(return_value=TaskResponseBase(task_id="task-123"))
+
+    await submit_once("test_user", None, ["task", 5, 3], TaskResponseBase, submit)
+    await submit_once("test_user", None, ["task", 5, 3], TaskResponseBase, submit)
+
+    assert submit.await_count == 2
+    assert await keys.dbsize() == 0
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_submit_once_scopes_keys_to_users(keys):
+    submit = AsyncMock(side_effect=[TaskResponseBase(task_id="task-1"), TaskResponseBase(task_id="task-2")])
+
+    await submit_once("user_a", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+    response, replayed = await submit_once("user_b", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+
+    assert response.task_id == "task-2"
+    assert not replayed
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_submit_once_rejects_retry_in_progress(keys):
+    marker = json.dumps({"fingerprint": idempotency.fingerprint(["task", 5, 3]), "token": "other"})
+    await keys.set("idempotency:test_user:key-1", marker)
+    submit = AsyncMock()
+
+    with pytest.raises(HTTPException) as exc_info:
+        await submit_once("test_user", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+
+    assert exc_info.value.status_code == 409
+    assert exc_info.value.headers["Retry-After"] == "1"
+    submit.assert_not_awaited()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_submit_once_rejects_key_reused_for_other_request(keys):
+    submit = AsyncMock(return_value=TaskResponseBase(task_id="task-123"))
+    await submit_once("test_user", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await submit_once("test_user", "key-1", ["task", 5, 4], TaskResponseBase, submit)
+
+    assert exc_info.value.status_code == 422
+    submit.assert_awaited_once()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_submit_once_gives_up_key_of_failed_submission(keys):
+    submit = AsyncMock(side_effect=[HTTPException(status_code=403), TaskResponseBase(task_id="task-123")])
+
+    with pytest.raises(HTTPException):
+        await submit_once("test_user", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+    assert not await keys.exists("idempotency:test_user:key-1")
+
+    response, replayed = await submit_once("test_user", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+
+    assert response.task_id == "task-123"
+    assert not replayed
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_submit_once_keeps_key_claimed_by_another_submission(keys):
+    async def submit():
+        # The marker expired during the submission and a retry claimed the key
+        await keys.set("idempotency:test_user:key-1", "claimed")
+        return TaskResponseBase(task_id="task-123")
+
+    await submit_once("test_user", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+
+    assert await keys.get("idempotency:test_user:key-1") == b"claimed"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_submit_once_keeps_key_of_cancelled_submission(keys):
+    submit = AsyncMock(side_effect=asyncio.CancelledError)
+
+    with pytest.raises(asyncio.CancelledError):
+        await submit_once("test_user", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+
+    assert 0 < await keys.ttl("idempotency:test_user:key-1") <= idempotency.IDEMPOTENCY_LOCK_TTL
+    with pytest.raises(HTTPException) as exc_info:
+        await submit_once("test_user", "key-1", ["task", 5, 3], TaskResponseBase, submit)
+    assert exc_info.value.status_code == 409
@@ -0,0 +1,105 @@
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from ledger import (
+    INSUFFICIENT_CREDITS,
+    LEDGER_GROUP,
+    LEDGER_STREAM,
+    MISSING_BALANCE,
+    debit,
+    flush,
+    history_debit_statement,
+    history_refund_statement,
+)
+
+
+@pytest.mark.anyio
+async def test_debit_returns_new_balance():
+    with patch("ledger._DEBIT_SCRIPT", new_callable=AsyncMock) as mock_script, \
+         patch("ledger._load", new_callable=AsyncMock) as mock_load:
+        mock_script.return_value = 490
+
+        assert await debit("test_user", ["task-123"], 10) == 490
+
+        mock_load.assert_not_called()
+        args = mock_script.await_args.kwargs["args"]
+        assert args[:2] == ["test_user", 10]
+        assert args[3:] == ["task-123"]
+
+
+@pytest.mark.anyio
+async def test_debit_loads_missing_balance_and_retries():
+    with patch("ledger._DEBIT_SCRIPT", new_callable=AsyncMock) as mock_script, \
+         patch("ledger._load", new_callable=AsyncMock) as mock_load:
+        mock_script.side_effect = [MISSING_BALANCE, 490]
+        mock_load.return_value = True
+
+        assert await debit("test_user", ["task-123"], 10) == 490
+
+        mock_load.assert_awaited_once_with("test_user")
+        assert mock_script.await_count == 2
+
+
+@pytest.mark.anyio
+async def test_debit_insufficient_credits():
+    with patch("ledger._DEBIT_SCRIPT", new_callable=AsyncMock) as mock_script:
+        mock_script.return_value = INSUFFICIENT_CREDITS
+
+        assert await debit("test_user", ["task-123"], 10) is None
+
+
+@pytest.mark.anyio
+async def test_debit_unknown_user():
+    with patch("ledger._DEBIT_SCRIPT", new_callable=AsyncMock) as mock_script, \
+         patch("ledger._load", new_callable=AsyncMock) as mock_load:
+        mock_script.return_value = MISSING_BALANCE
+        mock_load.return_value = False
+
+        assert await debit("nonexistent", ["task-123"], 10) is None
+        mock_script.assert_awaited_once()
+
+
+@pytest.mark.anyio
+async def test_flush_writes_batch_and_acknowledges_entries():
+    entries = [
+        (b"1-0", {b"op": b"debit", b"user": b"test_user", b"task": b"task-1", b"cost": b"10",
+                  b"ts": b"2026-01-01T00:00:00"}),
+        (b"1-1", {b"op": b"refund", b"user": b"test_user", b"task": b"task-1"}),
+    ]
+
+    with patch("ledger.async_session") as mock_session, \
+         patch("ledger.cache_instance", new_callable=MagicMock) as mock_cache:
+        mock_ctx = AsyncMock()
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+        mock_pipe = MagicMock()
+        mock_pipe.execute = AsyncMock()
+        mock_cache.pipeline.return_value.__aenter__.return_value = mock_pipe
+
+        await flush(entries)
+
+        assert mock_ctx.execute.await_count == 3
+        lock = str(mock_ctx.execute.call_args_list[0].args[0].compile(dialect=postgresql.dialect()))
+        assert lock.endswith("ORDER BY users.name FOR NO KEY UPDATE")
+        mock_ctx.commit.assert_awaited_once()
+        mock_pipe.xack.assert_called_once_with(LEDGER_STREAM, LEDGER_GROUP, b"1-0", b"1-1")
+        mock_pipe.xdel.assert_called_once_with(LEDGER_STREAM, b"1-0", b"1-1")
+
+
+def test_history_debit_statement_skips_replayed_rows():
+    rows = [dict(user_name="test_user", task_id="task-1", cost=10, created_at=None)]
+    sql = str(history_debit_statement(rows).compile(dialect=postgresql.dialect()))
+
+    assert "ON CONFLICT DO NOTHING" in sql
+    assert "NOT (EXISTS (SELECT ledger_refunds.task_id" in sql
+    assert "UPDATE users SET credits=(users.credits - totals.total) FROM totals" in sql
+
+
+def test_history_refund_statement_remembers_refunds_before_deleting():
+    sql = str(history_refund_statement([("test_user", "task-1")]).compile(dialect=postgresql.dialect()))
+
+    assert sql.startswith("WITH remembered AS \n(INSERT INTO ledger_refunds")
+    assert "ON CONFLICT DO NOTHING RETURNING ledger_refunds.user_name, ledger_refunds.task_id" in sql
+    assert "IN (SELECT remembered.user_name, remembered.task_id" in sql
+    assert "UPDATE users SET credits=(users.credits + totals.total) FROM totals" in sql
@@ -0,0 +1,49 @@
+import importlib
+from unittest.mock import patch
+
+import fakeredis
+import pytest
+
+import memo
+from celery_app import instance as celery_instance
+from memo import FOLLOW, HIT, LEAD, claim, memo_key, release
+
+
+@pytest.fixture
+def result_backend():
+    with patch("results.instance", fakeredis.FakeAsyncRedis()) as client:
+        # Register the scripts with a real client, even if the module was imported with redis mocked
+        importlib.reload(memo)
+        yield client
+
+
+def test_memo_key_is_deterministic():
+    assert memo_key("worker.add", [1, 2]) == memo_key("worker.add", [1, 2])
+    assert memo_key("worker.add", [1, 2]) != memo_key("worker.add", [2, 1])
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_claim_leads_then_follows(result_backend):
+    assert await claim("worker.add", [1, 2], "task-1") == (LEAD, None)
+    assert await claim("worker.add", [1, 2], "task-2") == (FOLLOW, "task-1")
+    assert await claim("worker.add", [2, 1], "task-3") == (LEAD, None)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_claim_serves_memoized_result(result_backend):
+    await result_backend.set(f"{memo_key('worker.add', [1, 2])}:result", celery_instance.backend.encode(3))
+
+    assert await claim("worker.add", [1, 2], "task-1") == (HIT, 3)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_release_hands_back_followers(result_backend):
+    await claim("worker.add", [1, 2], "task-1")
+    await claim("worker.add", [1, 2], "task-2")
+
+    assert await release("worker.add", [1, 2], "task-2") == []
+    assert await release("worker.add", [1, 2], "task-1") == ["task-2"]
+    assert await claim("worker.add", [1, 2], "task-3") == (LEAD, None)
@@ -0,0 +1,67 @@
+import threading
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from publisher import PUBLISH_PENDING, send_task, send_tasks
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_send_task_publishes_off_the_event_loop():
+    publishing_threads = []
+
+    def fake_send_task(name, args=None, task_id=None):
+        publishing_threads.append(threading.current_thread())
+        result = MagicMock()
+        result.id = task_id
+        return result
+
+    with patch("publisher.celery_instance") as mock_celery:
+        mock_celery.send_task.side_effect = fake_send_task
+
+        task_id = await send_task("worker.add", args=[5, 3], task_id="task-123")
+
+        assert task_id == "task-123"
+        mock_celery.send_task.assert_called_once_with("worker.add", args=[5, 3], task_id="task-123")
+        assert publishing_threads[0] is not threading.current_thread()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_send_task_releases_pending_gauge_on_failure():
+    with patch("publisher.celery_instance") as mock_celery:
+        mock_celery.send_task.side_effect = ConnectionError("broker down")
+        pending = PUBLISH_PENDING._value.get()
+
+        with pytest.raises(ConnectionError):
+            await send_task("worker.add", args=[5, 3])
+
+        assert PUBLISH_PENDING._value.get() == pending
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_send_tasks_shares_one_producer():
+    with patch("publisher.celery_instance") as mock_celery:
+        producer = mock_celery.producer_or_acquire.return_value.__enter__.return_value
+
+        group_id = await send_tasks("worker.add", [([1, 2], "task-1"), ([3, 4], "task-2")])
+
+        assert group_id is None
+        assert mock_celery.send_task.call_count == 2
+        assert all(call.kwargs["producer"] is producer for call in mock_celery.send_task.call_args_list)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_send_tasks_as_group_saves_group_result():
+    with patch("publisher.celery_instance"), \
+         patch("publisher.group") as mock_group:
+        group_result = mock_group.return_value.apply_async.return_value
+        group_result.id = "group-123"
+
+        group_id = await send_tasks("worker.add", [([1, 2], "task-1")], grouped=True)
+
+        assert group_id == "group-123"
+        group_result.save.assert_called_once()
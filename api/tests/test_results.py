@@ -0,0 +1,224 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import fakeredis
+import pytest
+from redis import asyncio as aioredis
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+
+from celery_app import instance as celery_instance
+from results import (
+    fetch_states,
+    notifier,
+    pack_meta,
+    sample_memory,
+    stream_states,
+    unpack_meta,
+    wait_for_state,
+    RESULT_TASK_BYTES,
+    RESULT_USED_MEMORY,
+)
+
+
+@pytest.fixture
+def result_backend():
+    server = fakeredis.FakeServer()
+    backend = celery_instance.backend
+    client = fakeredis.FakeRedis(server=server)
+
+    # Store results the way the worker does
+    with patch.object(type(backend), "client", client):
+        backend.store_result("task-1", 3, "SUCCESS")
+        backend.store_result("task-2", None, "STARTED")
+
+    yield fakeredis.FakeAsyncRedis(server=server)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_fetch_states_in_order(result_backend):
+    with patch("results.instance", result_backend):
+        states = await fetch_states(["task-2", "unknown", "task-1"])
+
+    assert [(state.task_id, state.state, state.result) for state in states] == [
+        ("task-2", "STARTED", None),
+        ("unknown", "PENDING", None),
+        ("task-1", "SUCCESS", 3),
+    ]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_fetch_states_splits_large_requests(result_backend):
+    with patch("results.instance", result_backend), \
+         patch("results.RESULTS_MGET_CHUNK_SIZE", 2):
+        states = await fetch_states(["task-1", "task-2", "task-1", "unknown", "task-2"])
+
+    assert [state.state for state in states] == ["SUCCESS", "STARTED", "SUCCESS", "PENDING", "STARTED"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_fetch_states_shortens_ttl_of_delivered_results(result_backend):
+    key = celery_instance.backend.get_key_for_task("task-1")
+    with patch("results.instance", result_backend), \
+         patch("results.RESULT_DELIVERED_TTL", 60):
+        await fetch_states(["task-1", "task-2"])
+
+    assert 0 < await result_backend.ttl(key) <= 60
+    assert await result_backend.ttl(celery_instance.backend.get_key_for_task("task-2")) > 60
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_fetch_states_packs_delivered_results_into_buckets(result_backend):
+    with patch("results.instance", result_backend), \
+         patch("results.RESULT_BUCKETS", 4):
+        first = await fetch_states(["task-1", "task-2"])
+        assert not await result_backend.exists(celery_instance.backend.get_key_for_task("task-1"))
+        assert await result_backend.exists(celery_instance.backend.get_key_for_task("task-2"))
+
+        second = await fetch_states(["task-1", "task-2"])
+
+    assert first == second
+    assert [(state.state, state.result) for state in second] == [("SUCCESS", 3), ("STARTED", None)]
+
+
+def test_pack_meta_is_compact():
+    packed = pack_meta({"status": "SUCCESS", "result": 8, "traceback": None, "children": []})
+
+    assert len(packed) == 3
+    assert unpack_meta(packed) == {"status": "SUCCESS", "result": 8}
+    assert unpack_meta(pack_meta({"status": "FAILURE", "result": {"exc_type": "ValueError"}})) == {
+        "status": "FAILURE", "result": None,
+    }
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_sample_memory_sets_bytes_per_task():
+    pipe = MagicMock()
+    pipe.execute = AsyncMock(return_value=[{"used_memory": 4096}, 200, 100, 300, 10])
+    client = MagicMock()
+    client.scan = AsyncMock(return_value=(0, [b"celery-task-meta-1", b"celery-task-meta-2"]))
+    client.pipeline.return_value.__aenter__ = AsyncMock(return_value=pipe)
+    client.pipeline.return_value.__aexit__ = AsyncMock(return_value=False)
+
+    with patch("results.instance", client), \
+         patch("results.RESULT_BUCKETS", 1):
+        await sample_memory()
+
+    assert RESULT_USED_MEMORY._value.get() == 4096
+    assert RESULT_TASK_BYTES.labels(storage="key")._value.get() == 150
+    assert RESULT_TASK_BYTES.labels(storage="bucket")._value.get() == 30
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_wait_for_state_returns_ready_state_immediately(result_backend):
+    with patch("results.instance", result_backend):
+        state = await wait_for_state("task-1", timeout=5)
+
+    assert (state.state, state.result) == ("SUCCESS", 3)
+    assert not notifier._subscribers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_wait_for_state_wakes_up_on_notification(result_backend):
+    with patch("results.instance", result_backend):
+        waiter = asyncio.create_task(wait_for_state("task-2", timeout=5))
+        await asyncio.sleep(0.05)
+
+        notifier.publish("task-2", {"status": "STARTED", "result": None})
+        notifier.publish("task-2", {"status": "SUCCESS", "result": 7})
+        state = await asyncio.wait_for(waiter, timeout=1)
+
+    assert (state.state, state.result) == ("SUCCESS", 7)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_wait_for_state_times_out_with_latest_state(result_backend):
+    with patch("results.instance", result_backend):
+        state = await wait_for_state("task-2", timeout=0.05)
+
+    assert state.state == "STARTED"
+    assert not notifier._subscribers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_notifier_wakes_waiters_on_stored_results():
+    server = fakeredis.FakeServer()
+    backend = celery_instance.backend
+
+    with patch("results.instance", fakeredis.FakeAsyncRedis(server=server)), \
+         patch.object(type(backend), "client", fakeredis.FakeRedis(server=server)):
+        listener = asyncio.create_task(notifier.run())
+        waiter = asyncio.create_task(wait_for_state("task-3", timeout=5))
+        await asyncio.sleep(0.1)
+
+        await asyncio.to_thread(backend.store_result, "task-3", 11, "SUCCESS")
+        state = await asyncio.wait_for(waiter, timeout=2)
+        listener.cancel()
+
+    assert (state.state, state.result) == ("SUCCESS", 11)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_notifier_outlives_idle_socket_timeouts(redis_server):
+    host, port = redis_server
+    client = aioredis.Redis(host=host, port=port, socket_timeout=0.1, retry=Retry(NoBackoff(), 0))
+    queue = notifier.subscribe("task-4")
+
+    with patch("results.instance", client), patch("results._logger") as mock_logger:
+        listener = asyncio.create_task(notifier.run())
+        # Idle for several socket timeouts
+        await asyncio.sleep(0.6)
+        listener.cancel()
+
+    notifier.unsubscribe("task-4", queue)
+    await client.aclose()
+
+    # Only the subscription being established asks to re-read the state
+    assert queue.qsize() == 1
+    assert queue.get_nowait() == ("task-4", None)
+    mock_logger.exception.assert_not_called()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_stream_states_yields_transitions_until_ready(result_backend):
+    async def collect():
+        return [state async for state in stream_states(["task-1", "task-2"], heartbeat=5)]
+
+    with patch("results.instance", result_backend):
+        stream = asyncio.create_task(collect())
+        await asyncio.sleep(0.05)
+
+        notifier.publish("task-2", {"status": "STARTED", "result": None})  # Unchanged, not repeated
+        notifier.publish("task-2", {"status": "SUCCESS", "result": 5})
+        streamed = await asyncio.wait_for(stream, timeout=1)
+
+    assert [(state.task_id, state.state) for state in streamed] == [
+        ("task-1", "SUCCESS"),
+        ("task-2", "STARTED"),
+        ("task-2", "SUCCESS"),
+    ]
+    assert not notifier._subscribers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_stream_states_sends_heartbeats(result_backend):
+    with patch("results.instance", result_backend):
+        stream = stream_states(["task-2"], heartbeat=0.01)
+
+        assert (await anext(stream)).state == "STARTED"
+        assert await anext(stream) is None
+        await stream.aclose()
+
+    assert not notifier._subscribers
@@ -0,0 +1,71 @@
+from unittest.mock import patch
+
+import fakeredis
+import pytest
+
+import routing
+from celery_app import TASK_BULK_QUEUE
+
+
+@pytest.fixture
+def counters():
+    client = fakeredis.FakeAsyncRedis()
+    with patch("routing.cache_instance", client), \
+         patch("routing.TASK_QUEUE_SHARDS", 8):
+        yield client
+
+
+@pytest.mark.anyio
+async def test_route_is_empty_without_shards():
+    with patch("routing.TASK_QUEUE_SHARDS", 0):
+        assert await routing.route("test_user") == {}
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_route_is_stable_per_user(counters):
+    assert await routing.route("test_user") == await routing.route("test_user")
+    assert routing.queue_for("test_user").startswith("tasks.")
+    assert int(routing.queue_for("test_user").split(".")[1]) in range(8)
+
+
+def test_route_spreads_users_over_shards():
+    with patch("routing.TASK_QUEUE_SHARDS", 8):
+        assert len({routing.queue_for(f"user-{i}") for i in range(100)}) == 8
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_route_uses_user_priority(counters):
+    with patch("routing.TASK_USER_PRIORITIES", {"paying_user": 5}), \
+         patch("routing.TASK_DEFAULT_PRIORITY", 1):
+        assert (await routing.route("paying_user"))["priority"] == 5
+        assert (await routing.route("test_user"))["priority"] == 1
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_route_sends_floods_to_bulk_queue(counters):
+    with patch("routing.TASK_BULK_THRESHOLD", 3):
+        queues = [(await routing.route("flooder"))["queue"] for _ in range(5)]
+
+        assert queues[:3] == [routing.queue_for("flooder")] * 3
+        assert queues[3:] == [TASK_BULK_QUEUE] * 2
+        assert (await routing.route("test_user"))["queue"] == routing.queue_for("test_user")
+        assert 0 < await counters.ttl("bulk:flooder") <= routing.TASK_BULK_WINDOW
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_route_sends_large_batches_to_bulk_queue(counters):
+    with patch("routing.TASK_BULK_THRESHOLD", 3):
+        assert (await routing.route("test_user", 4))["queue"] == TASK_BULK_QUEUE
+
+
+@pytest.mark.anyio
+async def test_route_without_bulk_threshold_skips_redis():
+    with patch("routing.TASK_QUEUE_SHARDS", 8), \
+         patch("routing.TASK_BULK_THRESHOLD", 0), \
+         patch("routing.cache_instance") as mock_cache:
+        assert (await routing.route("test_user", 1000))["queue"] == routing.queue_for("test_user")
+        mock_cache.pipeline.assert_not_called()
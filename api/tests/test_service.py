@@ -1,11 +1,25 @@
+import asyncio
+from datetime import datetime
 from unittest.mock import AsyncMock, MagicMock, patch
 
 import pytest
 from fastapi import HTTPException
+from sqlalchemy.dialects import postgresql
 
 from database.models import User
+from models import TaskStateResponse
 from service import (
+    API_COST,
+    get_streamed_task_ids,
+    create_addition_tasks,
+    poll_group_state,
+    DebitBatcher,
+    AdditionBatcher,
+    batch_debit_statement,
+    debit_statement,
     get_all_users,
+    get_task_history,
+    stream_user_names,
     create_addition_task,
     poll_task_state,
     get_user_credits,
@@ -27,7 +41,7 @@ async def test_get_all_users():
     mock_user = MagicMock()
     mock_user.name = "test_user"
 
-    with patch("service.async_session") as mock_session:
+    with patch("service.async_read_session") as mock_session:
         mock_ctx = AsyncMock()
         mock_result = MagicMock()
         mock_result.scalars.return_value.all.return_value = [mock_user]
@@ -40,72 +54,217 @@ async def test_get_all_users():
         assert result[0].name == "test_user"
 
 
+@pytest.mark.anyio
+async def test_get_all_users_pages_by_keyset():
+    with patch("service.async_read_session") as mock_session:
+        mock_ctx = AsyncMock()
+        mock_ctx.execute = AsyncMock(return_value=MagicMock())
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        await get_all_users(after="user1", limit=2)
+
+        compiled = mock_ctx.execute.await_args.args[0].compile(dialect=postgresql.dialect())
+        assert "WHERE users.name > %(name_1)s::VARCHAR ORDER BY users.name" in str(compiled)
+        assert compiled.params == {"name_1": "user1", "param_1": 2}
+
+
+@pytest.mark.anyio
+async def test_stream_user_names():
+    async def names():
+        for name in ["user1", "user2"]:
+            yield name
+
+    with patch("service.async_read_session") as mock_session:
+        mock_ctx = AsyncMock()
+        mock_ctx.stream_scalars = AsyncMock(return_value=names())
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        assert [name async for name in stream_user_names()] == ["user1", "user2"]
+
+
 @pytest.mark.anyio
 async def test_create_addition_task_success(mock_user):
-    with patch("service.celery_instance") as mock_celery, \
+    with patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task, \
          patch("service.async_session") as mock_session:
-        mock_task = MagicMock()
-        mock_task.id = "task-123"
-        mock_celery.send_task.return_value = mock_task
-
         mock_ctx = AsyncMock()
-        mock_ctx.execute = AsyncMock()
+        mock_result = MagicMock()
+        mock_result.scalar_one_or_none.return_value = 490
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
         mock_ctx.commit = AsyncMock()
         mock_session.return_value.__aenter__.return_value = mock_ctx
 
         result = await create_addition_task(mock_user, 5, 3)
 
-        assert result.task_id == "task-123"
-        mock_celery.send_task.assert_called_once_with("worker.add", args=[5, 3])
+        assert result.task_id
+        mock_ctx.execute.assert_awaited_once()
+        mock_ctx.commit.assert_awaited_once()
+        mock_send_task.assert_awaited_once_with("worker.add", args=[5, 3], task_id=result.task_id)
 
 
 @pytest.mark.anyio
 async def test_create_addition_task_insufficient_credits(mock_user):
-    mock_user.credits = 5  # Less than API_COST
+    with patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task, \
+         patch("service.async_session") as mock_session:
+        mock_ctx = AsyncMock()
+        mock_result = MagicMock()
+        mock_result.scalar_one_or_none.return_value = None  # Conditional debit matched no row
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
 
-    with pytest.raises(HTTPException) as exc_info:
-        await create_addition_task(mock_user, 5, 3)
+        with pytest.raises(HTTPException) as exc_info:
+            await create_addition_task(mock_user, 5, 3)
 
-    assert exc_info.value.status_code == 403
-    assert exc_info.value.detail == "Insufficient credits"
+        assert exc_info.value.status_code == 403
+        assert exc_info.value.detail == "Insufficient credits"
+        mock_ctx.commit.assert_not_called()
+        mock_send_task.assert_not_called()
 
 
-def test_poll_task_state_pending():
-    with patch("service.celery_instance") as mock_celery:
+@pytest.mark.anyio
+async def test_create_addition_task_refunds_when_publish_fails(mock_user):
+    with patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task, \
+         patch("service.async_session") as mock_session, \
+         patch("service.refund_tasks", new_callable=AsyncMock) as mock_refund:
+        mock_ctx = AsyncMock()
         mock_result = MagicMock()
-        mock_result.state = "PENDING"
-        mock_result.ready.return_value = False
-        mock_celery.AsyncResult.return_value = mock_result
+        mock_result.scalar_one_or_none.return_value = 490
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+        mock_send_task.side_effect = ConnectionError("broker down")
 
-        result = poll_task_state("task-123")
+        with pytest.raises(ConnectionError):
+            await create_addition_task(mock_user, 5, 3)
 
-        assert result.task_id == "task-123"
-        assert result.state == "PENDING"
-        assert result.result is None
+        task_id = mock_send_task.call_args.kwargs["task_id"]
+        mock_refund.assert_awaited_once_with("test_user", [task_id], API_COST)
+
+
+def test_debit_statement_is_a_single_conditional_statement():
+    sql = str(debit_statement("test_user", "task-123", API_COST).compile(dialect=postgresql.dialect()))
 
+    assert sql.startswith("WITH debited AS")
+    assert "users.credits >= " in sql
+    assert "INSERT INTO user_task_history" in sql
 
-def test_poll_task_state_success():
-    with patch("service.celery_instance") as mock_celery:
+
+@pytest.mark.anyio
+async def test_create_addition_tasks_debits_batch_once(mock_user):
+    with patch("service.publisher.send_tasks", new_callable=AsyncMock) as mock_send_tasks, \
+         patch("service.async_session") as mock_session:
+        mock_ctx = AsyncMock()
         mock_result = MagicMock()
-        mock_result.state = "SUCCESS"
-        mock_result.ready.return_value = True
-        mock_result.result = 8
-        mock_celery.AsyncResult.return_value = mock_result
+        mock_result.all.return_value = [("test_user", 470)]
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+        mock_send_tasks.return_value = "group-123"
+
+        result = await create_addition_tasks(mock_user, [(1, 2), (3, 4), (5, 6)], grouped=True)
+
+        assert len(result.task_ids) == 3
+        assert result.group_id == "group-123"
+        mock_ctx.execute.assert_awaited_once()
+        mock_ctx.commit.assert_awaited_once()
+        mock_send_tasks.assert_awaited_once_with(
+            "worker.add", [([1, 2], result.task_ids[0]), ([3, 4], result.task_ids[1]), ([5, 6], result.task_ids[2])],
+            grouped=True,
+        )
+
+
+@pytest.mark.anyio
+async def test_create_addition_tasks_insufficient_credits(mock_user):
+    with patch("service.publisher.send_tasks", new_callable=AsyncMock) as mock_send_tasks, \
+         patch("service.async_session") as mock_session:
+        mock_ctx = AsyncMock()
+        mock_result = MagicMock()
+        mock_result.all.return_value = []
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        with pytest.raises(HTTPException) as exc_info:
+            await create_addition_tasks(mock_user, [(1, 2), (3, 4)])
 
-        result = poll_task_state("task-123")
+        assert exc_info.value.status_code == 403
+        mock_ctx.commit.assert_not_called()
+        mock_send_tasks.assert_not_called()
 
+
+@pytest.mark.anyio
+async def test_poll_task_state():
+    with patch("service.results.fetch_states", new_callable=AsyncMock) as mock_fetch_states:
+        mock_fetch_states.return_value = [TaskStateResponse(task_id="task-123", state="SUCCESS", result=8)]
+
+        result = await poll_task_state("task-123")
+
+        mock_fetch_states.assert_awaited_once_with(["task-123"])
         assert result.task_id == "task-123"
         assert result.state == "SUCCESS"
         assert result.result == 8
 
 
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_poll_group_state():
+    with patch("service.GroupResult") as mock_group_result, \
+         patch("service.results.fetch_states", new_callable=AsyncMock) as mock_fetch_states:
+        mock_group_result.restore.return_value.results = [MagicMock(id="task-1"), MagicMock(id="task-2")]
+        mock_fetch_states.return_value = [
+            TaskStateResponse(task_id="task-1", state="SUCCESS", result=3),
+            TaskStateResponse(task_id="task-2", state="PENDING"),
+        ]
+
+        result = await poll_group_state("group-123")
+
+        assert result.group_id == "group-123"
+        assert [task.task_id for task in result.tasks] == ["task-1", "task-2"]
+        mock_fetch_states.assert_awaited_once_with(["task-1", "task-2"])
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_poll_group_state_not_found():
+    with patch("service.GroupResult") as mock_group_result:
+        mock_group_result.restore.return_value = None
+
+        with pytest.raises(HTTPException) as exc_info:
+            await poll_group_state("group-123")
+
+        assert exc_info.value.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_get_streamed_task_ids_defaults_to_recent_history(mock_user):
+    with patch("service.async_session") as mock_session:
+        mock_ctx = AsyncMock()
+        mock_result = MagicMock()
+        mock_result.scalars.return_value.all.return_value = ["task-2", "task-1"]
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        task_ids = await get_streamed_task_ids(mock_user, [], None)
+
+        assert task_ids == ["task-2", "task-1"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_get_streamed_task_ids_merges_group(mock_user):
+    with patch("service.GroupResult") as mock_group_result, \
+         patch("service.async_session") as mock_session:
+        mock_group_result.restore.return_value.results = [MagicMock(id="task-1"), MagicMock(id="task-2")]
+
+        task_ids = await get_streamed_task_ids(mock_user, ["task-1"], "group-123")
+
+        assert task_ids == ["task-1", "task-2"]
+        mock_session.assert_not_called()
+
+
 @pytest.mark.anyio
 async def test_get_user_credits_found():
     mock_user = MagicMock()
     mock_user.name = "test_user"
     mock_user.credits = 500
 
-    with patch("service.async_session") as mock_session:
+    with patch("service.async_read_session") as mock_session:
         mock_ctx = AsyncMock()
         mock_result = MagicMock()
         mock_result.scalar_one_or_none.return_value = mock_user
@@ -121,7 +280,7 @@ async def test_get_user_credits_found():
 
 @pytest.mark.anyio
 async def test_get_user_credits_not_found():
-    with patch("service.async_session") as mock_session:
+    with patch("service.async_read_session") as mock_session:
         mock_ctx = AsyncMock()
         mock_result = MagicMock()
         mock_result.scalar_one_or_none.return_value = None
@@ -137,11 +296,13 @@ async def test_get_user_credits_not_found():
 
 @pytest.mark.anyio
 async def test_update_user_credits_success():
-    with patch("service.async_session") as mock_session:
+    with patch("service.async_session") as mock_session, \
+         patch("service.auth.invalidate_user", new_callable=AsyncMock) as mock_invalidate:
         mock_ctx = AsyncMock()
         mock_row = MagicMock()
         mock_row.name = "test_user"
         mock_row.credits = 600
+        mock_row.api_key = "test-api-key"
         mock_result = MagicMock()
         mock_result.fetchone.return_value = mock_row
         mock_ctx.execute = AsyncMock(return_value=mock_result)
@@ -152,6 +313,7 @@ async def test_update_user_credits_success():
 
         assert result.name == "test_user"
         assert result.credits == 600
+        mock_invalidate.assert_awaited_once_with("test-api-key")
 
 
 @pytest.mark.anyio
@@ -168,3 +330,280 @@ async def test_update_user_credits_user_not_found():
 
         assert exc_info.value.status_code == 404
         assert exc_info.value.detail == "User not found."
+
+
+@pytest.mark.anyio
+async def test_get_user_credits_from_ledger():
+    with patch("service.BILLING_MODE", "ledger"), \
+         patch("service.ledger.get_credits", new_callable=AsyncMock) as mock_get_credits, \
+         patch("service.async_read_session") as mock_session:
+        mock_get_credits.return_value = 480
+
+        result = await get_user_credits("test_user")
+
+        assert result.credits == 480
+        mock_session.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_create_addition_task_debits_ledger(mock_user):
+    with patch("service.BILLING_MODE", "ledger"), \
+         patch("service.ledger.debit", new_callable=AsyncMock) as mock_debit, \
+         patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task, \
+         patch("service.async_session") as mock_session:
+        mock_debit.return_value = 490
+
+        result = await create_addition_task(mock_user, 5, 3)
+
+        mock_debit.assert_awaited_once_with("test_user", [result.task_id], API_COST)
+        mock_send_task.assert_awaited_once()
+        mock_session.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_create_addition_task_debits_credit_slots(mock_user):
+    with patch("service.BILLING_MODE", "sharded"), \
+         patch("service.credit_slots.debit", new_callable=AsyncMock) as mock_debit, \
+         patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task, \
+         patch("service.async_session") as mock_session:
+        mock_debit.return_value = 490
+
+        result = await create_addition_task(mock_user, 5, 3)
+
+        mock_debit.assert_awaited_once_with("test_user", [result.task_id], API_COST)
+        mock_send_task.assert_awaited_once()
+        mock_session.assert_not_called()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_debit_batcher_commits_concurrent_debits_once():
+    batcher = DebitBatcher(window=0.01, max_size=10)
+
+    with patch("service.async_session") as mock_session:
+        mock_ctx = AsyncMock()
+        mock_result = MagicMock()
+        mock_result.all.return_value = [("user1", 480), ("user2", 90)]
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        results = await asyncio.gather(
+            batcher.debit("user1", "task-1", API_COST),
+            batcher.debit("user1", "task-2", API_COST),
+            batcher.debit("user2", "task-3", API_COST),
+        )
+
+        assert results == [480, 480, 90]
+        mock_ctx.execute.assert_awaited_once()
+        mock_ctx.commit.assert_awaited_once()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_debit_batcher_flushes_when_full():
+    batcher = DebitBatcher(window=60, max_size=2)
+
+    with patch("service.async_session") as mock_session:
+        mock_ctx = AsyncMock()
+        mock_result = MagicMock()
+        mock_result.all.return_value = [("user1", 480)]
+        mock_ctx.execute = AsyncMock(return_value=mock_result)
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        results = await asyncio.wait_for(asyncio.gather(
+            batcher.debit("user1", "task-1", API_COST),
+            batcher.debit("user1", "task-2", API_COST),
+        ), timeout=1)
+
+        assert results == [480, 480]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_debit_batcher_falls_back_to_single_debits():
+    batcher = DebitBatcher(window=0.01, max_size=10)
+
+    with patch("service.async_session") as mock_session:
+        mock_ctx = AsyncMock()
+        batch_result = MagicMock()
+        batch_result.all.return_value = []  # Cannot afford both tasks
+        first_result = MagicMock()
+        first_result.scalar_one_or_none.return_value = 5
+        second_result = MagicMock()
+        second_result.scalar_one_or_none.return_value = None
+        mock_ctx.execute = AsyncMock(side_effect=[batch_result, first_result, second_result])
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        results = await asyncio.gather(
+            batcher.debit("user1", "task-1", API_COST),
+            batcher.debit("user1", "task-2", API_COST),
+        )
+
+        assert results == [5, None]
+        mock_ctx.commit.assert_awaited_once()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_debit_batcher_propagates_errors():
+    batcher = DebitBatcher(window=0.01, max_size=10)
+
+    with patch("service.async_session") as mock_session:
+        mock_ctx = AsyncMock()
+        mock_ctx.execute = AsyncMock(side_effect=ConnectionError("database down"))
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        with pytest.raises(ConnectionError):
+            await batcher.debit("user1", "task-1", API_COST)
+
+
+def test_batch_debit_statement_aggregates_per_user():
+    statement = batch_debit_statement([("user1", "task-1", 10), ("user1", "task-2", 10), ("user2", "task-3", 10)])
+    compiled = statement.compile(dialect=postgresql.dialect())
+
+    assert "UPDATE users SET credits=(users.credits - totals.total) FROM locked, (VALUES" in str(compiled)
+    assert sorted(v for k, v in compiled.params.items() if isinstance(v, int)) == [10, 10, 10, 10, 20]
+
+
+def test_batch_debit_statement_locks_users_in_name_order():
+    statement = batch_debit_statement([("user2", "task-1", 10), ("user1", "task-2", 10)])
+    compiled = statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+
+    assert "WHERE users.name IN ('user1', 'user2') ORDER BY users.name FOR NO KEY UPDATE" in str(compiled)
+    assert "VALUES ('user1', 10), ('user2', 10)" in str(compiled)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_addition_batcher_publishes_one_message():
+    batcher = AdditionBatcher(window=0.01, max_size=10)
+
+    with patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task:
+        await asyncio.gather(
+            batcher.submit("task-1", 1, 2),
+            batcher.submit("task-2", 3, 4),
+        )
+
+        mock_send_task.assert_awaited_once_with("worker.add_many", args=[["task-1", "task-2"], [1, 3], [2, 4]])
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_addition_batcher_flushes_when_full():
+    batcher = AdditionBatcher(window=60, max_size=2)
+
+    with patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task:
+        await asyncio.wait_for(asyncio.gather(
+            batcher.submit("task-1", 1, 2),
+            batcher.submit("task-2", 3, 4),
+        ), timeout=1)
+
+        mock_send_task.assert_awaited_once()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_addition_batcher_publishes_one_message_per_route():
+    batcher = AdditionBatcher(window=0.01, max_size=10)
+
+    with patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task:
+        await asyncio.gather(
+            batcher.submit("task-1", 1, 2, queue="tasks.0", priority=0),
+            batcher.submit("task-2", 3, 4, queue="tasks.1", priority=0),
+            batcher.submit("task-3", 5, 6, queue="tasks.0", priority=0),
+        )
+
+        assert mock_send_task.await_count == 2
+        mock_send_task.assert_any_await(
+            "worker.add_many", args=[["task-1", "task-3"], [1, 5], [2, 6]], queue="tasks.0", priority=0,
+        )
+        mock_send_task.assert_any_await("worker.add_many", args=[["task-2"], [3], [4]], queue="tasks.1", priority=0)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_create_addition_task_refunds_when_batch_publish_fails(mock_user):
+    with patch("service.TASK_MICROBATCH_WINDOW", 0.01), \
+         patch("service.addition_batcher", AdditionBatcher(window=0.01, max_size=10)), \
+         patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task, \
+         patch("service.debit_credits", new_callable=AsyncMock) as mock_debit, \
+         patch("service.refund_tasks", new_callable=AsyncMock) as mock_refund:
+        mock_debit.return_value = 490
+        mock_send_task.side_effect = ConnectionError("broker down")
+
+        with pytest.raises(ConnectionError):
+            await create_addition_task(mock_user, 5, 3)
+
+        task_id = mock_send_task.call_args.kwargs["args"][0][0]
+        mock_refund.assert_awaited_once_with("test_user", [task_id], API_COST)
+
+
+@pytest.mark.anyio
+async def test_create_addition_task_served_from_memo(mock_user):
+    with patch("service.memo.TASK_MEMO_TTL", 60), \
+         patch("service.memo.claim", new_callable=AsyncMock) as mock_claim, \
+         patch("service.results.store_states", new_callable=AsyncMock) as mock_store, \
+         patch("service.debit_credits", new_callable=AsyncMock) as mock_debit, \
+         patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task:
+        mock_debit.return_value = 490
+        mock_claim.return_value = (b"hit", 8)
+
+        result = await create_addition_task(mock_user, 5, 3)
+
+        mock_debit.assert_awaited_once_with("test_user", [result.task_id], API_COST)
+        mock_store.assert_awaited_once_with([result.task_id], "SUCCESS", 8)
+        mock_send_task.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_create_addition_task_settles_memo_hit(mock_user):
+    with patch("service.memo.TASK_MEMO_TTL", 60), \
+         patch("service.BILLING_POLICY", "on_success"), \
+         patch("service.memo.claim", new_callable=AsyncMock) as mock_claim, \
+         patch("service.results.store_states", new_callable=AsyncMock), \
+         patch("service.settlement.publish_outcomes", new_callable=AsyncMock) as mock_publish_outcomes, \
+         patch("service.debit_credits", new_callable=AsyncMock) as mock_debit:
+        mock_debit.return_value = 490
+        mock_claim.return_value = (b"hit", 8)
+
+        result = await create_addition_task(mock_user, 5, 3)
+
+        mock_publish_outcomes.assert_awaited_once_with([result.task_id], "SUCCESS")
+
+
+@pytest.mark.anyio
+async def test_create_addition_task_follows_task_in_flight(mock_user):
+    with patch("service.memo.TASK_MEMO_TTL", 60), \
+         patch("service.memo.claim", new_callable=AsyncMock) as mock_claim, \
+         patch("service.debit_credits", new_callable=AsyncMock) as mock_debit, \
+         patch("service.publisher.send_task", new_callable=AsyncMock) as mock_send_task:
+        mock_debit.return_value = 490
+        mock_claim.return_value = (b"follow", "task-1")
+
+        result = await create_addition_task(mock_user, 5, 3)
+
+        assert result.task_id != "task-1"
+        mock_send_task.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_get_task_history_pages_by_keyset(mock_user):
+    with patch("service.async_read_session") as mock_session:
+        mock_ctx = AsyncMock()
+        mock_ctx.execute = AsyncMock(return_value=MagicMock())
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        await get_task_history(mock_user, after="2026-10-17T10:00:00+02:00,task-1", limit=10)
+
+        compiled = mock_ctx.execute.await_args.args[0].compile(dialect=postgresql.dialect())
+        assert "(user_task_history.created_at, user_task_history.task_id) < (" in str(compiled)
+        assert "ORDER BY user_task_history.created_at DESC, user_task_history.task_id DESC" in str(compiled)
+        assert datetime(2026, 10, 17, 8) in compiled.params.values()
+
+
+@pytest.mark.anyio
+async def test_get_task_history_invalid_cursor(mock_user):
+    with pytest.raises(HTTPException) as exc_info:
+        await get_task_history(mock_user, after="not-a-cursor")
+
+    assert exc_info.value.status_code == 400
@@ -0,0 +1,39 @@
+from unittest.mock import AsyncMock, patch
+
+import fakeredis
+import pytest
+from sqlalchemy.dialects import postgresql
+
+from settlement import SETTLEMENT_GROUP, SETTLEMENT_STREAM, settle, settle_statement
+
+
+def test_settle_statement_only_touches_unsettled_tasks():
+    compiled = str(settle_statement([("task-1", True), ("task-2", False)]).compile(dialect=postgresql.dialect()))
+
+    assert "WHERE user_task_history.settled_at IS NULL FOR UPDATE OF user_task_history" in compiled
+    assert "SET cost=CASE WHEN pending.succeeded THEN user_task_history.cost" in compiled
+    assert "WHERE settled.succeeded IS false GROUP BY settled.user_name" in compiled
+    assert "UPDATE users SET credits=(users.credits + refunds.total) FROM refunds" in compiled
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_settle_commits_batch_and_acknowledges():
+    client = fakeredis.FakeAsyncRedis()
+    await client.xgroup_create(SETTLEMENT_STREAM, SETTLEMENT_GROUP, id="0", mkstream=True)
+    await client.xadd(SETTLEMENT_STREAM, {"task": "task-1", "state": "SUCCESS"})
+    await client.xadd(SETTLEMENT_STREAM, {"task": "task-2", "state": "FAILURE"})
+    [(_, entries)] = await client.xreadgroup(SETTLEMENT_GROUP, "consumer", {SETTLEMENT_STREAM: ">"})
+
+    with patch("settlement.results.instance", client), \
+         patch("settlement.async_session") as mock_session, \
+         patch("settlement.settle_statement") as mock_statement:
+        mock_ctx = AsyncMock()
+        mock_session.return_value.__aenter__.return_value = mock_ctx
+
+        await settle(entries)
+
+        mock_statement.assert_called_once_with([("task-1", True), ("task-2", False)])
+        mock_ctx.commit.assert_awaited_once()
+        assert await client.xlen(SETTLEMENT_STREAM) == 0
+        assert (await client.xpending(SETTLEMENT_STREAM, SETTLEMENT_GROUP))["pending"] == 0
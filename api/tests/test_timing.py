@@ -0,0 +1,52 @@
+import pytest
+
+import timing
+
+
+def test_stage_records_into_current_request():
+    timings = timing.start_request()
+
+    with timing.stage("debit"):
+        pass
+    with pytest.raises(ValueError):
+        with timing.stage("publish"):
+            raise ValueError()
+
+    assert [name for name, _ in timings] == ["debit", "publish"]
+    assert timing.API_STAGE_SECONDS.labels(stage="debit")._sum.get() > 0
+
+
+def test_server_timing_in_milliseconds():
+    assert timing.server_timing([("auth_cache", 0.0012), ("debit", 0.25)]) == "auth_cache;dur=1.2, debit;dur=250.0"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("anyio_backend", ["asyncio"])
+async def test_server_timing_middleware_adds_header_to_response_start():
+    async def endpoint(scope, receive, send):
+        with timing.stage("debit"):
+            pass
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    await timing.ServerTimingMiddleware(endpoint)({"type": "http"}, None, send)
+
+    headers = dict(sent[0]["headers"])
+    assert headers[b"content-type"] == b"text/plain"
+    assert headers[b"server-timing"].startswith(b"debit;dur=")
+    assert sent[1] == {"type": "http.response.body", "body": b"ok"}
+
+
+def test_stamp_submission_keeps_existing_stamp():
+    headers = {}
+    timing.stamp_submission(headers=headers)
+    submitted_at = headers[timing.SUBMITTED_AT_HEADER]
+
+    timing.stamp_submission(headers=headers)
+
+    assert headers[timing.SUBMITTED_AT_HEADER] == submitted_at
@@ -0,0 +1,92 @@
+"""Timing of the stages requests go through.
+
+`stage` measures a block of request handling, e.g. the debit transaction, into the
+`api_stage_seconds` histogram. The stages of a request are also reported in the
+`Server-Timing` header of its response, so that a single slow request shows where its time
+went, e.g. in the network panel of a browser.
+
+The header is added by `ServerTimingMiddleware`, unless `SERVER_TIMING` is disabled.
+
+Tasks are stamped with the time they were submitted before they are published. Workers
+measure how long tasks waited in the broker from that stamp, see the worker's metrics.
+"""
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from celery.signals import before_task_publish
+from prometheus_client import Histogram
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
+"""Whether responses report the stages of their request in a `Server-Timing` header."""
+
+SUBMITTED_AT_HEADER = "submitted_at"
+"""Task header holding the UNIX time the task was submitted at. Must match the worker."""
+
+API_STAGE_SECONDS = Histogram("api_stage_seconds", "Time spent per stage of request handling.", ["stage"])
+
+_timings: ContextVar[list[tuple[str, float]] | None] = ContextVar("timings", default=None)
+
+
+def start_request() -> list[tuple[str, float]]:
+    """Start collecting the stages of the current request.
+
+    Returns:
+        list[tuple[str, float]]: `(stage, seconds)` of every stage, filled in as the request is handled.
+    """
+    timings = []
+    _timings.set(timings)
+    return timings
+
+
+@contextmanager
+def stage(name: str):
+    """Measure a stage of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        API_STAGE_SECONDS.labels(stage=name).observe(elapsed)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, elapsed))
+
+
+def server_timing(timings: list[tuple[str, float]]) -> str:
+    """Format stages as a `Server-Timing` header value, in milliseconds."""
+    return ", ".join(f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in timings)
+
+
+class ServerTimingMiddleware:
+    """ASGI middleware reporting the stages of every HTTP request in a `Server-Timing` header.
+
+    The header is added to the response start message on its way out, so requests are not
+    wrapped in an extra task and stream the way `BaseHTTPMiddleware` would.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings = start_request()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start" and timings:
+                header = (b"server-timing", server_timing(timings).encode())
+                message = {**message, "headers": [*message.get("headers", []), header]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
+
+
+@before_task_publish.connect
+def stamp_submission(headers: dict | None = None, **_):
+    """Stamp tasks with the time they were submitted at."""
+    if headers is not None:
+        headers.setdefault(SUBMITTED_AT_HEADER, time.time())
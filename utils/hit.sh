@@ -11,18 +11,35 @@ response=$(curl -s -X POST "${BASE_URL}/task?x=5&y=3" \
 task_id=$(echo "$response" | jq -r '.task_id')
 echo "Task created: $task_id"
 
-# Poll until SUCCESS
+# Long-poll until the task is ready, the API holds each request for up to 30 seconds
 echo "Polling for result..."
 while true; do
-  poll_response=$(curl -s -X GET "${BASE_URL}/poll/${task_id}")
-  state=$(echo "$poll_response" | jq -r '.state')
+  poll_response=$(curl -s -w '\n%{http_code}' -X GET "${BASE_URL}/poll/${task_id}?wait=30")
+  status=$(echo "$poll_response" | tail -n 1)
+  body=$(echo "$poll_response" | sed '$d')
 
-  if [ "$state" = "SUCCESS" ]; then
-    result=$(echo "$poll_response" | jq -r '.result')
-    echo "Task completed! Result: $result"
-    break
+  # Client errors will not go away on retry, server errors and lost connections may
+  if [ "${status:0:1}" = "4" ]; then
+    echo "Polling failed with HTTP ${status}: $body"
+    exit 1
+  elif [ "$status" != "200" ]; then
+    echo "Polling failed with HTTP ${status} - retrying..."
+    sleep 1
+    continue
   fi
 
+  state=$(echo "$body" | jq -r '.state')
+  case "$state" in
+    SUCCESS)
+      result=$(echo "$body" | jq -r '.result')
+      echo "Task completed! Result: $result"
+      break
+      ;;
+    FAILURE|REVOKED)
+      echo "Task finished in state $state: $(echo "$body" | jq -c '.result')"
+      exit 1
+      ;;
+  esac
+
   echo "State: $state - waiting..."
-  sleep 1
 done